@@ -0,0 +1,1513 @@
+"""بنچمارک‌های ربات کتابخانه
+
+روی یک دیتابیس آزمایشی اجرا می‌شود (هرگز دیتابیس اصلی):
+    BENCH_DATABASE_URL=postgresql://localhost/library_bench python bench.py search --books 100000
+    BENCH_DATABASE_URL=... DB_POOL_MAX=20 python bench.py approve-race --stock 5 --requests 200
+    BENCH_DATABASE_URL=... DB_POOL_MAX=20 python bench.py waitlist --stock 5 --requests 200
+    BENCH_DATABASE_URL=... python bench.py persistence --users 2000
+    BENCH_DATABASE_URL=... python bench.py explain --books 100000 --loans 300000
+    BENCH_DATABASE_URL=... python bench.py subject-stats --books 100000
+    BENCH_DATABASE_URL=... BOOK_CACHE_SIZE=2000 python bench.py book-cache --lookups 20000
+    BENCH_DATABASE_URL=... python bench.py reminders --loans 300000
+    BENCH_DATABASE_URL=... python bench.py stats --loans 300000
+    BENCH_DATABASE_URL=... python bench.py export --loans 300000
+    BENCH_DATABASE_URL=... python bench.py archive --loans 1000000
+    BENCH_DATABASE_URL=... python bench.py catalog --books 100000
+    BENCH_DATABASE_URL=... python bench.py workers --workers 1,2,4 --updates 6000
+    BENCH_DATABASE_URL=... BENCH_REPLICA_URL=postgresql://replica/library_bench python bench.py replica
+    BENCH_DATABASE_URL=... python bench.py metrics
+    BENCH_DATABASE_URL=... python bench.py guard --requests 400
+    BENCH_DATABASE_URL=... python bench.py replay --mix all --updates 3000 --concurrency 50
+    BENCH_DATABASE_URL=... python bench.py replay --mix all --save-baseline   # ثبت خط پایه جدید
+
+خط پایه replay (bench_baseline.json) فقط شمارش‌های مستقل از ماشین را برای هر آپدیت نگه می‌دارد:
+فراخوانی Bot API، رفت‌وبرگشت دیتابیس و ردیف‌های خوانده و نوشته‌شده. مقایسه روی همین‌ها انجام می‌شود
+و زمان‌ها (آپدیت در ثانیه و p95 هر handler) فقط گزارش می‌شوند. تغییری که این شمارش‌ها را عمداً
+کم می‌کند خط پایه را با پارامترهای پیش‌فرض و --save-baseline دوباره ثبت می‌کند.
+"""
+import os
+import sys
+import io
+import time
+import random
+import asyncio
+import json
+import argparse
+import gc
+import statistics
+import gzip
+import csv
+import datetime
+import tracemalloc
+import types
+import itertools
+import signal
+from collections import Counter, OrderedDict, defaultdict
+
+BENCH_DATABASE_URL = os.environ.get('BENCH_DATABASE_URL')
+if not BENCH_DATABASE_URL:
+    sys.exit("BENCH_DATABASE_URL را روی یک دیتابیس آزمایشی تنظیم کنید.")
+os.environ['DATABASE_URL'] = BENCH_DATABASE_URL
+
+os.environ.setdefault('TOKEN', '123456:offline-bench')
+# کاربران ساختگی بازپخش با سرعت ماشین پیام می‌فرستند؛ محدودیت نرخ هر کاربر فقط در بنچمارک guard سنجیده می‌شود
+os.environ.setdefault('GUARD_USER_RATE', '0')
+import bot  # noqa: E402  (bot تنظیمات را هنگام import از محیط می‌خواند)
+from telegram import Update  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+WORDS = [
+    "تاریخ", "ایران", "کتاب", "شعر", "دیوان", "حافظ", "سعدی", "رمان", "جنگ", "صلح", "علم", "فلسفه",
+    "روانشناسی", "کودک", "آموزش", "ریاضی", "فیزیک", "شیمی", "برنامه‌نویسی", "پایتون", "داده", "هنر",
+    "history", "python", "data", "science", "war", "peace", "poetry", "novel", "music", "art",
+]
+AUTHORS = ["علی", "مریم", "رضا", "سارا", "حسین", "زهرا", "Smith", "Jones", "Garcia", "Tanaka"]
+SUBJECTS = ['داستان', 'علمی-تخیلی', 'روانشناسی', 'تاریخی', 'درسی', 'سایر']
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    pick = lambda p: samples[min(len(samples) - 1, int(len(samples) * p))]
+    return {
+        'n': len(samples),
+        'mean': statistics.fmean(samples),
+        'p50': pick(0.50),
+        'p95': pick(0.95),
+        'p99': pick(0.99),
+    }
+
+
+def report(name, samples):
+    p = percentiles(samples)
+    print(f"{name:<32} n={p['n']:<6} mean={p['mean']:8.2f}ms  p50={p['p50']:8.2f}ms  "
+          f"p95={p['p95']:8.2f}ms  p99={p['p99']:8.2f}ms")
+
+
+def _copy_books(conn, rows):
+    buf = io.StringIO()
+    for title, author, subject, count in rows:
+        buf.write(f"{title}\t{author}\t{subject}\t{count}\n")
+    buf.seek(0)
+    with conn.cursor() as cursor:
+        cursor.copy_from(buf, 'books', columns=('title', 'author', 'subject', 'count'))
+
+
+async def seed_books(n, rng):
+    existing = (await bot.db_query("SELECT count(*) FROM books"))[0][0]
+    if existing >= n:
+        return
+    print(f"درج {n - existing} کتاب...")
+    batch = []
+    for _ in range(n - existing):
+        title = " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 5)))
+        batch.append((title, rng.choice(AUTHORS), rng.choice(SUBJECTS), rng.randint(1, 5)))
+        if len(batch) == 10000:
+            await bot.db_pool.run(_copy_books, batch)
+            batch = []
+    if batch:
+        await bot.db_pool.run(_copy_books, batch)
+    await bot.db_query("ANALYZE books")
+
+
+async def bench_search(args):
+    rng = random.Random(args.seed)
+    await seed_books(args.books, rng)
+    queries = {
+        'exact': "تاریخ ایران",
+        'latin': "python data",
+        # ي و ك عربی، نیم‌فاصله و اعراب باید با نسخه فارسی یکسان شوند
+        'arabic-variants': "كتاب تاريخ",
+        'zwnj': "برنامه‌نویسی",
+        'typo': "پایتن",
+        'author-filter': "author:مریم شعر",
+        'subject-filter': "موضوع:تاریخی جنگ",
+        'rare': "zzzz",
+    }
+    print(f"pg_trgm: {'فعال' if bot.SEARCH_TRGM else 'غیرفعال'}")
+    for name, q in queries.items():
+        samples = []
+        for _ in range(args.repeat):
+            t = time.perf_counter()
+            await bot.search_books(q)
+            samples.append((time.perf_counter() - t) * 1000)
+        report(f"search[{name}]", samples)
+
+
+async def bench_approve_race(args):
+    """تأیید همزمان درخواست‌ها؛ شمارنده امانت نباید منفی شود یا از موجودی بگذرد"""
+    stock = args.stock
+    bid = (await bot.db_query(
+        "INSERT INTO books (title, author, subject, count) VALUES ('race', 'bench', 'سایر', %s) RETURNING id", (stock,)))[0][0]
+    lids = []
+    for uid in range(args.requests):
+        _, _, _, lid = await bot.request_loan(10**9 + uid, bid)
+        lids.append(lid)
+
+    t = time.perf_counter()
+    results = await asyncio.gather(*[bot.approve_loan(lid) for lid in lids], *[bot.approve_loan(lid) for lid in lids])
+    elapsed = time.perf_counter() - t
+    approved = sum(1 for r in results if r and r[2])
+    count, borrowed = (await bot.db_query("SELECT count, borrowed_count FROM books WHERE id = %s", (bid,)))[0]
+    print(f"{len(results)} تأیید همزمان در {elapsed * 1000:.1f}ms: تأییدشده={approved} borrowed_count={borrowed} count={count}")
+    assert approved == borrowed == min(stock, args.requests), "شمارنده امانت با تأییدها نمی‌خواند"
+
+    # بازگرداندن همزمان (هر امانت دو بار) و تأیید باقی‌مانده‌ها در همان حال
+    approved_rows = await bot.db_query("SELECT id, user_id FROM loans WHERE book_id = %s AND status = 'APPROVED'", (bid,))
+    await asyncio.gather(*[bot.return_loan(lid, uid) for lid, uid in approved_rows * 2],
+                         *[bot.approve_loan(lid) for lid in lids])
+    count, borrowed = (await bot.db_query("SELECT count, borrowed_count FROM books WHERE id = %s", (bid,)))[0]
+    live = (await bot.db_query("SELECT count(*) FROM loans WHERE book_id = %s AND status = 'APPROVED'", (bid,)))[0][0]
+    print(f"پس از بازگشت‌ها: borrowed_count={borrowed} امانت فعال={live} count={count}")
+    assert 0 <= borrowed <= count and borrowed == live, "شمارنده امانت خارج از بازه است"
+    await bot.db_query("DELETE FROM books WHERE id = %s", (bid,))
+    print("OK")
+
+
+async def bench_persistence(args):
+    """هزینه persistence در مسیر هر آپدیت (باید زیر میلی‌ثانیه بماند) و زمان flush دسته‌ای"""
+    persistence = bot.PostgresPersistence(bot.PERSISTENCE_INTERVAL)
+    await persistence.get_user_data()
+    await persistence.get_conversations('bench')
+    per_update = []
+    for rnd in range(3):
+        for uid in range(args.users):
+            user_data = {'book_data': {'title': f"کتاب {uid}", 'author': "bench"}, 'pager': {'stack': [None, rnd]}}
+            t = time.perf_counter()
+            await persistence.update_user_data(uid, user_data)
+            await persistence.update_conversation('bench', (uid, uid), rnd % 3)
+            # بدون تغییر: نباید دوباره نوشته شود
+            await persistence.update_user_data(uid, user_data)
+            per_update.append((time.perf_counter() - t) * 1000)
+        t = time.perf_counter()
+        await persistence.flush()
+        print(f"flush دور {rnd}: {2 * args.users} ورودی در {(time.perf_counter() - t) * 1000:.1f}ms")
+    report("persistence[per-update]", per_update)
+    print(f"نوشته‌شده={persistence.writes} بدون‌تغییر={persistence.skipped}")
+    assert percentiles(per_update)['p99'] < 1, "هزینه persistence در مسیر آپدیت بیش از یک میلی‌ثانیه است"
+
+    # خواندن دوباره، مانند راه‌اندازی مجدد
+    reloaded = bot.PostgresPersistence(bot.PERSISTENCE_INTERVAL)
+    convs = await reloaded.get_conversations('bench')
+    assert len(convs) == args.users and convs[(0, 0)] == 2, "وضعیت مکالمه پس از بارگذاری مجدد نمی‌خواند"
+    for uid in range(args.users):
+        await persistence.drop_user_data(uid)
+        await persistence.update_conversation('bench', (uid, uid), None)
+    await persistence.flush()
+    print("OK")
+
+
+def _copy_loans(conn, rows):
+    buf = io.StringIO()
+    for book_id, user_id, status in rows:
+        buf.write(f"{book_id}\t{user_id}\t{status}\n")
+    buf.seek(0)
+    with conn.cursor() as cursor:
+        cursor.copy_from(buf, 'loans', columns=('book_id', 'user_id', 'status'))
+
+
+async def seed_loans(n, rng):
+    """امانت‌های ساختگی؛ بیشترشان بسته‌شده‌اند، مانند یک کتابخانه واقعی"""
+    existing = (await bot.db_query("SELECT count(*) FROM loans"))[0][0]
+    if existing >= n:
+        return
+    # بنچمارک‌های دیگر کتاب حذف می‌کنند؛ شناسه‌ها پیوسته نیستند
+    book_ids = [r[0] for r in await bot.db_query("SELECT id FROM books")]
+    print(f"درج {n - existing} امانت...")
+    statuses = ['RETURNED'] * 90 + ['REJECTED'] * 5 + ['APPROVED'] * 3 + ['PENDING'] * 2
+    batch = []
+    for _ in range(n - existing):
+        batch.append((rng.choice(book_ids), rng.randint(1, n // 10), rng.choice(statuses)))
+        if len(batch) == 10000:
+            await bot.db_pool.run(_copy_loans, batch)
+            batch = []
+    if batch:
+        await bot.db_pool.run(_copy_loans, batch)
+    await bot.db_query("ANALYZE loans")
+
+
+async def bench_waitlist(args):
+    """بازگشت‌ها و افزایش موجودی همزمان؛ صف انتظار باید به ترتیب و بدون جلو افتادن تکراری خالی شود"""
+    stock = args.stock
+    bid = (await bot.db_query(
+        "INSERT INTO books (title, author, subject, count) VALUES ('waitlist', 'bench', 'سایر', %s) RETURNING id", (stock,)))[0][0]
+    holders = []
+    for uid in range(stock):
+        _, _, _, lid = await bot.request_loan(10**9 + uid, bid)
+        await bot.approve_loan(lid)
+        holders.append((lid, 10**9 + uid))
+    waiters = [10**9 + stock + i for i in range(args.requests)]
+    t = time.perf_counter()
+    joined = await asyncio.gather(*[bot.join_waitlist(uid, bid) for uid in waiters])
+    print(f"{len(waiters)} ورود همزمان به صف در {(time.perf_counter() - t) * 1000:.1f}ms")
+    assert all(j[3] >= 1 for j in joined)
+    # نوبتی که هنگام ورود همزمان گزارش می‌شود تقریبی است؛ پرس‌وجوی «کتاب‌های من» باید دقیق باشد
+    positions = [(await bot.db_query("""
+        SELECT (SELECT count(*) FROM waitlist q WHERE q.book_id = w.book_id AND q.id <= w.id)
+        FROM waitlist w WHERE w.user_id = %s AND w.book_id = %s
+    """, (uid, bid)))[0][0] for uid in waiters]
+    assert sorted(positions) == list(range(1, len(waiters) + 1)), "نوبت‌ها یکتا و پیوسته نیستند"
+
+    # هر امانت دو بار بازگردانده می‌شود و همزمان موجودی دو برابر می‌شود
+    t = time.perf_counter()
+    await asyncio.gather(*[bot.return_loan(lid, uid) for lid, uid in holders * 2], bot.set_book_count(bid, stock * 2))
+    elapsed = (time.perf_counter() - t) * 1000
+    pending = await bot.db_query("SELECT user_id FROM loans WHERE book_id = %s AND status = 'PENDING' ORDER BY id", (bid,))
+    left = (await bot.db_query("SELECT count(*) FROM waitlist WHERE book_id = %s", (bid,)))[0][0]
+    promoted = [r[0] for r in pending]
+    print(f"{len(holders) * 2 + 1} عملیات همزمان در {elapsed:.1f}ms: جلو آمده={len(promoted)} مانده در صف={left}")
+    assert len(promoted) == len(set(promoted)) == min(stock * 2, len(waiters)), "تعداد جلو آمده‌ها با نسخه‌های آزاد نمی‌خواند"
+    first = [uid for _, uid in sorted(zip(positions, waiters))][:len(promoted)]
+    assert sorted(promoted) == sorted(first), "صف به ترتیب ورود جلو نیامد"
+    assert left == len(waiters) - len(promoted)
+    await bot.db_query("DELETE FROM books WHERE id = %s", (bid,))
+    bot.notifier._pending.clear()
+    while not bot.notifier._queue.empty():
+        bot.notifier._queue.get_nowait()
+    print("OK")
+
+
+# کوئری‌های مسیرهای پرتکرار و جدولی که نباید روی آن Seq Scan انجام شود
+HOT_QUERIES = {
+    'my_loans': ('loans', """
+        SELECT l.id, b.title, l.status FROM loans l JOIN books b ON l.book_id = b.id
+        WHERE l.user_id = %(uid)s AND l.status IN ('PENDING', 'APPROVED')
+    """),
+    'duplicate-request': ('loans', """
+        SELECT 1 FROM loans WHERE user_id = %(uid)s AND book_id = %(bid)s AND status IN ('PENDING', 'APPROVED')
+    """),
+    'approval-page': ('loans', """
+        SELECT l.id, b.title, l.user_id FROM loans l JOIN books b ON l.book_id = b.id
+        WHERE l.status = 'PENDING' AND l.id > 0 ORDER BY l.id LIMIT 11
+    """),
+    'loans-page': ('loans', """
+        SELECT l.id, b.title, l.user_id FROM loans l JOIN books b ON l.book_id = b.id
+        WHERE l.status = 'APPROVED' AND l.id > 0 ORDER BY l.id LIMIT 11
+    """),
+    'book-requests': ('loans', "SELECT id FROM loans WHERE book_id = %(bid)s AND status = 'PENDING' ORDER BY id"),
+    'subject-page': ('books', """
+        SELECT id, title, author, count, borrowed_count FROM books WHERE subject = %(subject)s AND id > 0 ORDER BY id LIMIT 11
+    """),
+}
+HOT_INDEXES = ['loans_user_active', 'loans_status_id', 'loans_book_id', 'books_subject_id']
+
+
+def _plan_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', ()):
+        yield from _plan_nodes(child)
+
+
+def _explain_all(conn, params, drop_indexes):
+    """(نوع گره‌ها، هزینه کل) هر کوئری؛ با drop_indexes ایندکس‌ها فقط داخل همین تراکنش حذف می‌شوند"""
+    plans = {}
+    with conn.cursor() as cursor:
+        if drop_indexes:
+            for name in HOT_INDEXES:
+                cursor.execute(f"DROP INDEX {name}")
+        for name, (table, query) in HOT_QUERIES.items():
+            cursor.execute("EXPLAIN (FORMAT JSON) " + query, params)
+            plan = cursor.fetchone()[0][0]['Plan']
+            # loans پارتیشن‌بندی‌شده است؛ اسکن روی loans_hot یا loans_archive گزارش می‌شود
+            seq = any(n['Node Type'] == 'Seq Scan' and n.get('Relation Name', '').startswith(table)
+                      for n in _plan_nodes(plan))
+            plans[name] = (seq, plan['Total Cost'])
+    if drop_indexes:
+        conn.rollback()
+    return plans
+
+
+async def bench_explain(args):
+    """پلن کوئری‌های پرتکرار بدون ایندکس‌های مهاجرت ۴ و با آن‌ها"""
+    rng = random.Random(args.seed)
+    await seed_books(args.books, rng)
+    await seed_loans(args.loans, rng)
+    uid, bid = (await bot.db_query("SELECT user_id, book_id FROM loans WHERE status = 'PENDING' LIMIT 1"))[0]
+    params = {'uid': uid, 'bid': bid, 'subject': 'تاریخی'}
+
+    before = await bot.db_pool.run(_explain_all, params, True)
+    after = await bot.db_pool.run(_explain_all, params, False)
+    scan = lambda seq: "Seq Scan" if seq else "Index"
+    for name in HOT_QUERIES:
+        print(f"{name:<20} قبل: {scan(before[name][0]):<9} cost={before[name][1]:>10.1f}   "
+              f"بعد: {scan(after[name][0]):<9} cost={after[name][1]:>10.1f}")
+    assert not any(seq for seq, _ in after.values()), "کوئری پرتکراری هنوز Seq Scan دارد"
+
+    # قید borrowed_count باید مقدار خارج از بازه را رد کند
+    bad = await bot.db_query("UPDATE books SET borrowed_count = count + 1 WHERE id = %s", (bid,))
+    assert bad is None, "قید books_borrowed_count_range اعمال نشده است"
+    print("OK")
+
+
+def _vacuum(tables, full=False):
+    conn = bot.psycopg2.connect(BENCH_DATABASE_URL)
+    conn.autocommit = True  # VACUUM داخل تراکنش اجرا نمی‌شود
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f"VACUUM {'(FULL, ANALYZE)' if full else 'ANALYZE'} {tables}")
+    finally:
+        conn.close()
+
+
+async def _hot_latency(label, params, repeat):
+    for name, (table, query) in HOT_QUERIES.items():
+        if table != 'loans':
+            continue
+        samples = []
+        for p in params[:repeat]:
+            t = time.perf_counter()
+            await bot.db_query(query, p)
+            samples.append((time.perf_counter() - t) * 1000)
+        report(f"{name}[{label}]", samples)
+
+
+async def _loan_sizes():
+    rows = await bot.db_query("""
+        SELECT c.relname, (SELECT count(*) FROM loans WHERE archived = (c.relname = 'loans_archive')),
+               pg_table_size(c.oid), pg_indexes_size(c.oid)
+        FROM pg_class c WHERE c.relname IN ('loans_hot', 'loans_archive') ORDER BY 1 DESC
+    """)
+    for name, n, heap, idx in rows:
+        print(f"  {name:<14} {n:>8} ردیف  heap={heap / 2**20:7.1f}MB  ایندکس‌ها={idx / 2**20:7.1f}MB")
+
+
+STATS_TOTALS = """
+    SELECT (SELECT row(sum(requested), sum(approved), sum(rejected), sum(returned), sum(decided))::text FROM loan_stats_daily),
+           (SELECT sum(approved) FROM loan_stats_book), (SELECT sum(approved) FROM loan_stats_user)
+"""
+
+
+async def bench_archive(args):
+    """تأخیر کوئری‌های امانت‌های جاری با همه تاریخچه در پارتیشن داغ و پس از بایگانی آن"""
+    rng = random.Random(args.seed)
+    await seed_books(args.books, rng)
+    await seed_loans(args.loans, rng)
+    if (await bot.db_query("SELECT count(*) FROM loans WHERE archived"))[0][0]:
+        print("برگرداندن بایگانی به پارتیشن داغ برای اندازه‌گیری «پیش از بایگانی»...")
+        await bot.db_query("UPDATE loans SET archived = false WHERE archived")
+    await asyncio.get_running_loop().run_in_executor(None, _vacuum, "loans")
+
+    active = await bot.db_query("""
+        SELECT user_id, book_id FROM loans WHERE status IN ('PENDING', 'APPROVED') ORDER BY random() LIMIT %s
+    """, (args.repeat * 20,))
+    params = [{'uid': uid, 'bid': bid} for uid, bid in active]
+    total, exported = (await bot.db_query("SELECT count(*), count(*) FILTER (WHERE status = 'RETURNED') FROM loans"))[0]
+    await bot.flush_stats()
+    stats = (await bot.db_query(STATS_TOTALS))[0]
+
+    print("پیش از بایگانی (همه تاریخچه در loans_hot، مانند جدول بدون پارتیشن):")
+    await _loan_sizes()
+    await _hot_latency("before", params, len(params))
+
+    t = time.perf_counter()
+    moved = await bot.archive_loans(after_days=0, batch=args.batch)
+    elapsed = time.perf_counter() - t
+    print(f"بایگانی: {moved} امانت در {elapsed:.1f}s ({moved / elapsed:.0f} ردیف در ثانیه، "
+          f"دسته‌های {args.batch} تایی)")
+    await asyncio.get_running_loop().run_in_executor(None, _vacuum, "loans")
+
+    print("پس از بایگانی و VACUUM:")
+    await _loan_sizes()
+    await _hot_latency("after", params, len(params))
+    # VACUUM فضای آزادشده را برای درج‌های بعدی نگه می‌دارد و فایل کوچک نمی‌شود؛ اندازه پایدار
+    # پارتیشن داغ پس از فشرده‌سازی یک‌باره (VACUUM FULL یا pg_repack پس از اولین بایگانی بزرگ)
+    await asyncio.get_running_loop().run_in_executor(None, _vacuum, "loans_hot", True)
+    print("پس از فشرده‌سازی loans_hot:")
+    await _loan_sizes()
+    await _hot_latency("compact", params, len(params))
+
+    # بایگانی در آمار اثری ندارد و تاریخچه از loans و خروجی CSV همچنان دیده می‌شود
+    assert (await bot.db_query("SELECT count(*) FROM loan_stats_delta"))[0][0] == 0, "بایگانی رویداد آمار ساخت"
+    assert (await bot.db_query(STATS_TOTALS))[0] == stats, "بایگانی آمار امانت‌ها را تغییر داد"
+    assert (await bot.db_query("SELECT count(*) FROM loans"))[0][0] == total
+    assert (await bot.db_query("""
+        SELECT count(*) FROM loans_hot
+        WHERE status IN ('RETURNED', 'REJECTED') AND COALESCE(return_date, decided_at, borrow_date) < CURRENT_TIMESTAMP
+    """))[0][0] == 0
+    spool, rows, _ = await bot.build_export('history', status='RETURNED', compress=False)
+    spool.close()
+    assert rows == exported, f"خروجی تاریخچه {rows} ردیف دارد، انتظار {exported}"
+    assert await bot.archive_loans(after_days=0) == 0
+    print("OK")
+
+
+OVERDUE_PLAN = """
+    EXPLAIN (FORMAT JSON)
+    SELECT l.id FROM loans l
+    WHERE l.status = 'APPROVED' AND l.due_date < CURRENT_TIMESTAMP
+      AND l.user_id NOT IN (
+          SELECT r.user_id FROM loans r
+          WHERE r.status = 'APPROVED' AND r.last_reminded_at > CURRENT_TIMESTAMP - interval '1 day'
+      )
+    ORDER BY l.due_date LIMIT 5000
+"""
+
+
+async def bench_reminders(args):
+    """job یادآوری روی تاریخچه بزرگ امانت‌ها: بدون Seq Scan، یک پیام برای هر کاربر، و اجرای دوم بی‌اثر"""
+    rng = random.Random(args.seed)
+    await seed_books(args.books, rng)
+    await seed_loans(args.loans, rng)
+    # حدود دو سوم امانت‌های فعال از موعد گذشته‌اند
+    await bot.db_query("""
+        UPDATE loans SET due_date = CURRENT_TIMESTAMP - (mod(id, 30) - 10) * interval '1 day', last_reminded_at = NULL
+        WHERE status = 'APPROVED'
+    """)
+    await bot.db_query("ANALYZE loans")
+    total, active = (await bot.db_query("SELECT count(*), count(*) FILTER (WHERE status = 'APPROVED') FROM loans"))[0]
+    overdue, users = (await bot.db_query("""
+        SELECT count(*), count(DISTINCT user_id) FROM loans WHERE status = 'APPROVED' AND due_date < CURRENT_TIMESTAMP
+    """))[0]
+    print(f"امانت‌ها: {total}، فعال: {active}، دیرکرد: {overdue} از {users} کاربر")
+
+    # تاریخچه در loans_archive است و نباید در پلن بیاید؛ پارتیشن داغ فقط امانت‌های جاری و تازه
+    # بسته‌شده را دارد و اسکن کامل آن (اگر planner ارزان‌تر بداند) به اندازه تاریخچه وابسته نیست
+    nodes = list(_plan_nodes((await bot.db_query(OVERDUE_PLAN))[0][0][0]['Plan']))
+    scans = sorted({f"{n['Node Type']} on {n['Relation Name']}" for n in nodes if 'Relation Name' in n})
+    print(f"پلن جستجوی دیرکردها: {', '.join(scans)}")
+    assert not any(n.get('Relation Name') == 'loans_archive' for n in nodes), "جستجوی دیرکردها بایگانی را می‌خواند"
+
+    # با محدودیت REMINDER_BATCH ممکن است چند اجرا لازم باشد تا همه کاربران پیام بگیرند
+    queued = bot.notifier.depth()
+    runs = []
+    while True:
+        before = bot.notifier.depth()
+        t = time.perf_counter()
+        await bot.send_overdue_reminders(None)
+        runs.append((time.perf_counter() - t) * 1000)
+        if bot.notifier.depth() == before:
+            break
+    messages = bot.notifier.depth() - queued
+    reminded = (await bot.db_query("SELECT count(*) FROM loans WHERE last_reminded_at IS NOT NULL"))[0][0]
+    print(f"{len(runs) - 1} اجرا ({', '.join(f'{r:.1f}ms' for r in runs[:-1])})، "
+          f"{reminded} امانت یادآوری شد، {messages} پیام در صف")
+    assert messages == users and reminded == overdue, "هر کاربر باید دقیقاً یک پیام با همه دیرکردهایش بگیرد"
+
+    samples = []
+    for _ in range(args.repeat):
+        t = time.perf_counter()
+        await bot.send_overdue_reminders(None)
+        samples.append((time.perf_counter() - t) * 1000)
+    report("reminders[steady state]", samples)
+    assert bot.notifier.depth() - queued == messages, "یادآوری تکراری در همان روز فرستاده شد"
+
+    bot.notifier._pending.clear()
+    while not bot.notifier._queue.empty():
+        bot.notifier._queue.get_nowait()
+    await bot.db_query("UPDATE loans SET last_reminded_at = NULL WHERE last_reminded_at IS NOT NULL")
+    print("OK")
+
+
+# همان باز شدن ردیف‌ها به رویداد که loan_stats_fold انجام می‌دهد، مستقیم روی کل loans
+LOAN_STATS_CHECK = """
+    WITH ev AS (
+        SELECT borrow_date::date AS day, 1 AS requested, 0 AS approved, 0 AS rejected, 0 AS returned, NULL::float8 AS wait
+        FROM loans
+        UNION ALL
+        SELECT COALESCE(decided_at, borrow_date)::date, 0, 1, 0, 0, extract(epoch FROM decided_at - borrow_date)
+        FROM loans WHERE status IN ('APPROVED', 'RETURNED')
+        UNION ALL
+        SELECT COALESCE(decided_at, borrow_date)::date, 0, 0, 1, 0, extract(epoch FROM decided_at - borrow_date)
+        FROM loans WHERE status = 'REJECTED'
+        UNION ALL
+        SELECT COALESCE(return_date, decided_at, borrow_date)::date, 0, 0, 0, 1, NULL FROM loans WHERE status = 'RETURNED'
+    )
+    SELECT day, sum(requested), sum(approved), sum(rejected), sum(returned), count(wait) FROM ev GROUP BY day ORDER BY day
+"""
+
+
+async def _circulate(rng, n):
+    """تأیید، رد و بازگشت تصادفی همزمان با backfill"""
+    pending = [r[0] for r in await bot.db_query("SELECT id FROM loans WHERE status = 'PENDING' ORDER BY random() LIMIT %s", (n,))]
+    active = await bot.db_query("SELECT id, user_id FROM loans WHERE status = 'APPROVED' ORDER BY random() LIMIT %s", (n,))
+    ops = [bot.approve_loan(lid) if rng.random() < 0.7 else bot.reject_loan(lid) for lid in pending]
+    ops += [bot.return_loan(lid, uid) for lid, uid in active]
+    rng.shuffle(ops)
+    for i in range(0, len(ops), 20):
+        await asyncio.gather(*ops[i:i + 20])
+    return len(ops)
+
+
+async def bench_stats(args):
+    """backfill دسته‌ای همزمان با عملیات امانت باید دقیقاً با شمارش مستقیم بخواند؛ و /stats هزینه ثابت دارد"""
+    rng = random.Random(args.seed)
+    await seed_books(args.books, rng)
+    await seed_loans(args.loans, rng)
+
+    # امانت‌های ساختگی همه امروز ثبت شده‌اند؛ تاریخ‌ها در یک سال پخش می‌شوند (پیش از backfill، پس بی‌اثر بر آمار)
+    await bot.db_query("""
+        UPDATE loans SET borrow_date = CURRENT_TIMESTAMP - mod(id, 365) * interval '1 day',
+                         decided_at = CASE WHEN status <> 'PENDING'
+                                           THEN CURRENT_TIMESTAMP - mod(id, 365) * interval '1 day' + mod(id, 72) * interval '1 hour' END,
+                         return_date = CASE WHEN status = 'RETURNED'
+                                            THEN CURRENT_TIMESTAMP - mod(id, 365) * interval '1 day' + interval '10 days' END
+        WHERE decided_at IS NULL AND status <> 'PENDING' OR borrow_date > CURRENT_TIMESTAMP - interval '1 hour'
+    """)
+    t = time.perf_counter()
+    backfill = asyncio.ensure_future(bot.backfill_stats(rebuild=True, batch=args.batch))
+    ops = await _circulate(rng, 150)
+    batches = await backfill
+    ops += await _circulate(rng, 150)
+    print(f"backfill: {batches} دسته در {(time.perf_counter() - t) * 1000:.0f}ms، همزمان با {ops} عملیات امانت")
+
+    await bot.flush_stats()
+    expected = [tuple(r) for r in await bot.db_query(LOAN_STATS_CHECK)]
+    actual = [tuple(r) for r in await bot.db_query("""
+        SELECT day, requested, approved, rejected, returned, decided FROM loan_stats_daily
+        WHERE requested <> 0 OR approved <> 0 OR rejected <> 0 OR returned <> 0 ORDER BY day
+    """)]
+    assert actual == expected, "loan_stats_daily با شمارش مستقیم نمی‌خواند"
+    counts = [len(actual)]
+    for table, key in (('loan_stats_book', 'book_id'), ('loan_stats_user', 'user_id')):
+        expected = await bot.db_query(f"""
+            SELECT {key}, count(*) FROM loans WHERE status IN ('APPROVED', 'RETURNED') GROUP BY {key} ORDER BY {key}
+        """)
+        actual = await bot.db_query(f"SELECT {key}, approved FROM {table} WHERE approved <> 0 ORDER BY {key}")
+        assert actual == expected, f"{table} با شمارش مستقیم نمی‌خواند"
+        counts.append(len(actual))
+    print("آمار {} روز، {} کتاب و {} کاربر با شمارش مستقیم یکی است".format(*counts))
+
+    samples = []
+    for _ in range(args.repeat):
+        t = time.perf_counter()
+        await bot.db_pool.run(bot._load_stats, bot.STATS_DAYS)
+        samples.append((time.perf_counter() - t) * 1000)
+    report("stats[rollups]", samples)
+    samples = []
+    for _ in range(min(args.repeat, 5)):
+        t = time.perf_counter()
+        await bot.db_query(LOAN_STATS_CHECK)
+        samples.append((time.perf_counter() - t) * 1000)
+    report("stats[direct scan]", samples)
+    print("OK")
+
+
+async def _export_peak(**kwargs):
+    """(اوج حافظه پایتون به بایت، تعداد ردیف، اندازه فایل) برای یک خروجی"""
+    tracemalloc.start()
+    try:
+        spool, rows, size = await bot.build_export(**kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    spool.close()
+    return peak, rows, size
+
+
+async def bench_export(args):
+    """اوج حافظه خروجی CSV باید به اندازه دسته وابسته باشد، نه به تعداد ردیف‌ها؛ در مقایسه با fetchall"""
+    rng = random.Random(args.seed)
+    await seed_books(args.books, rng)
+    await seed_loans(args.loans, rng)
+    total = (await bot.db_query("SELECT count(*) FROM loans"))[0][0]
+    today = datetime.date.today()
+    days = (await bot.db_query("SELECT count(DISTINCT borrow_date::date) FROM loans"))[0][0]
+    since = today - datetime.timedelta(days=max(days // 10, 1))
+
+    # فایل موقت کوچک تا فقط حافظه خود خواندن و نوشتن سنجیده شود (وگرنه تا EXPORT_SPOOL_BYTES در حافظه می‌ماند)
+    spool_bytes, bot.EXPORT_SPOOL_BYTES = bot.EXPORT_SPOOL_BYTES, 64 * 1024
+    try:
+        small = await _export_peak(kind='history', since=since)
+        t = time.perf_counter()
+        full = await _export_peak(kind='history')
+        elapsed = time.perf_counter() - t
+        raw = await _export_peak(kind='history', compress=False)
+    finally:
+        bot.EXPORT_SPOOL_BYTES = spool_bytes
+    for name, (peak, rows, size) in (('history[از ' + since.isoformat() + ']', small), ('history[همه]', full),
+                                     ('history[همه، csv]', raw)):
+        print(f"{name:<28} {rows:>8} ردیف  فایل={size / 2**20:7.2f}MB  اوج حافظه={peak / 2**20:6.2f}MB")
+    print(f"خروجی کامل: {elapsed:.2f}s ({full[1] / elapsed:.0f} ردیف در ثانیه)")
+
+    tracemalloc.start()
+    try:
+        rows = await bot.db_query(bot.EXPORTS['history'][1], {'since': None, 'until': None, 'status': None})
+        _, fetchall_peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del rows
+    print(f"{'history[fetchall]':<28} {total:>8} ردیف  اوج حافظه={fetchall_peak / 2**20:6.2f}MB")
+
+    assert full[1] == raw[1] == total, "تعداد ردیف خروجی با جدول نمی‌خواند"
+    assert full[0] < small[0] * 1.5 + 512 * 1024, "اوج حافظه با تعداد ردیف‌ها رشد می‌کند"
+    assert full[0] * 5 < fetchall_peak, "خروجی جریانی از fetchall کم‌حافظه‌تر نیست"
+
+    # محتوای فایل: سربرگ، تعداد ردیف‌ها و فیلتر وضعیت
+    spool, rows, _ = await bot.build_export('loans', status='RETURNED')
+    with gzip.GzipFile(fileobj=spool) as f:
+        reader = csv.reader(io.TextIOWrapper(f, encoding='utf-8-sig', newline=''))
+        header = next(reader)
+        statuses = Counter(row[3] for row in reader)
+    spool.close()
+    returned = (await bot.db_query("SELECT count(*) FROM loans WHERE status = 'RETURNED'"))[0][0]
+    assert header == bot.EXPORTS['loans'][0] and statuses == Counter({'RETURNED': returned}) and rows == returned
+    print("OK")
+
+
+def _brute_search(rows, text):
+    words = bot._TOKEN_RE.findall(bot.normalize_text(text))
+    return {r[0] for r in rows
+            if all(any(t.startswith(w) for t in bot.CatalogIndex.tokens(r)) for w in words)}
+
+
+async def _wait_until(check, timeout=5, message="تغییر به ایندکس inline نرسید"):
+    deadline = time.perf_counter() + timeout
+    while not check():
+        assert time.perf_counter() < deadline, message
+        await asyncio.sleep(0.05)
+
+
+async def bench_catalog(args):
+    """ایندکس inline: زمان ساخت و حافظه، تأخیر هر جستجو در برابر search_books، و رسیدن تغییرات با NOTIFY"""
+    rng = random.Random(args.seed)
+    await seed_books(args.books, rng)
+    rows = await bot.db_query(bot.CatalogIndex.query)
+
+    t = time.perf_counter()
+    built = bot.CatalogIndex.build(rows)
+    elapsed = time.perf_counter() - t
+    del built
+    gc.collect()
+    tracemalloc.start()
+    built = bot.CatalogIndex.build(rows)
+    gc.collect()
+    footprint, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # ردیف‌ها از قبل در حافظه بودند؛ حافظه آن‌ها جدا حساب می‌شود
+    keys, slots, books, slot_of = built
+    print(f"ساخت: {len(books)} کتاب، {len(keys)} کلمه ({len(set(keys))} یکتا) در {elapsed:.2f}s؛ "
+          f"ایندکس {footprint / 2**20:.1f}MB (slots {slots.itemsize * len(slots) / 2**20:.1f}MB)")
+    del built, keys, slots, books, slot_of
+
+    index = bot.CatalogIndex(0, bot.CATALOG_SCAN_LIMIT)
+    index._install(*bot.CatalogIndex.build(rows))
+    typed = []
+    for query in QUERIES:
+        query = bot.SEARCH_FILTER_RE.sub(" ", query)
+        typed += [query[:n] for n in range(1, len(query) + 1)]
+    samples = []
+    for _ in range(max(args.repeat // 10, 1)):
+        for text in typed:
+            t = time.perf_counter()
+            index.search(text, bot.INLINE_RESULTS + 1)
+            samples.append((time.perf_counter() - t) * 1000)
+    report("inline[index]", samples)
+    samples = []
+    for text in typed[::4]:
+        t = time.perf_counter()
+        await bot.search_books(text, bot.INLINE_RESULTS + 1)
+        samples.append((time.perf_counter() - t) * 1000)
+    report("inline[search_books]", samples)
+
+    # بدون سقف پیمایش، ایندکس باید دقیقاً همان کتاب‌های جستجوی کامل را بدهد
+    index.scan_limit = 10**9
+    for text in ["تار", "python da", "حافظ شع", "علی", "xyzq", "کتاب ایر"]:
+        assert {r[0] for r in index.search(text, 10**9)} == _brute_search(rows, text), text
+    del index
+
+    catalog = bot.catalog_index
+    await _wait_until(lambda: catalog.ready and not catalog._pending and not catalog._reload, timeout=60)
+    builds = catalog.builds
+    t = time.perf_counter()
+    bid = (await bot.db_query(
+        "INSERT INTO books (title, author, subject, count) VALUES ('zqxbench alpha', 'bench', 'bench', 2) RETURNING id"))[0][0]
+    await _wait_until(lambda: catalog.search("zqxb", 5))
+    print(f"کتاب تازه پس از {(time.perf_counter() - t) * 1000:.0f}ms در ایندکس بود")
+    await bot.db_query("UPDATE books SET title = 'zqxbench beta' WHERE id = %s", (bid,))
+    await _wait_until(lambda: catalog.search("beta zqx", 5))
+    assert not catalog.search("alpha zqx", 5)
+    await bot.db_query("UPDATE books SET count = 7 WHERE id = %s", (bid,))
+    await _wait_until(lambda: catalog.search("zqxbench", 5)[0][4] == 7)
+    await bot.db_query("DELETE FROM books WHERE id = %s", (bid,))
+    await _wait_until(lambda: not catalog.search("zqxbench", 5))
+    assert catalog.builds == builds, "تغییر تکی باید بدون ساخت دوباره اعمال شود"
+    print(f"به‌روزرسانی‌های تکی: {catalog.updates}")
+    print("OK")
+
+
+STATS_CHECK = """
+    SELECT subject, count(*), sum(count), sum(count - borrowed_count) FROM books
+    WHERE subject IS NOT NULL GROUP BY subject ORDER BY subject
+"""
+
+
+async def bench_subject_stats(args):
+    """subject_stats پس از عملیات همزمان باید با شمارش مستقیم یکی باشد؛ و مقایسه هزینه مرور موضوعی"""
+    rng = random.Random(args.seed)
+    await seed_books(args.books, rng)
+
+    samples = []
+    for _ in range(args.repeat):
+        t = time.perf_counter()
+        await bot.db_query("SELECT DISTINCT subject FROM books WHERE subject IS NOT NULL")
+        samples.append((time.perf_counter() - t) * 1000)
+    report("browse[SELECT DISTINCT]", samples)
+    samples = []
+    for _ in range(args.repeat):
+        t = time.perf_counter()
+        await bot.db_query(bot.subject_cache.query)
+        samples.append((time.perf_counter() - t) * 1000)
+    report("browse[subject_stats]", samples)
+    samples = []
+    for _ in range(args.repeat):
+        t = time.perf_counter()
+        await bot.subject_cache.get()
+        samples.append((time.perf_counter() - t) * 1000)
+    report("browse[cache]", samples)
+
+    # عملیات مخلوط همزمان: افزودن، امانت، بازگشت، تغییر موضوع و موجودی، حذف
+    ids = [r[0] for r in await bot.db_query("SELECT id FROM books ORDER BY random() LIMIT 200")]
+    ops = []
+    for i, bid in enumerate(ids):
+        ops.append(bot.request_loan(2 * 10**9 + i, bid))
+    await asyncio.gather(*ops)
+    lids = [r[0] for r in await bot.db_query("SELECT id FROM loans WHERE user_id >= %s AND status = 'PENDING'", (2 * 10**9,))]
+    invalidated = bot.db_listener.received
+    await asyncio.gather(
+        bot.apply_loan_batch(lids[:100]),
+        *[bot.approve_loan(lid) for lid in lids[100:]],
+        *[bot.set_book_count(bid, rng.randint(3, 8)) for bid in ids[:50]],
+        bot.db_query("UPDATE books SET subject = 'bench-moved' WHERE id = ANY(%s)", (ids[50:80],)),
+        bot.db_query("DELETE FROM books WHERE id = ANY(%s)", (ids[80:100],)),
+        bot.db_query("INSERT INTO books (title, author, subject, count) SELECT 'bench', 'bench', 'bench-new', 2 FROM generate_series(1, 10)"),
+    )
+    rows = await bot.db_query("SELECT id, user_id FROM loans WHERE user_id >= %s AND status = 'APPROVED'", (2 * 10**9,))
+    await asyncio.gather(*[bot.return_loan(lid, uid) for lid, uid in rows[::2]])
+    await asyncio.sleep(0.2)  # رسیدن اعلان‌ها
+
+    expected = [tuple(r) for r in await bot.db_query(STATS_CHECK)]
+    actual = [tuple(r) for r in await bot.subject_cache.get()]
+    print(f"اعلان‌های دریافت‌شده: {bot.db_listener.received - invalidated}  موضوع‌ها: {len(actual)}")
+    assert actual == expected, "subject_stats با شمارش مستقیم نمی‌خواند"
+
+    await bot.db_query("DELETE FROM loans WHERE user_id >= %s", (2 * 10**9,))
+    await bot.db_query("DELETE FROM books WHERE subject IN ('bench-moved', 'bench-new')")
+    print("OK")
+
+
+async def bench_book_cache(args):
+    """دسترسی با توزیع Zipf (چند عنوان پرطرفدار) با و بدون کش رکورد کتاب، و رسیدن ابطال از نمونه دیگر"""
+    rng = random.Random(args.seed)
+    await seed_books(args.books, rng)
+    ids = [r[0] for r in await bot.db_query("SELECT id FROM books ORDER BY id")]
+    weights = [1 / (rank + 1) for rank in range(len(ids))]
+    lookups = rng.choices(ids, weights, k=args.lookups)
+
+    samples = []
+    for bid in lookups[:args.repeat * 20]:
+        t = time.perf_counter()
+        await bot.db_query("SELECT id, title, author, subject, count, borrowed_count, version FROM books WHERE id = %s", (bid,))
+        samples.append((time.perf_counter() - t) * 1000)
+    report("book[db]", samples)
+
+    cache = bot.book_cache
+    samples = []
+    t0 = time.perf_counter()
+    for bid in lookups:
+        t = time.perf_counter()
+        await cache.get(bid)
+        samples.append((time.perf_counter() - t) * 1000)
+    elapsed = time.perf_counter() - t0
+    report("book[cache]", samples)
+    print(f"hit ratio={cache.hit_ratio():.1%} evictions={cache.evictions} size={len(cache._rows)} "
+          f"({args.lookups / elapsed:.0f} lookups/s)")
+
+    # ده درخواست همزمان یک کتاب سرد فقط یک کوئری می‌زنند
+    cold = ids[-1]
+    cache.invalidate(cold)
+    misses = cache.misses
+    rows = await asyncio.gather(*[cache.get(cold) for _ in range(10)])
+    assert len(set(rows)) == 1 and cache.misses - misses == 10 and cold not in cache._loading
+
+    # نوشتن از یک اتصال دیگر (مانند نمونه دوم ربات) باید با NOTIFY ورودی را باطل کند
+    hot = lookups[0]
+    before = await cache.get(hot)
+    await bot.db_query("UPDATE books SET count = count + 1 WHERE id = %s", (hot,))
+    await asyncio.sleep(0.2)
+    after = await cache.get(hot)
+    print(f"نسخه کتاب {hot}: {before[6]} -> {after[6]}  count: {before[4]} -> {after[4]}")
+    assert after[6] == before[6] + 1 and after[4] == before[4] + 1, "ابطال از طریق NOTIFY نرسید"
+    # اعلان قدیمی‌تر از ورودی کش‌شده نباید آن را بیرون بیندازد
+    cache.on_notify(f"{hot}:{before[6]}")
+    assert hot in cache._rows
+    await bot.db_query("UPDATE books SET count = count - 1 WHERE id = %s", (hot,))
+    print("OK")
+
+
+async def bench_metrics(args):
+    """هزینه هر مشاهده متریک (باید چند میکروثانیه یا کمتر باشد) و زمان ساخت خروجی /metrics"""
+    n = 200000
+    hist = bot.Histogram('bench_seconds', "bench", ('handler',))
+    labels = ('bench',)
+    t = time.perf_counter()
+    for i in range(n):
+        hist.observe(labels, (i % 1000) / 10000)
+    print(f"Histogram.observe: {(time.perf_counter() - t) / n * 1e6:.3f}µs")
+
+    query = "SELECT id, title FROM books WHERE id = %s AND subject = 'x'"
+    t = time.perf_counter()
+    for _ in range(n):
+        bot.query_fingerprint(query)
+    print(f"query_fingerprint (cached): {(time.perf_counter() - t) / n * 1e6:.3f}µs")
+
+    async def handler(update, context):
+        return None
+    wrapped = bot.instrument(handler)
+    t = time.perf_counter()
+    for _ in range(n):
+        await handler(None, None)
+    bare = time.perf_counter() - t
+    t = time.perf_counter()
+    for _ in range(n):
+        await wrapped(None, None)
+    overhead = (time.perf_counter() - t - bare) / n * 1e6
+    print(f"instrument() overhead per handler call: {overhead:.3f}µs")
+    bot.METRICS.remove(hist)
+
+    for _ in range(200):
+        await bot.db_query("SELECT 1")
+    t = time.perf_counter()
+    text = bot.render_metrics()
+    print(f"render_metrics: {(time.perf_counter() - t) * 1000:.2f}ms, {len(text.splitlines())} خط")
+    assert overhead < 5, "هزینه اندازه‌گیری هر handler بیش از ۵ میکروثانیه است"
+    print("OK")
+
+
+# --- بازپخش آفلاین آپدیت‌ها از مسیر کامل Application ---
+
+class OfflineRequest(BaseRequest):
+    """جایگزین HTTP برای Bot API: پاسخ ساختگی و شمارش فراخوانی‌ها؛ latency تأخیر شبیه‌سازی‌شده شبکه است"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self._message_id = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def read_timeout(self):
+        return 5
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        name = url.rsplit('/', 1)[-1]
+        self.calls[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = request_data.parameters if request_data else {}
+        if name == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': "bench", 'username': "bench_bot"}
+        elif name in ('sendMessage', 'editMessageText', 'sendDocument'):
+            self._message_id += 1
+            result = {'message_id': self._message_id, 'date': int(time.time()),
+                      'chat': {'id': params.get('chat_id', 1), 'type': 'private'}, 'text': ""}
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+class UpdateFactory:
+    _ids = itertools.count(1)  # update_id یکتا در کل اجرا؛ تکراری‌ها را محافظ دور می‌ریزد
+
+    def __init__(self, bot_instance):
+        self.bot = bot_instance
+        self.update_id = 0
+
+    def raw(self, uid, text):
+        self.update_id = next(self._ids)
+        user = {'id': uid, 'is_bot': False, 'first_name': f"u{uid}"}
+        return {'update_id': self.update_id, 'message': {
+            'message_id': self.update_id, 'date': int(time.time()), 'text': text,
+            'chat': {'id': uid, 'type': 'private'}, 'from': user,
+        }}
+
+    def text(self, uid, text):
+        return Update.de_json(self.raw(uid, text), self.bot)
+
+
+REPLAY_USER_BASE = 3 * 10**9
+REPLAY_ADMIN = REPLAY_USER_BASE - 1
+QUERIES = ["تاریخ ایران", "python", "كتاب", "شعر حافظ", "author:مریم", "موضوع:تاریخی جنگ", "پایتن", "data science"]
+
+
+def _flows(rng, hot, subjects):
+    """هر جریان دنباله متن‌هایی است که یک کاربر پشت سر هم می‌فرستد"""
+    return {
+        'search': lambda: ['🔍 جستجوی کتاب', rng.choice(QUERIES)],
+        'details': lambda: ['🔎 جزئیات کتاب', str(rng.choice(hot))],
+        'browse': lambda: ['🏷️ مرور موضوعی', rng.choice(subjects)],
+        'borrow': lambda: ['🤝 امانت کتاب', str(rng.choice(hot))],
+        'my_loans': lambda: ['📕 کتاب‌های من'],
+        'approve': _approve_flow,
+    }
+
+
+async def _approve_flow():
+    # کتابی که واقعاً درخواست منتظر دارد؛ وگرنه ادمین فهرست را می‌بیند و لغو می‌کند
+    res = await bot.db_query("SELECT book_id FROM loans WHERE status = 'PENDING' AND user_id >= %s LIMIT 1",
+                             (REPLAY_USER_BASE,))
+    if not res:
+        return ['📩 درخواست‌های امانت', 'لغو عملیات']
+    return ['📩 درخواست‌های امانت', f"book:{res[0][0]}", '✅ تأیید و رد مازاد']
+
+MIXES = {
+    'search-heavy': {'search': 60, 'details': 25, 'browse': 15},
+    'borrow-storm': {'borrow': 70, 'my_loans': 20, 'details': 10},
+    'approval-burst': {'borrow': 75, 'approve': 25},
+}
+
+
+async def _cleanup_replay():
+    await bot.db_query("""
+        WITH d AS (DELETE FROM loans WHERE user_id >= %(base)s RETURNING book_id, status)
+        UPDATE books SET borrowed_count = books.borrowed_count - c.n
+        FROM (SELECT book_id, count(*) AS n FROM d WHERE status = 'APPROVED' GROUP BY book_id) c
+        WHERE books.id = c.book_id
+    """, {'base': REPLAY_USER_BASE})
+    await bot.db_query("""
+        DELETE FROM bot_persistence
+        WHERE (kind = 'user' AND key::bigint >= %(admin)s)
+           OR (kind LIKE 'conv:%%' AND (key::jsonb ->> 0)::bigint >= %(admin)s)
+    """, {'admin': REPLAY_ADMIN})
+
+
+_ROWS_QUERY = """
+    SELECT COALESCE(sum(seq_tup_read + COALESCE(idx_tup_fetch, 0)), 0),
+           COALESCE(sum(n_tup_ins + n_tup_upd + n_tup_del), 0)
+    FROM pg_stat_user_tables
+"""
+
+
+async def _work_counters(request):
+    """شمارش‌های مستقل از ماشین تا این لحظه: فراخوانی Bot API، رفت‌وبرگشت دیتابیس و ردیف‌ها"""
+    await _wait_until(lambda: bot.notifier.depth() == 0, 120, "صف ارسال خالی نشد")
+    # هر backend آمار جدول‌ها را پس از حدود یک ثانیه بیکاری در pg_stat می‌نویسد
+    await asyncio.sleep(1.5)
+    db_calls = sum(sum(series[:-1]) for series in bot.db_query_seconds._series.values())
+    read, written = (await bot.db_query(_ROWS_QUERY))[0]
+    return {'api_calls': sum(request.calls.values()), 'db_calls': db_calls,
+            'rows_read': int(read), 'rows_written': int(written)}
+
+
+async def replay_mix(app, request, mix, args, rng, hot, subjects):
+    """اجرای یک ترکیب؛ (آپدیت در ثانیه، نمونه‌های هر handler بر حسب ms، شمارش‌های هر آپدیت)"""
+    samples = defaultdict(list)
+    observe = bot.handler_seconds.observe
+    # همان نقطه‌ای که /metrics از آن تغذیه می‌شود، اینجا نمونه‌های خام را هم نگه می‌دارد
+    bot.handler_seconds.observe = lambda labels, value: (samples[labels[0]].append(value * 1000), observe(labels, value))
+
+    factory = UpdateFactory(app.bot)
+    flows = _flows(rng, hot, subjects)
+    names, weights = zip(*MIXES[mix].items())
+    # هر کاربر در هر لحظه فقط یک جریان دارد، مانند یک کاربر واقعی
+    free_users = asyncio.Queue()
+    for uid in range(REPLAY_USER_BASE, REPLAY_USER_BASE + args.concurrency * 4):
+        free_users.put_nowait(uid)
+    sent = 0
+    sem = asyncio.Semaphore(args.concurrency)
+
+    async def run_flow(name):
+        nonlocal sent
+        async with sem:
+            uid = REPLAY_ADMIN if name == 'approve' else await free_users.get()
+            try:
+                texts = flows[name]()
+                if asyncio.iscoroutine(texts):
+                    texts = await texts
+                for text in texts:
+                    await app.process_update(factory.text(uid, text))
+                    sent += 1
+            finally:
+                if uid != REPLAY_ADMIN:
+                    free_users.put_nowait(uid)
+
+    admin_lock = asyncio.Lock()
+
+    async def run_any(name):
+        if name == 'approve':
+            async with admin_lock:  # ادمین هم مکالمه‌هایش را پشت سر هم انجام می‌دهد
+                await run_flow(name)
+        else:
+            await run_flow(name)
+
+    planned = []
+    per_flow = {name: 3 if name == 'approve' else len(flows[name]()) for name in names}
+    total = 0
+    while total < args.updates:
+        name = rng.choices(names, weights)[0]
+        planned.append(name)
+        total += per_flow[name]
+
+    before = await _work_counters(request)
+    t = time.perf_counter()
+    await asyncio.gather(*[run_any(name) for name in planned])
+    elapsed = time.perf_counter() - t
+    bot.handler_seconds.observe = observe
+    after = await _work_counters(request)
+    return sent / elapsed, samples, {k: (after[k] - before[k]) / sent for k in after}
+
+
+async def bench_replay(args):
+    """بازپخش ترکیب‌های واقعی آپدیت از گراف کامل handlerهای main() با Bot API ساختگی"""
+    rng = random.Random(args.seed)
+    await seed_books(args.books, rng)
+    await _cleanup_replay()
+    hot = [r[0] for r in await bot.db_query("SELECT id FROM books ORDER BY id LIMIT 20")]
+    subjects = [r[0] for r in await bot.db_query("SELECT subject FROM subject_stats")]
+    await bot.db_query("INSERT INTO admins (user_id) VALUES (%s) ON CONFLICT DO NOTHING", (REPLAY_ADMIN,))
+    bot.admin_cache.invalidate()
+
+    request = OfflineRequest(args.api_latency / 1000)
+    app = bot.build_application(request)
+    await app.initialize()
+    bot.notifier.start(app.bot)
+    # ساخت اولیه ایندکس inline هزینه یک‌باره راه‌اندازی است، نه بخشی از بار پایدار
+    await _wait_until(lambda: bot.catalog_index.ready and not bot.catalog_index._reload, timeout=120)
+    results = {}
+    try:
+        for mix in (MIXES if args.mix == 'all' else [args.mix]):
+            # ردیف‌های مرده اجرای قبلی و آمار کهنه planner را عوض می‌کنند و ردیف‌های خوانده‌شده را با آن
+            _vacuum("loans, waitlist, books")
+            rate, samples, per_update = await replay_mix(app, request, mix, args, rng, hot, subjects)
+            print(f"== {mix}: {rate:.0f} آپدیت در ثانیه (همزمانی {args.concurrency})")
+            for handler, values in sorted(samples.items()):
+                report(f"  {handler}", values)
+            print("  هر آپدیت: " + "  ".join(f"{k}={v:.2f}" for k, v in sorted(per_update.items())))
+            results[mix] = per_update
+            await _cleanup_replay()
+        print(f"فراخوانی‌های Bot API: {dict(request.calls)}")
+    finally:
+        await bot.notifier.stop()
+        await app.shutdown()
+        await bot.db_query("DELETE FROM admins WHERE user_id = %s", (REPLAY_ADMIN,))
+        await _cleanup_replay()
+        bot.admin_cache.invalidate()
+
+    # شمارش‌ها به اندازه کاتالوگ، بذر و همزمانی وابسته‌اند، نه به ماشین
+    params = {'books': args.books, 'seed': args.seed, 'updates': args.updates, 'concurrency': args.concurrency}
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({'params': params, 'per_update': results}, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"خط پایه در {args.baseline} ذخیره شد.")
+        return
+    if not os.path.exists(args.baseline):
+        print(f"خط پایه {args.baseline} وجود ندارد؛ مقایسه انجام نشد.")
+        return
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    if baseline.get('params') != params:
+        print(f"خط پایه با پارامترهای {baseline.get('params')} ثبت شده است؛ مقایسه انجام نشد.")
+        return
+    regressions = []
+    for mix, res in results.items():
+        base = baseline['per_update'].get(mix)
+        if not base:
+            continue
+        for name, value in sorted(res.items()):
+            # اندکی جابه‌جایی از ترتیب همزمانی (مثلا برخورد دو امانت روی نسخه آخر) پسرفت نیست
+            limit = base.get(name, value) * (1 + args.tolerance) + 0.05
+            if value > limit:
+                regressions.append(f"{mix}[{name}]: {value:.2f} > {limit:.2f} در هر آپدیت")
+    if regressions:
+        print("پسرفت نسبت به خط پایه:\n  " + "\n  ".join(regressions))
+        sys.exit(1)
+    print("بدون پسرفت نسبت به خط پایه.")
+
+
+def _dropped():
+    return Counter({labels[0]: int(n) for labels, n in bot.updates_dropped._values.items()})
+
+
+async def bench_guard(args):
+    """سیل پیام یک کاربر کنار کاربران عادی با و بدون محافظ، آپدیت تکراری و کاهش بار با اولویت ادمین"""
+    rng = random.Random(args.seed)
+    await seed_books(args.books, rng)
+    await _cleanup_replay()
+    await bot.db_query("INSERT INTO admins (user_id) VALUES (%s) ON CONFLICT DO NOTHING", (REPLAY_ADMIN,))
+    await bot.admin_cache.get(refresh=True)
+
+    # بدون تأخیر شبکه هیچ دو handlerی همپوشانی ندارند و بار هرگز بالا نمی‌رود
+    request = OfflineRequest((args.api_latency or 20) / 1000)
+    app = bot.build_application(request)
+    await app.initialize()
+    bot.notifier.start(app.bot)
+    await _wait_until(lambda: bot.catalog_index.ready and not bot.catalog_index._reload, timeout=120)
+    guard = bot.update_guard
+    factory = UpdateFactory(app.bot)
+    spammer, users = REPLAY_USER_BASE, range(REPLAY_USER_BASE + 1, REPLAY_USER_BASE + 21)
+    observe = bot.handler_seconds.observe
+    try:
+        # یک کاربر args.requests متن ناشناخته (هر کدام start و یک پاسخ) همزمان با کاربران عادی
+        for label, enabled in (("بدون محافظ", False), ("با محافظ", True)):
+            guard.rate = (bot.GUARD_USER_RATE or 1) if enabled else 0
+            guard.max_in_flight = bot.GUARD_MAX_IN_FLIGHT if enabled else float('inf')
+            guard._buckets, guard._noticed = OrderedDict(), OrderedDict()
+            samples = []
+            dropped, calls = _dropped(), request.calls['sendMessage']
+
+            async def normal(uid):
+                for _ in range(3):
+                    t = time.perf_counter()
+                    await app.process_update(factory.text(uid, "سلام"))
+                    samples.append((time.perf_counter() - t) * 1000)
+                    await asyncio.sleep(0.2)
+
+            await asyncio.gather(*[app.process_update(factory.text(spammer, "سلام")) for _ in range(args.requests)],
+                                 *[normal(uid) for uid in users])
+            await _wait_until(lambda: not bot.notifier.depth(), message="صف ارسال خالی نشد")
+            drops = _dropped() - dropped
+            print(f"== {label}: محدودشده={drops['throttled']} ردشده={drops['shed']} "
+                  f"sendMessage={request.calls['sendMessage'] - calls}")
+            report(f"  کاربر عادی[{label}]", samples)
+        assert drops['throttled'] == args.requests - guard.burst, "کاربر پرتکرار باید پس از burst محدود شود"
+
+        # ارسال دوباره همان آپدیت
+        update = factory.text(users[0], "سلام")
+        dropped = _dropped()
+        await app.process_update(update)
+        await app.process_update(update)
+        assert (_dropped() - dropped)['duplicate'] == 1
+        print("آپدیت تکراری: یک بار پردازش شد")
+
+        # بار زیاد: با آستانه پایین آپدیت کاربران عادی رد می‌شود و ادمین همچنان پاسخ می‌گیرد
+        guard.max_in_flight = 5
+        guard.rate, guard._noticed = 0, OrderedDict()
+        dropped = _dropped()
+        handled = Counter()
+        bot.handler_seconds.observe = lambda labels, value: (handled.update([labels[0]]), observe(labels, value))
+        try:
+            await asyncio.gather(*[app.process_update(factory.text(REPLAY_USER_BASE + 100 + i, "سلام")) for i in range(100)],
+                                 *[app.process_update(factory.text(REPLAY_ADMIN, "سلام")) for _ in range(10)])
+        finally:
+            bot.handler_seconds.observe = observe
+        drops = _dropped() - dropped
+        print(f"کاهش بار: {drops['shed']} آپدیت رد شد، {handled['start']} پردازش شد (شامل ۱۰ آپدیت ادمین)")
+        assert drops['shed'] > 0 and handled['start'] == 110 - drops['shed'] and drops['shed'] <= 100
+        guard.max_in_flight = 0
+        try:
+            assert guard.classify(factory.text(REPLAY_ADMIN, "سلام")) is None, "آپدیت ادمین در بار زیاد رد شد"
+            assert guard.classify(factory.text(users[0], "سلام")) == 'shed'
+        finally:
+            guard.max_in_flight = bot.GUARD_MAX_IN_FLIGHT
+        print(f"شمارنده‌ها: {dict(_dropped())}")
+    finally:
+        guard.rate, guard.max_in_flight = bot.GUARD_USER_RATE, bot.GUARD_MAX_IN_FLIGHT
+        await bot.notifier.stop()
+        await app.shutdown()
+        await bot.db_query("DELETE FROM admins WHERE user_id = %s", (REPLAY_ADMIN,))
+        await _cleanup_replay()
+        bot.admin_cache.invalidate()
+    print("OK")
+
+
+def _hanging_request():
+    """worker که هرگز آماده نمی‌شود (مانند post_init منتظر دیتابیس یا قفل مهاجرت)"""
+    time.sleep(3600)
+
+
+async def _start_supervisor(n, warmup):
+    sup = bot.Supervisor(n, bot.WORKER_MAX_INFLIGHT, OfflineRequest)
+    await sup.start()
+    await _wait_until(sup.healthy, 120, "workerها آماده نشدند")
+    await asyncio.sleep(warmup)  # ساخت ایندکس inline هر worker پس از آماده شدن
+    return sup
+
+
+async def _drive(sup, updates):
+    t = time.perf_counter()
+    for data in updates:
+        await sup.dispatch(data)
+    await _wait_until(lambda: sum(w.processed for w in sup.workers) >= sup.dispatched, 600, "آپدیت‌ها تمام نشدند")
+    return len(updates) / (time.perf_counter() - t)
+
+
+async def bench_workers(args):
+    """گذردهی ingress با N worker، حفظ ترتیب پیام‌های هر کاربر، اجرای دوباره worker از کار افتاده و تخلیه"""
+    rng = random.Random(args.seed)
+    await seed_books(args.books, rng)
+    await _cleanup_replay()
+    books = [r[0] for r in await bot.db_query("SELECT id FROM books ORDER BY id LIMIT 20")]
+    subjects = [r[0] for r in await bot.db_query("SELECT subject FROM subject_stats")]
+    # موجودی زیاد تا هر درخواست امانت فقط به ترتیب پیام‌ها وابسته باشد
+    counts = await bot.db_query("SELECT id, count FROM books WHERE id = ANY(%s)", (books,))
+    await bot.db_query("UPDATE books SET count = count + 100000 WHERE id = ANY(%s)", (books,))
+
+    factory = UpdateFactory(None)
+    users = [REPLAY_USER_BASE + i for i in range(args.concurrency * 4)]
+    flows = {'details': lambda: ['🔎 جزئیات کتاب', str(rng.choice(books))],
+             'browse': lambda: ['🏷️ مرور موضوعی', rng.choice(subjects)],
+             'borrow': lambda: ['🤝 امانت کتاب', str(rng.choice(books))]}
+    names, weights = zip(*{'details': 45, 'browse': 45, 'borrow': 10}.items())
+
+    def workload(total):
+        """جریان‌های هر کاربر پشت سر هم، کاربران در هم؛ (آپدیت‌ها، جفت‌های یکتای کاربر و کتاب امانتی)"""
+        queues = {uid: [] for uid in users}
+        borrowed = set()
+        n = 0
+        while n < total:
+            uid = rng.choice(users)
+            texts = flows[rng.choices(names, weights)[0]]()
+            if texts[0] == '🤝 امانت کتاب':
+                borrowed.add((uid, int(texts[1])))
+            queues[uid] += texts
+            n += len(texts)
+        updates = []
+        while any(queues.values()):
+            for uid in users:
+                if queues[uid]:
+                    updates.append(factory.raw(uid, queues[uid].pop(0)))
+        return updates, borrowed
+
+    try:
+        rates = {}
+        for n in [int(x) for x in args.workers.split(',')]:
+            updates, borrowed = workload(args.updates)
+            sup = await _start_supervisor(n, args.warmup)
+            try:
+                rates[n] = await _drive(sup, updates)
+            finally:
+                await sup.stop(bot.WORKER_DRAIN_TIMEOUT)
+            loans = (await bot.db_query("SELECT count(*) FROM loans WHERE user_id >= %s", (REPLAY_USER_BASE,)))[0][0]
+            per_worker = [w.processed for w in sup.workers]
+            print(f"workers={n}: {rates[n]:.0f} آپدیت در ثانیه ({rates[n] / rates[min(rates)]:.2f}x)  "
+                  f"هر worker: {per_worker}  امانت: {loans}/{len(borrowed)}")
+            # هر «امانت کتاب» و شماره‌اش به همان ترتیب به یک worker رسیده‌اند، وگرنه درخواستی ثبت نمی‌شد
+            assert loans == len(borrowed) and sup.lost == 0, "ترتیب پیام‌های کاربر حفظ نشد یا آپدیتی گم شد"
+            await _cleanup_replay()
+
+        n = max(rates)
+        sup = await _start_supervisor(n, 0)
+        try:
+            victim = sup.workers[0]
+            victim.process.kill()
+            await _wait_until(lambda: victim.restarts == 1 and sup.healthy(), 120, "worker دوباره اجرا نشد")
+            print(f"worker 0 پس از kill دوباره اجرا شد (pid {victim.process.pid})")
+            # SIGTERM به کل گروه (مانند systemd) worker را بدون تخلیه نمی‌کشد
+            os.kill(victim.process.pid, signal.SIGTERM)
+            await asyncio.sleep(1)
+            assert victim.process.is_alive() and victim.restarts == 1, "worker با SIGTERM متوقف شد"
+            # تخلیه: آپدیت‌های تحویل‌شده پیش از توقف همه انجام می‌شوند
+            updates, _ = workload(min(args.updates, 500))
+            for data in updates:
+                await sup.dispatch(data)
+        finally:
+            await sup.stop(bot.WORKER_DRAIN_TIMEOUT)
+        done = sum(w.processed for w in sup.workers)
+        print(f"تخلیه: {done}/{sup.dispatched} آپدیت پیش از خاموشی انجام شد، گم‌شده: {sup.lost}")
+        assert done == sup.dispatched and sup.lost == 0
+
+        # متریک‌های handler و دیتابیس workerها از /metrics همان ingress خوانده می‌شوند
+        sup = await _start_supervisor(n, 0)
+        try:
+            for data in workload(50)[0]:
+                await sup.dispatch(data)
+            text = ""
+            for _ in range(int(bot.WORKER_METRICS_INTERVAL + bot.WORKER_HEARTBEAT_INTERVAL) * 4):
+                text = bot.render_metrics(sup.metrics())
+                if all(f'library_handler_seconds_count{{worker="{w.index}",' in text for w in sup.workers):
+                    break
+                await asyncio.sleep(0.5)
+            else:
+                raise AssertionError("متریک‌های handler همه workerها در /metrics نیامد")
+            served = sum(float(line.rsplit(' ', 1)[1]) for line in text.splitlines()
+                         if line.startswith('library_handler_seconds_count{worker='))
+            print(f"/metrics: {served:.0f} اجرای handler از {n} worker، "
+                  f"{text.count('library_db_query_seconds_count{worker=')} سری کوئری")
+        finally:
+            await sup.stop(bot.WORKER_DRAIN_TIMEOUT)
+
+        # worker متوقف (SIGSTOP) که pipe آپدیت‌هایش پر شده event loop ingress و worker دیگر را نگه نمی‌دارد
+        sup = await _start_supervisor(2, 0)
+        try:
+            stalled = sup.workers[0]
+            os.kill(stalled.process.pid, signal.SIGSTOP)
+            padding = "x" * 4000
+            t = time.perf_counter()
+            for i in range(min(bot.WORKER_MAX_INFLIGHT, 100)):  # حدود ۴۰۰KB، چند برابر بافر pipe
+                await sup.dispatch(factory.raw(REPLAY_USER_BASE + 2 * (i % 10), padding))
+            queued = time.perf_counter() - t
+            before = sup.workers[1].processed
+            for i in range(20):
+                await sup.dispatch(factory.raw(REPLAY_USER_BASE + 2 * i + 1, "/start"))
+            await _wait_until(lambda: sup.workers[1].processed >= before + 20, 30, "worker دیگر پشت pipe پر ماند")
+            os.kill(stalled.process.pid, signal.SIGCONT)
+            await _wait_until(lambda: sum(w.processed for w in sup.workers) >= sup.dispatched, 120, "آپدیت‌ها تمام نشدند")
+            print(f"pipe پر: 100 آپدیت بزرگ در {queued * 1000:.0f}ms صف شد و worker دیگر ادامه داد")
+        finally:
+            os.kill(stalled.process.pid, signal.SIGCONT)
+            await sup.stop(bot.WORKER_DRAIN_TIMEOUT)
+
+        # worker که در راه‌اندازی گیر کرده پس از WORKER_START_TIMEOUT کشته و دوباره اجرا می‌شود
+        start_timeout, bot.WORKER_START_TIMEOUT = bot.WORKER_START_TIMEOUT, 3
+        sup = bot.Supervisor(1, bot.WORKER_MAX_INFLIGHT, _hanging_request)
+        try:
+            await sup.start()
+            await _wait_until(lambda: sup.workers[0].restarts >= 1, 30, "worker گیرکرده کشته نشد")
+            print(f"worker گیرکرده در راه‌اندازی پس از {bot.WORKER_START_TIMEOUT:.0f} ثانیه دوباره اجرا شد")
+        finally:
+            bot.WORKER_START_TIMEOUT = start_timeout
+            await sup.stop(1)
+        print(f"هسته‌های CPU: {os.cpu_count()}")
+        print("OK")
+    finally:
+        await _cleanup_replay()
+        for bid, count in counts:
+            await bot.db_query("UPDATE books SET count = %s WHERE id = %s", (count, bid))
+
+
+def _as_user(user_id):
+    """اجرای ادامه کار در زمینه آپدیتی از کاربر user_id (مانند handler)"""
+    update = types.SimpleNamespace(update_id=None, effective_user=types.SimpleNamespace(id=user_id))
+    return bot._trace.set(bot.Trace("bench", update))
+
+
+async def _on_replica():
+    res = await bot.db_read("SELECT pg_is_in_recovery()")
+    return res[0][0]
+
+
+async def bench_replica(args):
+    """مسیریابی خواندن‌ها به replica: سهم replica، خواندن نوشته خود، و برگشت به primary هنگام تأخیر یا قطعی"""
+    dsn = os.environ.get('BENCH_REPLICA_URL')
+    if not dsn:
+        sys.exit("BENCH_REPLICA_URL را روی replica همان دیتابیس آزمایشی تنظیم کنید.")
+    rng = random.Random(args.seed)
+    await seed_books(args.books, rng)
+    router = bot.replica
+    if router.pool is None:
+        await router.open(dsn)
+    assert router.healthy, f"replica سالم نیست (تأخیر {router.lag})"
+    assert await _on_replica(), "خواندن به replica نرسید"
+
+    words = [rng.choice(WORDS) for _ in range(args.repeat)]
+    for name, fresh in (("search[primary]", True), ("search[replica]", False)):
+        samples = []
+        for w in words:
+            t = time.perf_counter()
+            await bot.db_read("SELECT id, title FROM books WHERE title ILIKE %s ORDER BY id LIMIT 10",
+                              (f"%{w}%",), fresh=fresh)
+            samples.append((time.perf_counter() - t) * 1000)
+        report(name, samples)
+
+    bid = (await bot.db_query("SELECT min(id) FROM books"))[0][0]
+    token = _as_user(1001)
+    try:
+        await bot.db_write("UPDATE books SET count = count WHERE id = %s", (bid,))
+        assert not await _on_replica(), "کاربری که نوشته باید از primary بخواند"
+    finally:
+        bot._trace.reset(token)
+    token = _as_user(1002)
+    try:
+        assert await _on_replica(), "کاربر دیگر باید همچنان از replica بخواند"
+    finally:
+        bot._trace.reset(token)
+    print(f"خواندن نوشته خود: {bot.DB_STICKY_SECONDS:.0f}s از primary پس از نوشتن")
+
+    conn = await asyncio.get_running_loop().run_in_executor(None, bot.psycopg2.connect, dsn)
+    conn.autocommit = True
+    control = lambda sql: conn.cursor().execute(sql)
+    max_lag = router.max_lag
+    try:
+        # replay متوقف: تا وقتی تأخیر از حد کمتر است BookCache با نسخه ابطال، ردیف کهنه را از replica نمی‌پذیرد
+        router.max_lag = 3600
+        cache = bot.book_cache
+        before = await cache.get(bid)
+        control("SELECT pg_wal_replay_pause()")
+        await bot.db_write("UPDATE books SET count = count + 1 WHERE id = %s", (bid,))
+        await _wait_until(lambda: bid not in cache._rows, message="ابطال از طریق NOTIFY نرسید")
+        await router.check()
+        assert router.healthy
+        stale = (await bot.db_read("SELECT count FROM books WHERE id = %s", (bid,)))[0][0]
+        after = await cache.get(bid)
+        print(f"replay متوقف: replica count={stale}، کش count={after[4]} (نسخه {before[6]} -> {after[6]})")
+        assert stale == before[4] and after[4] == before[4] + 1 and after[6] > before[6]
+
+        # با حد تأخیر کوچک، replica متوقف ناسالم می‌شود و همه خواندن‌ها به primary می‌روند
+        router.max_lag = 1
+        await asyncio.sleep(1.5)
+        await bot.db_write("UPDATE books SET count = count - 1 WHERE id = %s", (bid,))
+        await router.check()
+        print(f"تأخیر اندازه‌گیری‌شده: {router.lag:.1f}s healthy={router.healthy}")
+        assert not router.healthy and not await _on_replica()
+        control("SELECT pg_wal_replay_resume()")
+        await _wait_until(lambda: router.healthy, timeout=3 * bot.DB_REPLICA_CHECK_INTERVAL + 2,
+                          message="replica پس از ادامه replay سالم نشد")
+        assert await _on_replica()
+        print(f"ادامه replay: replica دوباره سالم (تأخیر {router.lag:.1f}s)")
+
+        # قطع همه اتصال‌های ربات به replica: همان خواندن از primary جواب می‌گیرد
+        control("SELECT pg_terminate_backend(pid) FROM pg_stat_activity "
+                "WHERE datname = current_database() AND pid <> pg_backend_pid() AND backend_type = 'client backend'")
+        res = await bot.db_read("SELECT pg_is_in_recovery()")
+        assert res is not None and res[0][0] is False and not router.healthy
+        await _wait_until(lambda: router.healthy, timeout=3 * bot.DB_REPLICA_CHECK_INTERVAL + 2,
+                          message="replica پس از قطع اتصال‌ها برنگشت")
+        assert await _on_replica()
+        print("قطع اتصال replica: خواندن از primary انجام شد و replica در بررسی بعدی برگشت")
+        print(f"خواندن‌ها: {dict(bot.db_reads._values)}")
+    finally:
+        router.max_lag = max_lag
+        control("SELECT pg_wal_replay_resume()")
+        conn.close()
+    print("OK")
+
+
+BENCHES = {
+    'search': bench_search,
+    'approve-race': bench_approve_race,
+    'waitlist': bench_waitlist,
+    'persistence': bench_persistence,
+    'explain': bench_explain,
+    'subject-stats': bench_subject_stats,
+    'book-cache': bench_book_cache,
+    'reminders': bench_reminders,
+    'stats': bench_stats,
+    'export': bench_export,
+    'archive': bench_archive,
+    'catalog': bench_catalog,
+    'metrics': bench_metrics,
+    'replay': bench_replay,
+    'workers': bench_workers,
+    'guard': bench_guard,
+    'replica': bench_replica,
+}
+
+
+async def run(args):
+    await bot.on_startup(None)
+    try:
+        await BENCHES[args.bench](args)
+    finally:
+        await bot.on_shutdown(None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('bench', choices=sorted(BENCHES))
+    parser.add_argument('--books', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--stock', type=int, default=5)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--loans', type=int, default=300000)
+    parser.add_argument('--lookups', type=int, default=20000)
+    parser.add_argument('--batch', type=int, default=5000, help="اندازه دسته backfill آمار")
+    parser.add_argument('--mix', choices=['all', *MIXES], default='all')
+    parser.add_argument('--updates', type=int, default=3000, help="تعداد تقریبی آپدیت هر ترکیب")
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--workers', default='1,2,4', help="تعداد workerهای هر اجرا، جداشده با ویرگول")
+    parser.add_argument('--warmup', type=float, default=5, help="ثانیه صبر پس از آماده شدن workerها")
+    parser.add_argument('--api-latency', type=float, default=0, help="تأخیر شبیه‌سازی‌شده هر فراخوانی Bot API (ms)")
+    parser.add_argument('--baseline', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json'))
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.2, help="افزایش مجاز شمارش‌های هر آپدیت نسبت به خط پایه")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
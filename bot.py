@@ -1,42 +1,137 @@
 import os
+import re
+import io
+import csv
+import tempfile
+import time
+import asyncio
 import psycopg2
+import psycopg2.pool
+import psycopg2.extras
+import psycopg2.errors
+import secrets
+import warnings
 import logging
-from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, ForceReply
+import bisect
+import functools
+import random
+import threading
+import queue
+import contextvars
+import datetime
+import gzip
+import zoneinfo
+from array import array
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+from telegram import (
+    Bot, Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, ForceReply, InlineKeyboardButton, InlineKeyboardMarkup,
+    InlineQueryResultArticle, InputTextMessageContent,
+)
 from telegram.ext import (
     Application,
     CommandHandler,
     MessageHandler,
+    CallbackQueryHandler,
+    InlineQueryHandler,
     filters,
     ContextTypes,
     ConversationHandler,
+    TypeHandler,
+    ApplicationHandlerStop,
+    BasePersistence,
+    PersistenceInput,
 )
-from collections import defaultdict
+from telegram.error import TelegramError, RetryAfter, NetworkError
+from telegram.request import HTTPXRequest
+from telegram.warnings import PTBUserWarning, PTBDeprecationWarning
+from collections import defaultdict, OrderedDict, deque
 from itertools import chain
-from flask import Flask
-from threading import Thread
-
-# --- وب‌سرور برای زنده نگه داشتن ربات در Render ---
-app = Flask('')
-
-@app.route('/')
-def home():
-    return "I am alive! Bot is running..."
-
-def run_http():
-    # Render پورت را در متغیر محیطی PORT قرار می‌دهد
-    port = int(os.environ.get("PORT", 8080))
-    app.run(host='0.0.0.0', port=port)
-
-def keep_alive():
-    t = Thread(target=run_http)
-    t.start()
-# ---------------------------------------------------
+import hmac
+import json
+import signal
+import multiprocessing
+import tornado.web
+from tornado.httpserver import HTTPServer
 
 # --- توکن و تنظیمات ---
 # مقادیر را از متغیرهای محیطی Render می‌خوانیم
 TOKEN = os.environ.get('TOKEN')
 DATABASE_URL = os.environ.get('DATABASE_URL')
 
+# حالت دریافت آپدیت: webhook (پیش‌فرض وقتی WEBHOOK_URL تنظیم شده) یا polling برای توسعه محلی
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')  # آدرس عمومی سرویس، مثلا https://my-bot.onrender.com
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/telegram')
+# در حالت webhook الزامی است و بین همه نمونه‌ها یکی است؛ درخواست بدون هدر درست (مثلا آپدیت جعلی
+# با شناسه ادمین) پذیرفته نمی‌شود
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+BOT_MODE = os.environ.get('BOT_MODE', 'webhook' if WEBHOOK_URL else 'polling')
+# Render پورت را در متغیر محیطی PORT قرار می‌دهد
+PORT = int(os.environ.get('PORT', 8080))
+
+# تنظیمات استخر اتصال دیتابیس
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))  # ثانیه انتظار برای گرفتن اتصال
+DB_HEALTHCHECK_INTERVAL = float(os.environ.get('DB_HEALTHCHECK_INTERVAL', 30))  # ثانیه بیکاری پیش از بررسی سلامت اتصال
+DATABASE_REPLICA_URL = os.environ.get('DATABASE_REPLICA_URL')  # اختیاری: replica فقط‌خواندنی برای خواندن‌های غیرحساس
+DB_REPLICA_POOL_MAX = int(os.environ.get('DB_REPLICA_POOL_MAX', DB_POOL_MAX))
+DB_REPLICA_MAX_LAG = float(os.environ.get('DB_REPLICA_MAX_LAG', 5))  # ثانیه؛ با تأخیر بیشتر خواندن‌ها به primary برمی‌گردند
+DB_REPLICA_CHECK_INTERVAL = float(os.environ.get('DB_REPLICA_CHECK_INTERVAL', 2))  # ثانیه بین اندازه‌گیری‌های تأخیر replica
+DB_STICKY_SECONDS = float(os.environ.get('DB_STICKY_SECONDS', 5))  # پس از نوشتن کاربر، خواندن‌هایش تا این مدت از primary
+ADMIN_CACHE_TTL = float(os.environ.get('ADMIN_CACHE_TTL', 300))  # ثانیه اعتبار کش لیست ادمین‌ها
+BOOK_CACHE_SIZE = int(os.environ.get('BOOK_CACHE_SIZE', 2000))  # بیشینه تعداد رکورد کتاب در کش
+SUBJECT_CACHE_TTL = float(os.environ.get('SUBJECT_CACHE_TTL', 3600))  # ثانیه؛ در حالت عادی NOTIFY کش را باطل می‌کند
+LISTEN_RETRY_INTERVAL = float(os.environ.get('LISTEN_RETRY_INTERVAL', 5))  # ثانیه بین تلاش‌های اتصال دوباره LISTEN
+PAGE_SIZE = int(os.environ.get('PAGE_SIZE', 10))  # تعداد ردیف در هر صفحه از فهرست‌ها
+IMPORT_CHUNK_ROWS = int(os.environ.get('IMPORT_CHUNK_ROWS', 5000))  # ردیف‌های هر دسته COPY در ورود گروهی
+
+# تنظیمات صف ارسال پیام (محدودیت تلگرام: حدود ۳۰ پیام در ثانیه در کل و ۱ پیام در ثانیه برای هر چت)
+NOTIFY_WORKERS = int(os.environ.get('NOTIFY_WORKERS', 4))
+NOTIFY_QUEUE_SIZE = int(os.environ.get('NOTIFY_QUEUE_SIZE', 10000))
+NOTIFY_GLOBAL_RATE = float(os.environ.get('NOTIFY_GLOBAL_RATE', 25))
+NOTIFY_CHAT_RATE = float(os.environ.get('NOTIFY_CHAT_RATE', 1))
+NOTIFY_MAX_RETRIES = int(os.environ.get('NOTIFY_MAX_RETRIES', 5))
+PERSISTENCE_INTERVAL = float(os.environ.get('PERSISTENCE_INTERVAL', 10))  # ثانیه بین ذخیره‌های دسته‌ای وضعیت مکالمه‌ها
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')  # اگر تنظیم شود /metrics فقط با Authorization: Bearer <token> پاسخ می‌دهد
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 500))  # کوئری کندتر از این (شامل انتظار استخر) ثبت می‌شود
+SLOW_UPDATE_MS = float(os.environ.get('SLOW_UPDATE_MS', 2000))  # آپدیت کندتر از این با درخت spanها لاگ می‌شود
+SLOW_EXPLAIN_RATE = float(os.environ.get('SLOW_EXPLAIN_RATE', 0.1))  # سهم کوئری‌های کند که EXPLAIN می‌گیرند (ANALYZE فقط برای خواندن‌ها)
+SLOWLOG_SIZE = int(os.environ.get('SLOWLOG_SIZE', 50))  # ظرفیت حلقه کوئری‌های کند
+LOAN_PERIOD_DAYS = int(os.environ.get('LOAN_PERIOD_DAYS', 14))  # مهلت هر امانت از زمان تأیید
+REMINDER_INTERVAL = float(os.environ.get('REMINDER_INTERVAL', 900))  # ثانیه بین بررسی‌های امانت‌های سررسیدگذشته
+REMINDER_BATCH = int(os.environ.get('REMINDER_BATCH', 5000))  # تقریباً بیشینه امانت‌های یادآوری‌شده در هر اجرا
+DIGEST_TIME = os.environ.get('DIGEST_TIME', '09:00')  # ساعت ارسال گزارش روزانه ادمین‌ها
+BOT_TIMEZONE = os.environ.get('BOT_TIMEZONE', 'Asia/Tehran')
+STATS_DAYS = int(os.environ.get('STATS_DAYS', 30))  # پنجره روزهای گزارش /stats
+STATS_BACKFILL_BATCH = int(os.environ.get('STATS_BACKFILL_BATCH', 5000))  # امانت‌های هر دسته backfill آمار
+STATS_FLUSH_INTERVAL = float(os.environ.get('STATS_FLUSH_INTERVAL', 60))  # ثانیه بین جمع‌بندی تغییرات آمار
+LOAN_ARCHIVE_AFTER_DAYS = int(os.environ.get('LOAN_ARCHIVE_AFTER_DAYS', 30))  # امانت بسته‌شده پس از این مدت به بایگانی می‌رود
+LOAN_ARCHIVE_BATCH = int(os.environ.get('LOAN_ARCHIVE_BATCH', 1000))  # امانت‌های هر تراکنش انتقال به بایگانی
+LOAN_ARCHIVE_INTERVAL = float(os.environ.get('LOAN_ARCHIVE_INTERVAL', 3600))  # ثانیه بین اجراهای بایگانی
+EXPORT_BATCH_ROWS = int(os.environ.get('EXPORT_BATCH_ROWS', 2000))  # ردیف‌های هر fetch از cursor خروجی
+EXPORT_SPOOL_BYTES = int(os.environ.get('EXPORT_SPOOL_BYTES', 4 * 1024 * 1024))  # بیش از این، فایل خروجی روی دیسک می‌رود
+CATALOG_REFRESH_DELAY = float(os.environ.get('CATALOG_REFRESH_DELAY', 0.5))  # ثانیه جمع شدن اعلان‌ها پیش از به‌روزرسانی ایندکس
+CATALOG_SCAN_LIMIT = int(os.environ.get('CATALOG_SCAN_LIMIT', 2000))  # بیشینه نامزدهای بررسی‌شده در هر جستجوی inline
+INLINE_RESULTS = int(os.environ.get('INLINE_RESULTS', 20))  # نتیجه‌های هر صفحه inline (حداکثر ۵۰)
+INLINE_CACHE_TIME = int(os.environ.get('INLINE_CACHE_TIME', 10))  # ثانیه کش نتیجه‌ها در سرور تلگرام؛ کوتاه چون موجودی عوض می‌شود
+BOT_WORKERS = int(os.environ.get('BOT_WORKERS', 0))  # بیش از صفر: یک پردازه ingress و این تعداد worker
+WORKER_MAX_INFLIGHT = int(os.environ.get('WORKER_MAX_INFLIGHT', 200))  # آپدیت‌های تمام‌نشده هر worker پیش از توقف دریافت
+WORKER_HEARTBEAT_INTERVAL = float(os.environ.get('WORKER_HEARTBEAT_INTERVAL', 2))
+WORKER_HEARTBEAT_TIMEOUT = float(os.environ.get('WORKER_HEARTBEAT_TIMEOUT', 30))  # worker بی‌پاسخ پس از این کشته و دوباره اجرا می‌شود
+WORKER_DRAIN_TIMEOUT = float(os.environ.get('WORKER_DRAIN_TIMEOUT', 25))  # مهلت تمام کردن کار در دست هنگام توقف
+# worker که در این مدت آماده نشود (دیتابیس در دسترس نیست، قفل مهاجرت) کشته و دوباره اجرا می‌شود؛
+# باید از طولانی‌ترین مهاجرت بیشتر باشد
+WORKER_START_TIMEOUT = float(os.environ.get('WORKER_START_TIMEOUT', 300))
+WORKER_METRICS_INTERVAL = float(os.environ.get('WORKER_METRICS_INTERVAL', 5))  # فاصله ارسال متریک‌های worker به ingress
+GUARD_USER_RATE = float(os.environ.get('GUARD_USER_RATE', 1))  # آپدیت در ثانیه برای هر کاربر در درازمدت؛ 0 یعنی بدون محدودیت
+GUARD_USER_BURST = int(os.environ.get('GUARD_USER_BURST', 8))  # آپدیت‌های پشت سر هم مجاز پیش از محدود شدن
+GUARD_DEDUP_SIZE = int(os.environ.get('GUARD_DEDUP_SIZE', 10000))  # تعداد update_idهای اخیر برای تشخیص تکراری
+GUARD_MAX_USERS = int(os.environ.get('GUARD_MAX_USERS', 50000))  # بیشینه کاربرانی که سطل توکنشان نگه داشته می‌شود
+GUARD_MAX_IN_FLIGHT = int(os.environ.get('GUARD_MAX_IN_FLIGHT', 200))  # با این تعداد handler در حال اجرا فقط ادمین‌ها پذیرفته می‌شوند
+GUARD_MAX_DB_WAITING = int(os.environ.get('GUARD_MAX_DB_WAITING', DB_POOL_MAX * 10))  # همین، برای منتظران اتصال دیتابیس
+GUARD_NOTICE_INTERVAL = float(os.environ.get('GUARD_NOTICE_INTERVAL', 10))  # ثانیه بین پیام‌های «آهسته‌تر» به یک کاربر
+
 # --- فعال کردن لاگینگ ---
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
@@ -54,96 +149,2464 @@ DETAILS_GET_ID = 9
 DELETE_GET_ID, DELETE_CONFIRM = range(10, 12)
 BROWSE_GET_SUBJECT_CHOICE = 12
 APPROVAL_GET_LOAN_ID, APPROVAL_CONFIRM_ACTION = range(13, 15)
+IMPORT_GET_FILE = 15
+
+# --- متریک‌ها (فرمت متنی Prometheus) ---
+# پیاده‌سازی کوچک و بدون وابستگی: هر مشاهده یک bisect و چند جمع ساده روی event loop است
+# و متن خروجی فقط هنگام درخواست /metrics ساخته می‌شود.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS = []
+
+def _labels(names, values, extra=""):
+    parts = [f'{n}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, doc, labelnames=()):
+        self.name, self.doc, self.labelnames = name, doc, labelnames
+        self._values = defaultdict(float)
+        METRICS.append(self)
+
+    def inc(self, labels=(), n=1):
+        self._values[labels] += n
+
+    def samples(self):
+        for labels, value in list(self._values.items()):
+            yield self.name + _labels(self.labelnames, labels), value
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, labels=(), n=1):
+        self._values[labels] -= n
+
+    def total(self):
+        return sum(self._values.values())
+
+class CallbackMetric:
+    """مقدار هنگام خواندن /metrics از fn گرفته می‌شود؛ fn لیست (برچسب‌ها، مقدار) برمی‌گرداند"""
+
+    def __init__(self, name, doc, kind, labelnames, fn):
+        self.name, self.doc, self.kind, self.labelnames, self.fn = name, doc, kind, labelnames, fn
+        METRICS.append(self)
+
+    def samples(self):
+        for labels, value in self.fn():
+            yield self.name + _labels(self.labelnames, labels), value
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name, self.doc, self.labelnames, self.buckets = name, doc, labelnames, buckets
+        self._series = {}  # labels -> [شمار هر bucket..., شمار بیش از آخرین bucket، مجموع]
+        METRICS.append(self)
+
+    def observe(self, labels, value):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def samples(self):
+        for labels, series in list(self._series.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, series):
+                cumulative += n
+                yield self.name + "_bucket" + _labels(self.labelnames, labels, f'le="{bound}"'), cumulative
+            cumulative += series[-2]
+            yield self.name + "_bucket" + _labels(self.labelnames, labels, 'le="+Inf"'), cumulative
+            yield self.name + "_sum" + _labels(self.labelnames, labels), series[-1]
+            yield self.name + "_count" + _labels(self.labelnames, labels), cumulative
+
+def metrics_snapshot():
+    """نمونه‌های همه متریک‌ها به تفکیک نام؛ workerها این را برای ingress می‌فرستند"""
+    return {metric.name: list(metric.samples()) for metric in METRICS}
+
+def render_metrics(extra=()):
+    """extra: جفت‌های (برچسب، snapshot) پردازه‌های دیگر که با همان برچسب کنار نمونه‌های این پردازه می‌آیند"""
+    lines = []
+    for metric in METRICS:
+        lines.append(f"# HELP {metric.name} {metric.doc}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(f"{name} {value}" for name, value in metric.samples())
+        for label, snapshot in extra:
+            for name, value in snapshot.get(metric.name, ()):
+                name = name.replace("{", "{" + label + ",", 1) if "{" in name else name + "{" + label + "}"
+                lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+_FP_STRING = re.compile(r"'(?:[^']|'')*'")
+_FP_PARAM = re.compile(r"%\(\w+\)s|%s|\b\d+(?:\.\d+)?\b")
+_FP_SPACE = re.compile(r"\s+")
+
+@functools.lru_cache(maxsize=1024)
+def query_fingerprint(query):
+    """متن نرمال‌شده کوئری برای برچسب متریک: ثابت‌ها و پارامترها «?» و فاصله‌ها یکی می‌شوند"""
+    q = _FP_PARAM.sub("?", _FP_STRING.sub("?", query))
+    q = _FP_SPACE.sub(" ", q).strip()
+    return q if len(q) <= 120 else q[:117] + "..."
+
+handler_seconds = Histogram('library_handler_seconds', "Handler latency", ('handler',))
+handler_errors = Counter('library_handler_errors_total', "Unhandled exceptions raised by handlers", ('handler',))
+handlers_in_flight = Gauge('library_handlers_in_flight', "Handler calls currently running", ('handler',))
+db_query_seconds = Histogram('library_db_query_seconds', "Database call latency (excluding pool wait)", ('query',))
+db_errors = Counter('library_db_errors_total', "Failed database calls", ('query', 'error'))
+db_pool_wait_seconds = Histogram('library_db_pool_wait_seconds', "Time spent waiting for a pool connection")
+telegram_seconds = Histogram('library_telegram_request_seconds', "Bot API request latency", ('method',))
+telegram_errors = Counter('library_telegram_errors_total', "Failed Bot API requests", ('method',))
+db_reads = Counter('library_db_reads_total', "Read-only queries by the database that served them", ('target',))
+loans_archived = Counter('library_loans_archived_total', "Closed loans moved to the archive partition")
+updates_dropped = Counter('library_updates_dropped_total', "Updates dropped before dispatch", ('reason',))
+
+# --- ردیابی آپدیت‌ها و لاگ کوئری‌های کند ---
+# هر آپدیت در instrument یک trace می‌گیرد که در contextvar نگه داشته می‌شود؛ فراخوانی‌های
+# دیتابیس و Bot API همان handler به‌عنوان span زیر آن ثبت می‌شوند. taskهایی که handler
+# می‌سازد context را به ارث می‌برند، پس spanهایشان هم در همین trace می‌آیند.
+
+class Span:
+    __slots__ = ('name', 'start', 'duration', 'detail', 'children')
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.perf_counter()
+        self.duration = None
+        self.detail = None
+        self.children = []
+
+    def finish(self, detail=None):
+        self.duration = time.perf_counter() - self.start
+        self.detail = detail
+
+class Trace:
+    __slots__ = ('_id', 'update_id', 'user_id', 'root', 'spans')
+    MAX_SPANS = 200
+
+    def __init__(self, name, update):
+        self._id = None
+        self.update_id = getattr(update, 'update_id', None)
+        self.user_id = getattr(getattr(update, 'effective_user', None), 'id', None)
+        self.root = Span(name)
+        self.spans = 0
+
+    @property
+    def id(self):
+        # شناسه فقط وقتی ساخته می‌شود که جایی لاگ شود؛ بیشتر traceها هرگز نیازش ندارند
+        if self._id is None:
+            self._id = secrets.token_hex(4)
+        return self._id
+
+    def child(self, name):
+        if self.spans >= self.MAX_SPANS:
+            return None
+        self.spans += 1
+        span = Span(name)
+        self.root.children.append(span)
+        return span
+
+    def render(self):
+        lines = [f"trace {self.id} update={self.update_id} {self.root.name} {self.root.duration * 1000:.1f}ms"]
+        for span in self.root.children:
+            offset = (span.start - self.root.start) * 1000
+            took = f"{span.duration * 1000:.1f}ms" if span.duration is not None else "ناتمام"
+            lines.append(f"  +{offset:.1f}ms {span.name} {took}" + (f" ({span.detail})" if span.detail else ""))
+        return "\n".join(lines)
+
+_trace = contextvars.ContextVar('trace', default=None)
+
+def current_trace_id():
+    trace = _trace.get()
+    return trace.id if trace is not None else "-"
+
+def current_user_id():
+    """کاربر آپدیتی که handler جاری برایش اجرا می‌شود (برای خواندن نوشته‌های خودش)"""
+    trace = _trace.get()
+    return trace.user_id if trace is not None else None
+
+def start_span(name):
+    trace = _trace.get()
+    return trace.child(name) if trace is not None else None
+
+def _format_timing(timing):
+    return " ".join(f"{k}={v * 1000:.1f}" for k, v in timing.items())
+
+def params_shape(params):
+    """شکل پارامترها بدون مقدارشان (برای لاگ): نوع هر پارامتر و طول لیست‌ها"""
+    def shape(v):
+        return f"{type(v).__name__}[{len(v)}]" if isinstance(v, (list, tuple)) else type(v).__name__
+    if isinstance(params, dict):
+        return "{" + ", ".join(f"{k}: {shape(v)}" for k, v in params.items()) + "}"
+    return "(" + ", ".join(shape(v) for v in params) + ")"
+
+slow_queries = deque(maxlen=SLOWLOG_SIZE)
+_explaining = set()
+_EXPLAINABLE = re.compile(r'^\s*(SELECT|WITH|INSERT|UPDATE|DELETE)\b', re.IGNORECASE)
+# دستوری که یکی از این‌ها را دارد چیزی می‌نویسد یا قفل می‌گیرد و فقط EXPLAIN بدون ANALYZE می‌گیرد؛
+# اجرای دوباره‌اش قفل ردیف‌ها و قفل آمار را درست وقتی دیتابیس زیر فشار است دوباره می‌گیرد
+_WRITES = re.compile(
+    r'\b(INSERT|UPDATE|DELETE|MERGE|SHARE|nextval|setval|pg_advisory\w*|pg_notify|loan_stats_flush)\b',
+    re.IGNORECASE)
+
+def record_slow_query(pool, fingerprint, query, params, total, timing):
+    entry = {
+        'at': time.strftime('%Y-%m-%d %H:%M:%S'), 'trace': current_trace_id(), 'query': fingerprint,
+        'ms': total * 1000, 'timing': _format_timing(timing),
+        'params': params_shape(params) if query is not None else "", 'plan': None,
+    }
+    slow_queries.append(entry)
+    logger.warning(f"کوئری کند [{entry['trace']}] {entry['ms']:.0f}ms ({entry['timing']}) {fingerprint} {entry['params']}")
+    if (query is not None and fingerprint not in _explaining and _EXPLAINABLE.match(query)
+            and random.random() < SLOW_EXPLAIN_RATE):
+        _explaining.add(fingerprint)
+        # روی همان استخری که کوئری اجرا شد (primary یا replica)
+        asyncio.ensure_future(_capture_explain(pool, entry, query, params))
+
+def _explain(conn, query, params, analyze):
+    with conn.cursor() as cursor:
+        if analyze:
+            # دستور واقعاً اجرا می‌شود؛ فقط‌خواندنی، بدون انتظار برای قفل و کوتاه
+            cursor.execute("SET TRANSACTION READ ONLY")
+            cursor.execute("SET LOCAL statement_timeout = '5s'")
+            cursor.execute("SET LOCAL lock_timeout = '500ms'")
+            cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + query, params)
+        else:
+            cursor.execute("EXPLAIN " + query, params)
+        plan = "\n".join(r[0] for r in cursor.fetchall())
+    conn.rollback()
+    return plan
+
+async def _capture_explain(pool, entry, query, params):
+    # task یک کپی از context سازنده را دارد؛ EXPLAIN جزو trace آن آپدیت نیست
+    _trace.set(None)
+    analyze = _EXPLAINABLE.match(query).group(1).upper() in ('SELECT', 'WITH') and not _WRITES.search(query)
+    try:
+        entry['plan'] = await pool.run(_explain, query, params, analyze)
+    except (psycopg2.Error, PoolTimeout) as e:
+        entry['plan'] = f"EXPLAIN ناموفق: {e}"
+    finally:
+        _explaining.discard(entry['query'])
+
+def instrument(callback):
+    """پیچیدن یک callback آپدیت با ثبت زمان، خطا و تعداد در حال اجرا"""
+    labels = (callback.__name__,)
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        handlers_in_flight.inc(labels)
+        trace = Trace(labels[0], update)
+        token = _trace.set(trace)
+        try:
+            return await callback(update, context)
+        except Exception:
+            handler_errors.inc(labels)
+            raise
+        finally:
+            _trace.reset(token)
+            trace.root.finish()
+            handler_seconds.observe(labels, trace.root.duration)
+            handlers_in_flight.dec(labels)
+            if trace.root.duration * 1000 >= SLOW_UPDATE_MS:
+                logger.warning("آپدیت کند:\n" + trace.render())
+    return wrapper
+
+def instrument_handlers(application):
+    """همه handlerهای ثبت‌شده، از جمله مراحل ConversationHandlerها"""
+    def walk(handlers):
+        for handler in handlers:
+            if isinstance(handler, ConversationHandler):
+                walk(handler.entry_points)
+                for state_handlers in handler.states.values():
+                    walk(state_handlers)
+                walk(handler.fallbacks)
+            else:
+                handler.callback = instrument(handler.callback)
+    for group in application.handlers.values():
+        walk(group)
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest با ثبت زمان هر فراخوانی Bot API بر اساس نام متد"""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        labels = (url.rsplit('/', 1)[-1],)
+        span = start_span("telegram " + labels[0])
+        start = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            telegram_errors.inc(labels)
+            raise
+        finally:
+            telegram_seconds.observe(labels, time.perf_counter() - start)
+            if span is not None:
+                span.finish()
+        if code >= 400:
+            telegram_errors.inc(labels)
+        return code, payload
 
 # --- توابع کمکی دیتابیس ---
 
-def db_query(query, params=()):
-    """یک تابع کمکی برای اتصال و اجرای کوئری در دیتابیس PostgreSQL"""
-    if not DATABASE_URL:
+class PoolTimeout(Exception):
+    """در زمان مقرر اتصال آزادی در استخر پیدا نشد"""
+
+class DBPool:
+    """استخر محدود اتصال‌های PostgreSQL که کوئری‌ها را خارج از event loop اجرا می‌کند"""
+
+    def __init__(self, dsn, minconn, maxconn, acquire_timeout, healthcheck_interval):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.acquire_timeout = acquire_timeout
+        self.healthcheck_interval = healthcheck_interval
+        self.in_use = 0
+        self.waiting = 0
+        self._pool = None
+        self._executor = None
+        self._slots = None
+        self._last_used = {}
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        # هر اتصال یک thread اختصاصی دارد تا فراخوانی‌های همزمان پشت هم صف نکشند
+        self._executor = ThreadPoolExecutor(max_workers=self.maxconn, thread_name_prefix="db")
+        self._slots = asyncio.Semaphore(self.maxconn)
+        try:
+            self._pool = await loop.run_in_executor(
+                self._executor, psycopg2.pool.ThreadedConnectionPool, self.minconn, self.maxconn, self.dsn
+            )
+        except psycopg2.Error:
+            self._executor.shutdown(wait=False)
+            raise
+        logger.info(f"استخر دیتابیس آماده شد (min={self.minconn}, max={self.maxconn})")
+
+    async def run(self, fn, *args):
+        """fn(conn, *args) را با یک اتصال از استخر در یک thread جدا و داخل یک تراکنش اجرا می‌کند"""
+        if self._pool is None:
+            raise PoolTimeout("استخر دیتابیس باز نشده است.")
+        labels = (query_fingerprint(args[0]) if fn is _execute else fn.__name__,)
+        span = start_span("db " + labels[0])
+        timing = {}
+        self.waiting += 1
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            db_errors.inc(labels + ('PoolTimeout',))
+            if span is not None:
+                span.finish("PoolTimeout")
+            raise PoolTimeout(f"پس از {self.acquire_timeout} ثانیه اتصال آزادی پیدا نشد.")
+        finally:
+            self.waiting -= 1
+            timing['wait'] = time.perf_counter() - start
+            db_pool_wait_seconds.observe((), timing['wait'])
+
+        self.in_use += 1
+        submitted = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        work = self._executor.submit(self._call, fn, args, timing, submitted)
+        # جایگاه وقتی آزاد می‌شود که خود thread (و اتصالش) تمام شده باشد: لغو handler فقط future
+        # asyncio را لغو می‌کند و کاری که شروع شده تا پایان اتصال را نگه می‌دارد
+        work.add_done_callback(lambda _work: loop.call_soon_threadsafe(self._release))
+        try:
+            return await asyncio.wrap_future(work)
+        except Exception as e:
+            db_errors.inc(labels + (type(e).__name__,))
+            raise
+        finally:
+            db_query_seconds.observe(labels, time.perf_counter() - submitted)
+            total = time.perf_counter() - start
+            if span is not None:
+                span.finish(_format_timing(timing))
+            if total * 1000 >= SLOW_QUERY_MS and fn is not _explain:
+                query, params = args if fn is _execute else (None, None)
+                record_slow_query(self, labels[0], query, params, total, timing)
+
+    def _release(self):
+        self.in_use -= 1
+        self._slots.release()
+
+    def _call(self, fn, args, timing, submitted):
+        start = time.perf_counter()
+        timing['queue'] = start - submitted
+        conn = self._checkout()
+        timing['connect'] = time.perf_counter() - start
+        broken = False
+        _db_local.timing = timing
+        try:
+            result = fn(conn, *args)
+            committing = time.perf_counter()
+            conn.commit()
+            timing['commit'] = time.perf_counter() - committing
+            return result
+        except Exception:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+            raise
+        finally:
+            _db_local.timing = None
+            broken = broken or conn.closed != 0
+            if broken:
+                self._last_used.pop(id(conn), None)
+            else:
+                self._last_used[id(conn)] = time.monotonic()
+            self._pool.putconn(conn, close=broken)
+
+    def _checkout(self):
+        conn = self._pool.getconn()
+        idle = time.monotonic() - self._last_used.get(id(conn), 0)
+        if conn.closed or idle > self.healthcheck_interval:
+            # اتصالی که مدتی بیکار مانده ممکن است سمت سرور بسته شده باشد
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                conn.rollback()
+            except psycopg2.Error:
+                logger.warning("اتصال خراب دیتابیس کنار گذاشته شد.")
+                self._last_used.pop(id(conn), None)
+                self._pool.putconn(conn, close=True)
+                conn = self._pool.getconn()
+        return conn
+
+    async def close(self):
+        if self._pool is None:
+            return
+        # منتظر می‌مانیم کوئری‌های در حال اجرا تمام شوند
+        for _ in range(self.maxconn):
+            try:
+                await asyncio.wait_for(self._slots.acquire(), self.acquire_timeout)
+            except asyncio.TimeoutError:
+                logger.warning("برخی کوئری‌ها هنگام بستن استخر هنوز در حال اجرا بودند.")
+                break
+        self._pool.closeall()
+        self._pool = None
+        self._executor.shutdown(wait=False)
+        logger.info("استخر دیتابیس بسته شد.")
+
+db_pool = None
+_db_local = threading.local()  # زمان‌بندی کوئری جاری هر thread استخر (برای لاگ کوئری کند)
+
+def _execute(conn, query, params):
+    with conn.cursor() as cursor:
+        start = time.perf_counter()
+        cursor.execute(query, params)
+        executed = time.perf_counter()
+        # هر کوئری‌ای که ردیف برگرداند (SELECT یا RETURNING) نتیجه‌اش را می‌دهد
+        result = cursor.fetchall() if cursor.description is not None else "COMMIT_OK"
+        timing = getattr(_db_local, 'timing', None)
+        if timing is not None:
+            timing['execute'] = executed - start
+            timing['fetch'] = time.perf_counter() - executed
+        return result
+
+async def _query(pool, query, params):
+    if pool is None:
         logger.error("خطا: DATABASE_URL در دسترس نیست.")
         return None
-        
-    conn = None
+
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cursor = conn.cursor()
-        
-        cursor.execute(query, params)
-        
-        if query.strip().upper().startswith("SELECT"):
-            results = cursor.fetchall()
-            return results
-        else:
-            conn.commit()
-            return "COMMIT_OK"
-            
-    except psycopg2.Error as e:
+        return await pool.run(_execute, query, params)
+    except (psycopg2.Error, PoolTimeout) as e:
         logger.error(f"خطای دیتابیس: {e}")
-        if conn:
-            conn.rollback()
         return None
-    finally:
-        if conn:
-            conn.close()
 
-def init_db():
-    """ایجاد جداول مورد نیاز"""
-    if not DATABASE_URL:
-        logger.error("خطا: DATABASE_URL تنظیم نشده است.")
-        return
-        
-    logger.info("در حال بررسی و ایجاد جداول دیتابیس...")
-    
-    # 1. جدول books
-    db_query("""
+async def db_write(query, params=()):
+    """اجرای دستوری که می‌نویسد روی primary بدون مسدود کردن event loop؛ کاربر جاری مدتی از primary می‌خواند"""
+    replica.touch(current_user_id())
+    return await _query(db_pool, query, params)
+
+async def db_read(query, params=(), fresh=False):
+    """اجرای یک کوئری فقط‌خواندنی؛ اگر fresh نباشد و replica سالم باشد از replica
+
+    خطای اتصال یا پر بودن استخر replica همان خواندن را به primary می‌برد و replica را تا
+    بررسی بعدی ناسالم علامت می‌زند؛ خطای خود کوئری روی primary هم تکرار می‌شد و برگردانده نمی‌شود.
+    """
+    pool = db_pool if fresh else replica.target(current_user_id())
+    if pool is not db_pool:
+        try:
+            result = await pool.run(_execute, query, params)
+            db_reads.inc(('replica',))
+            return result
+        except (psycopg2.OperationalError, PoolTimeout) as e:
+            replica.mark_down(e)
+        except psycopg2.Error as e:
+            logger.error(f"خطای دیتابیس (replica): {e}")
+            return None
+    db_reads.inc(('primary',))
+    return await _query(db_pool, query, params)
+
+db_query = db_write  # نام قدیمی برای ابزارها و بنچمارک‌ها؛ همیشه primary
+
+# --- مسیریابی خواندن‌ها به replica ---
+# خواندن‌هایی که چند ثانیه کهنگی را تحمل می‌کنند (جستجو، مرور، جزئیات، فهرست امانت‌ها، خروجی CSV)
+# با db_read به replica اختیاری می‌روند و همه نوشتن‌ها با db_write به primary. کاربری که تازه نوشته
+# تا DB_STICKY_SECONDS از primary می‌خواند تا تغییر خودش را ببیند. اگر replica در دسترس نباشد یا
+# تأخیرش از DB_REPLICA_MAX_LAG بگذرد، همه خواندن‌ها تا بهبود آن به primary برمی‌گردند.
+
+# هر بررسی موقعیت WAL primary را با زمانش نگه می‌دارد؛ تأخیر، عمر قدیمی‌ترین نمونه‌ای است که
+# replica هنوز به آن نرسیده. عمر آخرین تراکنش اعمال‌شده روی replica بیکار هم بزرگ است و به کار نمی‌آید.
+# سروری که در حال recovery نیست (مثلاً خود primary) همیشه به‌روز حساب می‌شود.
+PRIMARY_LSN_QUERY = "SELECT pg_current_wal_lsn() - '0/0'::pg_lsn"
+REPLICA_LSN_QUERY = "SELECT CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn() - '0/0'::pg_lsn END"
+
+class ReplicaRouter:
+    """استخر replica، سلامت و تأخیر آن، و پنجره خواندن از primary پس از نوشتن هر کاربر"""
+
+    def __init__(self, sticky_seconds, max_lag, check_interval):
+        self.sticky_seconds = sticky_seconds
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.pool = None
+        self.healthy = False
+        self.lag = None
+        self._dsn = None
+        self._sticky = {}  # user_id -> زمان پایان خواندن از primary
+        self._samples = deque()  # (زمان، موقعیت WAL primary) که replica هنوز به آن نرسیده
+        self._task = None
+
+    def touch(self, user_id):
+        if self._dsn is None or user_id is None:
+            return
+        now = time.monotonic()
+        if len(self._sticky) > 10000:
+            self._sticky = {u: t for u, t in self._sticky.items() if t > now}
+        self._sticky[user_id] = now + self.sticky_seconds
+
+    def target(self, user_id=None):
+        """استخری که خواندن غیرحساس این کاربر باید از آن انجام شود"""
+        if not self.healthy:
+            return db_pool
+        if user_id is not None and self._sticky.get(user_id, 0) > time.monotonic():
+            return db_pool
+        return self.pool
+
+    def mark_down(self, error):
+        if self.healthy:
+            logger.warning(f"replica در دسترس نیست؛ خواندن‌ها به primary می‌روند: {error}")
+        self.healthy = False
+
+    async def open(self, dsn):
+        self._dsn = dsn
+        await self.check()
+        self._task = asyncio.ensure_future(self._monitor())
+
+    async def check(self):
+        """اندازه‌گیری تأخیر replica و به‌روزرسانی healthy؛ استخر بسته یا خراب دوباره باز می‌شود"""
+        try:
+            if self.pool is None:
+                pool = DBPool(self._dsn, DB_POOL_MIN, DB_REPLICA_POOL_MAX, DB_POOL_TIMEOUT, DB_HEALTHCHECK_INTERVAL)
+                await pool.open()
+                self.pool = pool
+            now = time.monotonic()
+            primary = (await db_pool.run(_execute, PRIMARY_LSN_QUERY, ()))[0][0]
+            replayed = (await asyncio.wait_for(
+                self.pool.run(_execute, REPLICA_LSN_QUERY, ()), self.check_interval + DB_POOL_TIMEOUT))[0][0]
+        except (psycopg2.Error, PoolTimeout, asyncio.TimeoutError) as e:
+            self.lag = None
+            self.mark_down(e)
+            return
+        samples = self._samples
+        samples.append((now, primary))
+        while samples and (replayed is None or samples[0][1] <= replayed):
+            samples.popleft()
+        self.lag = time.monotonic() - samples[0][0] if samples else 0.0
+        healthy = self.lag <= self.max_lag
+        if healthy != self.healthy:
+            if healthy:
+                logger.info(f"replica سالم است (تأخیر {self.lag:.1f}s)؛ خواندن‌ها به replica می‌روند.")
+            else:
+                logger.warning(f"تأخیر replica {self.lag:.1f}s است؛ خواندن‌ها به primary می‌روند.")
+        self.healthy = healthy
+
+    async def _monitor(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            await self.check()
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.healthy = False
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+replica = ReplicaRouter(DB_STICKY_SECONDS, DB_REPLICA_MAX_LAG, DB_REPLICA_CHECK_INTERVAL)
+
+# --- اعلان‌های PostgreSQL (LISTEN/NOTIFY) ---
+
+class DBListener:
+    """یک اتصال اختصاصی LISTEN که اعلان‌ها را روی همان event loop به callbackها می‌رساند
+
+    callback(payload) همگام و سریع است (مثلاً باطل کردن یک کش). اگر اتصال قطع شود
+    دوباره وصل می‌شود و چون اعلان‌های زمان قطعی از دست رفته‌اند، همه callbackها را با None صدا می‌زند.
+    """
+
+    def __init__(self, dsn, retry_interval):
+        self.dsn = dsn
+        self.retry_interval = retry_interval
+        self.received = 0
+        self._handlers = defaultdict(list)
+        self._conn = None
+        self._fd = None
+        self._loop = None
+        self._reconnect_task = None
+
+    def subscribe(self, channel, callback):
+        self._handlers[channel].append(callback)
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        await self._connect()
+        logger.info(f"گوش دادن به اعلان‌های دیتابیس: {', '.join(self._handlers)}")
+
+    async def _connect(self):
+        self._conn = await self._loop.run_in_executor(None, self._open)
+        # fileno پس از قطع اتصال قابل خواندن نیست؛ برای remove_reader نگه داشته می‌شود
+        self._fd = self._conn.fileno()
+        self._loop.add_reader(self._fd, self._on_readable)
+
+    def _open(self):
+        conn = psycopg2.connect(self.dsn)
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            for channel in self._handlers:
+                cursor.execute(f'LISTEN "{channel}"')
+        return conn
+
+    def _on_readable(self):
+        try:
+            self._conn.poll()
+        except psycopg2.Error as e:
+            logger.warning(f"اتصال LISTEN قطع شد؛ تلاش دوباره: {e}")
+            self._drop()
+            self._reconnect_task = asyncio.ensure_future(self._reconnect())
+            return
+        while self._conn.notifies:
+            n = self._conn.notifies.pop(0)
+            self.received += 1
+            self._dispatch(n.channel, n.payload)
+
+    def _dispatch(self, channel, payload):
+        for callback in self._handlers.get(channel, ()):
+            try:
+                callback(payload)
+            except Exception:
+                logger.exception(f"خطا در پردازش اعلان {channel}")
+
+    async def _reconnect(self):
+        while True:
+            await asyncio.sleep(self.retry_interval)
+            try:
+                await self._connect()
+            except psycopg2.Error as e:
+                logger.warning(f"اتصال دوباره LISTEN ناموفق بود: {e}")
+                continue
+            for channel in list(self._handlers):
+                self._dispatch(channel, None)
+            return
+
+    def _drop(self):
+        if self._conn is None:
+            return
+        self._loop.remove_reader(self._fd)
+        try:
+            self._conn.close()
+        except psycopg2.Error:
+            pass
+        self._conn = None
+
+    async def stop(self):
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+        self._drop()
+
+db_listener = None
+
+# --- نرمال‌سازی و جستجو ---
+
+# یکسان‌سازی حروف عربی/فارسی و ارقام؛ همین جدول در تابع SQL به نام normalize_fa هم استفاده می‌شود
+_FA_FROM = "يىكةۀأإآؤ۰۱۲۳۴۵۶۷۸۹٠١٢٣٤٥٦٧٨٩"
+_FA_TO = "ییکههاااو01234567890123456789"
+# نیم‌فاصله، کشیده و اعراب حذف می‌شوند
+_FA_DROP = "\u200c\u200d\u0640" + "".join(chr(c) for c in range(0x064B, 0x0653)) + "\u0654\u0670"
+_FA_TABLE = str.maketrans(_FA_FROM, _FA_TO, _FA_DROP)
+
+SEARCH_TRGM = False
+SEARCH_FILTER_RE = re.compile(r'(author|subject|نویسنده|موضوع):("[^"]*"|\S+)', re.IGNORECASE)
+SEARCH_FIELDS = {'author': 'author', 'نویسنده': 'author', 'subject': 'subject', 'موضوع': 'subject'}
+_TOKEN_RE = re.compile(r'\w+')
+
+def normalize_text(text):
+    """نسخه پایتونی normalize_fa برای نرمال کردن عبارت جستجو"""
+    return " ".join((text or "").translate(_FA_TABLE).lower().split())
+
+def parse_search(text):
+    """جدا کردن فیلترهای author: و subject: از عبارت اصلی جستجو"""
+    filters = {}
+
+    def take(m):
+        filters[SEARCH_FIELDS[m.group(1).lower()]] = normalize_text(m.group(2).strip('"'))
+        return " "
+
+    rest = SEARCH_FILTER_RE.sub(take, text)
+    return normalize_text(rest), {k: v for k, v in filters.items() if v}
+
+def _like(term):
+    return "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+async def search_books(text, limit=10, after=None):
+    """جستجوی رتبه‌بندی‌شده روی ستون نرمال‌شده search_text
+
+    after مکان‌نمای [امتیاز, id] آخرین ردیف صفحه قبل است (صفحه‌بندی keyset).
+    """
+    q, filters = parse_search(text)
+    if not q and not filters:
+        return []
+
+    where, params = [], {'limit': limit}
+    if q:
+        params['q'] = q
+        params['q_like'] = _like(q)
+        if SEARCH_TRGM:
+            # LIKE برای تطابق دقیق و <% برای تحمل غلط تایپی؛ هر دو از ایندکس trigram استفاده می‌کنند
+            where.append("(search_text LIKE %(q_like)s OR %(q)s <%% search_text)")
+            score = "word_similarity(%(q)s, search_text) + (normalize_fa(title) LIKE %(q_like)s)::int"
+        else:
+            where.append("search_text LIKE %(q_like)s")
+            score = "(normalize_fa(title) LIKE %(q_like)s)::int"
+    else:
+        score = "0"
+    for field, term in filters.items():
+        params[field] = _like(term)
+        # شرط روی search_text فقط برای استفاده از ایندکس است؛ شرط دوم فیلد را دقیق می‌کند
+        where.append(f"search_text LIKE %({field})s AND normalize_fa({field}) LIKE %({field})s")
+
+    # امتیاز به numeric گرد می‌شود تا مکان‌نما بدون خطای ممیز شناور برگردد
+    keyset = ""
+    if after:
+        params['after_score'] = Decimal(after[0])
+        params['after_id'] = after[1]
+        keyset = "WHERE score < %(after_score)s OR (score = %(after_score)s AND id > %(after_id)s)"
+
+    return await db_read(f"""
+        SELECT * FROM (
+            SELECT id, title, author, subject, count, borrowed_count, round(({score})::numeric, 4) AS score
+            FROM books
+            WHERE {' AND '.join(where)}
+        ) ranked
+        {keyset}
+        ORDER BY score DESC, id
+        LIMIT %(limit)s
+    """, params)
+
+# --- کش‌های درون‌پردازه ---
+
+class QueryCache:
+    """نگه‌داری نتیجه یک کوئری کوچک در حافظه با TTL؛ build ردیف‌ها را به مقدار کش‌شده تبدیل می‌کند"""
+
+    def __init__(self, query, ttl, build):
+        self.query = query
+        self.ttl = ttl
+        self.build = build
+        self.hits = 0
+        self.misses = 0
+        self._value = None
+        self._loaded_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def _fresh(self):
+        return self._value is not None and time.monotonic() - self._loaded_at < self.ttl
+
+    async def get(self, refresh=False):
+        if not refresh and self._fresh():
+            self.hits += 1
+            return self._value
+        async with self._lock:
+            # ممکن است درخواست همزمان دیگری در این فاصله مقدار را بارگذاری کرده باشد
+            if not refresh and self._fresh():
+                self.hits += 1
+                return self._value
+            self.misses += 1
+            results = await db_read(self.query, fresh=True)
+            if results is None:
+                # در خطای دیتابیس آخرین مقدار معتبر را نگه می‌داریم و کش نمی‌کنیم
+                return self._value if self._value is not None else self.build([])
+            self._value = self.build(results)
+            self._loaded_at = time.monotonic()
+            return self._value
+
+    def peek(self):
+        """آخرین مقدار بارگذاری‌شده بدون دیتابیس و بدون توجه به TTL؛ None اگر هنوز بارگذاری نشده"""
+        return self._value
+
+    def invalidate(self, _payload=None):
+        self._value = None
+
+class BookCache:
+    """کش LRU رکورد کتاب‌ها بر اساس id برای مسیرهای نمایشی
+
+    نوشته‌های خود ربات ورودی را فوراً باطل می‌کنند و نوشته‌های نمونه‌های دیگر با اعلان
+    books_changed می‌رسند. هر رکورد نسخه ردیف را دارد تا اعلانی که دیرتر از بارگذاری
+    دوباره برسد ورودی تازه‌تر را بی‌دلیل بیرون نیندازد. بررسی موجودی هرگز از این کش نمی‌خواند.
+
+    بارگذاری از replica است؛ برای هر کتاب کمینه نسخه‌ای که پس از آخرین ابطال قابل کش است نگه
+    داشته می‌شود و اگر replica هنوز به آن نرسیده باشد، همان کتاب از primary خوانده می‌شود.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._rows = OrderedDict()  # id -> (id, title, author, subject, count, borrowed_count, version)
+        self._loading = {}  # id -> Future بارگذاری در جریان، تا درخواست‌های همزمان یک کوئری بزنند
+        self._epoch = 0  # با هر ابطال زیاد می‌شود؛ نتیجه بارگذاری هم‌زمان با ابطال ذخیره نمی‌شود
+        self._min_version = OrderedDict()  # id -> کمینه نسخه قابل قبول از replica (inf: فقط primary)
+        self._fresh_until = 0.0  # پس از ابطال کلی، تا این زمان همه بارگذاری‌ها از primary
+
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    async def get(self, bid):
+        row = self._rows.get(bid)
+        if row is not None:
+            self.hits += 1
+            self._rows.move_to_end(bid)
+            return row
+        self.misses += 1
+        if bid in self._loading:
+            return await asyncio.shield(self._loading[bid])
+        fut = asyncio.get_running_loop().create_future()
+        self._loading[bid] = fut
+        epoch = self._epoch
+        try:
+            row = await self._load(bid)
+            if row is not None and epoch == self._epoch:
+                self._rows[bid] = row
+                if len(self._rows) > self.maxsize:
+                    self._rows.popitem(last=False)
+                    self.evictions += 1
+            fut.set_result(row)
+            return row
+        except BaseException as e:
+            fut.set_exception(e)
+            fut.exception()  # اگر منتظر دیگری نباشد هشدار «exception never retrieved» ندهد
+            raise
+        finally:
+            del self._loading[bid]
+
+    async def _load(self, bid):
+        query = "SELECT id, title, author, subject, count, borrowed_count, version FROM books WHERE id = %s"
+        need = self._min_version.get(bid)
+        fresh = time.monotonic() < self._fresh_until
+        res = await db_read(query, (bid,), fresh=fresh)
+        row = tuple(res[0]) if res else None
+        if not fresh and need is not None and (row is None or row[6] < need):
+            # replica ممکن است هنوز تغییری را که ابطال از آن خبر داده اعمال نکرده باشد
+            res = await db_read(query, (bid,), fresh=True)
+            row = tuple(res[0]) if res else None
+        if res is not None and self._min_version.get(bid) == need:
+            self._min_version.pop(bid, None)
+        return row
+
+    def invalidate(self, bid, version=None):
+        """حذف ورودی؛ با version فقط اگر نسخه کش‌شده قدیمی‌تر باشد"""
+        self._epoch += 1
+        need = float('inf') if version is None else version
+        if need > self._min_version.get(bid, 0):
+            self._min_version[bid] = need
+            self._min_version.move_to_end(bid)
+            if len(self._min_version) > self.maxsize:
+                self._min_version.popitem(last=False)
+        row = self._rows.get(bid)
+        if row is not None and (version is None or row[6] < version):
+            del self._rows[bid]
+            self.invalidations += 1
+
+    def clear(self, _payload=None):
+        self._epoch += 1
+        self._fresh_until = time.monotonic() + DB_REPLICA_MAX_LAG
+        self.invalidations += len(self._rows)
+        self._rows.clear()
+
+    def on_notify(self, payload):
+        if not payload or payload == '*':
+            # None یعنی اتصال LISTEN دوباره برقرار شده و ممکن است اعلانی از دست رفته باشد
+            self.clear()
+            return
+        for item in payload.split(','):
+            bid, _, version = item.partition(':')
+            self.invalidate(int(bid), int(version) if version else None)
+
+class CatalogIndex:
+    """ایندکس پیشوندی درون‌پردازه روی کلمه‌های عنوان و نویسنده برای پاسخ inline بدون کوئری
+
+    هر کلمه نرمال‌شده همراه شماره ردیف کتابش در دو آرایه موازی و مرتب (_keys و _slots) است؛
+    کلمه‌های هم‌پیشوند کنار هم‌اند و جستجوی پیشوند یک bisect است. رشته‌های کلمه بین کتاب‌ها
+    مشترک‌اند. تغییرات با اعلان books_changed دسته‌ای خوانده و اعمال می‌شوند؛ کتاب حذف‌شده فقط
+    علامت می‌خورد و وقتی یک‌چهارم ردیف‌ها مرده باشند ایندکس دوباره ساخته می‌شود.
+    همه تغییرات از یک task انجام می‌شوند و جستجو هرگز منتظر دیتابیس نمی‌ماند.
+    """
+
+    query = "SELECT id, title, author, subject, count, borrowed_count FROM books"
+
+    def __init__(self, refresh_delay, scan_limit):
+        self.refresh_delay = refresh_delay
+        self.scan_limit = scan_limit
+        self.ready = False
+        self.builds = 0
+        self.updates = 0
+        self._keys = []  # کلمه‌ها به ترتیب
+        self._slots = array('i')  # شماره ردیف هر کلمه در _books
+        self._books = []  # ردیف -> (id, title, author, subject, count, borrowed_count) یا None اگر حذف شده
+        self._slot_of = {}  # id -> ردیف
+        self._dead = 0
+        self._pending = set()
+        self._reload = False
+        self._task = None
+
+    def __len__(self):
+        return len(self._slot_of)
+
+    @staticmethod
+    def tokens(row):
+        return set(_TOKEN_RE.findall(normalize_text(f"{row[1]} {row[2]}")))
+
+    @classmethod
+    def build(cls, rows):
+        """(keys, slots, books, slot_of) از ردیف‌های کتاب؛ در thread جدا اجرا می‌شود"""
+        books = [tuple(r) for r in rows]
+        shared = {}
+        pairs = []
+        for slot, row in enumerate(books):
+            for tok in cls.tokens(row):
+                pairs.append((shared.setdefault(tok, tok), slot))
+        pairs.sort()
+        keys = [k for k, _ in pairs]
+        slots = array('i', [s for _, s in pairs])
+        return keys, slots, books, {row[0]: slot for slot, row in enumerate(books)}
+
+    def search(self, text, limit):
+        """کتاب‌هایی که هر کلمه عبارت، پیشوند کلمه‌ای از عنوان یا نویسنده آن‌هاست"""
+        words = _TOKEN_RE.findall(normalize_text(text))
+        if not words:
+            return []
+        # نامزدها از بلندترین کلمه (معمولاً کم‌تکرارترین) می‌آیند و بقیه روی خود کتاب بررسی می‌شوند
+        words.sort(key=len, reverse=True)
+        first, rest = words[0], words[1:]
+        keys, slots, books = self._keys, self._slots, self._books
+        i = bisect.bisect_left(keys, first)
+        end = min(len(keys), i + self.scan_limit)
+        seen, found = set(), []
+        # تطابق کامل کلمه پیش از کلمه‌های بلندتر هم‌پیشوند می‌آید، پس ترتیب آرایه خود رتبه‌بندی است
+        while i < end and len(found) < limit and keys[i].startswith(first):
+            slot = slots[i]
+            i += 1
+            row = books[slot]
+            if row is None or slot in seen:
+                continue
+            seen.add(slot)
+            if rest:
+                toks = self.tokens(row)
+                if not all(any(t.startswith(w) for t in toks) for w in rest):
+                    continue
+            found.append(row)
+        return found
+
+    def on_notify(self, payload):
+        if not payload or payload == '*':
+            # None یعنی اتصال LISTEN دوباره برقرار شده و ممکن است اعلانی از دست رفته باشد
+            self._reload = True
+        else:
+            for item in payload.split(','):
+                self._pending.add(int(item.partition(':')[0]))
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._refresh())
+
+    async def _refresh(self):
+        # چند اعلان پشت سر هم (مثلاً یک ورود گروهی) یک بار اعمال می‌شوند
+        await asyncio.sleep(self.refresh_delay)
+        while self._reload or self._pending:
+            if self._reload:
+                self._reload = False
+                self._pending.clear()
+                ok = await self._load()
+            else:
+                ids, self._pending = self._pending, set()
+                rows = await db_read(self.query + " WHERE id = ANY(%s)", (list(ids),), fresh=True)
+                ok = rows is not None
+                if ok:
+                    self._apply(ids, rows)
+            if not ok:
+                # تا دیتابیس برگردد نسخه فعلی ایندکس سرویس می‌دهد
+                self._reload = True
+                await asyncio.sleep(LISTEN_RETRY_INTERVAL)
+
+    async def _load(self):
+        start = time.perf_counter()
+        try:
+            built = await db_pool.run(self._build_from_db)
+        except (psycopg2.Error, PoolTimeout) as e:
+            logger.error(f"خطای ساخت ایندکس کتاب‌ها: {e}")
+            return False
+        self._install(*built)
+        logger.info(f"ایندکس inline: {len(self)} کتاب، {len(self._keys)} کلمه در {time.perf_counter() - start:.2f}s")
+        return True
+
+    def _build_from_db(self, conn):
+        return self.build(_execute(conn, self.query, ()))
+
+    def _install(self, keys, slots, books, slot_of):
+        self._keys, self._slots, self._books, self._slot_of = keys, slots, books, slot_of
+        self._dead = 0
+        self.builds += 1
+        self.ready = True
+
+    def _apply(self, ids, rows):
+        current = {r[0]: tuple(r) for r in rows}
+        for bid in ids:
+            row = current.get(bid)
+            slot = self._slot_of.get(bid)
+            if slot is not None and row is not None and self._books[slot][1:3] == row[1:3]:
+                # بیشتر تغییرها موجودی است؛ کلمه‌ها دست نمی‌خورند
+                self._books[slot] = row
+                continue
+            if slot is not None:
+                self._books[slot] = None
+                del self._slot_of[bid]
+                self._dead += 1
+            if row is not None:
+                self._add(row)
+            self.updates += 1
+        if self._dead > len(self._books) // 4:
+            # ساخت دوباره در thread استخر انجام می‌شود تا event loop معطل نماند
+            self._reload = True
+
+    def _add(self, row):
+        slot = len(self._books)
+        self._books.append(row)
+        self._slot_of[row[0]] = slot
+        for tok in self.tokens(row):
+            i = bisect.bisect_right(self._keys, tok)
+            self._keys.insert(i, tok)
+            self._slots.insert(i, slot)
+
+    def start(self):
+        self.on_notify(None)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+book_cache = BookCache(BOOK_CACHE_SIZE)
+catalog_index = CatalogIndex(CATALOG_REFRESH_DELAY, CATALOG_SCAN_LIMIT)
+
+admin_cache = QueryCache("SELECT user_id FROM admins", ADMIN_CACHE_TTL, lambda rows: frozenset(r[0] for r in rows))
+# با اعلان subject_stats باطل می‌شود؛ TTL فقط پشتیبان قطعی LISTEN است
+subject_cache = QueryCache(
+    "SELECT subject, titles, copies, available FROM subject_stats WHERE titles > 0 ORDER BY subject",
+    SUBJECT_CACHE_TTL, list)
+
+async def is_admin(user_id):
+    return user_id in await admin_cache.get()
+
+async def get_admin_user_ids():
+    return list(await admin_cache.get())
+
+# --- مهاجرت‌های اسکیمای دیتابیس ---
+# هر مرحله (نسخه، توضیح، دستورها) فقط یک بار اجرا و در schema_version ثبت می‌شود.
+# مرحله‌های جدید فقط به انتهای فهرست اضافه می‌شوند؛ مرحله‌های قبلی هرگز ویرایش نمی‌شوند.
+# دستورها رشته یا (رشته، پارامترها) هستند.
+
+STATS_LOCK_ID = 7310023  # قفل advisory بین trigger آمار امانت‌ها و دسته‌های backfill
+
+# هر ردیف امانت به رویدادهایش باز می‌شود (درخواست، تأیید، رد، بازگشت)؛ ردیف‌های added با
+# علامت مثبت و removed با علامت منفی می‌آیند، پس یک تغییر وضعیت فقط اختلافش را اضافه می‌کند
+LOAN_STATS_EVENTS = """
+    CREATE OR REPLACE FUNCTION loan_stats_events(added loans[], removed loans[])
+    RETURNS SETOF loan_stats_delta LANGUAGE sql IMMUTABLE AS $$
+        WITH r AS (
+            SELECT a.*, 1 AS sign FROM unnest(added) a
+            UNION ALL
+            SELECT d.*, -1 FROM unnest(removed) d
+        ), ev AS (
+            SELECT borrow_date::date AS day, book_id, user_id, sign AS requested, 0 AS approved, 0 AS rejected,
+                   0 AS returned, NULL::double precision AS wait, sign
+            FROM r
+            UNION ALL
+            SELECT COALESCE(decided_at, borrow_date)::date, book_id, user_id, 0, sign, 0, 0,
+                   extract(epoch FROM decided_at - borrow_date)::double precision, sign
+            FROM r WHERE status IN ('APPROVED', 'RETURNED')
+            UNION ALL
+            SELECT COALESCE(decided_at, borrow_date)::date, book_id, user_id, 0, 0, sign, 0,
+                   extract(epoch FROM decided_at - borrow_date)::double precision, sign
+            FROM r WHERE status = 'REJECTED'
+            UNION ALL
+            SELECT COALESCE(return_date, decided_at, borrow_date)::date, book_id, user_id, 0, 0, 0, sign, NULL, sign
+            FROM r WHERE status = 'RETURNED'
+        )
+        SELECT day, book_id, user_id, sum(requested)::int, sum(approved)::int, sum(rejected)::int, sum(returned)::int,
+               COALESCE(sum(sign) FILTER (WHERE wait IS NOT NULL), 0)::int, COALESCE(sum(sign * wait), 0)
+        FROM ev GROUP BY day, book_id, user_id
+        HAVING sum(requested) <> 0 OR sum(approved) <> 0 OR sum(rejected) <> 0 OR sum(returned) <> 0
+    $$
+    """
+
+MIGRATIONS = [
+    (1, "جداول پایه", [
+        """
         CREATE TABLE IF NOT EXISTS books (
             id SERIAL PRIMARY KEY,
             title TEXT NOT NULL,
             author TEXT,
             subject TEXT,
-            count INTEGER NOT NULL, 
-            borrowed_count INTEGER DEFAULT 0 
-        )
-    """)
-
-    # 2. جدول admins
-    db_query("""
-        CREATE TABLE IF NOT EXISTS admins (
-            user_id BIGINT PRIMARY KEY
+            count INTEGER NOT NULL,
+            borrowed_count INTEGER DEFAULT 0
         )
-    """)
-    
-    # 3. جدول loans
-    db_query("""
+        """,
+        "CREATE TABLE IF NOT EXISTS admins (user_id BIGINT PRIMARY KEY)",
+        """
         CREATE TABLE IF NOT EXISTS loans (
             id SERIAL PRIMARY KEY,
             book_id INTEGER REFERENCES books(id) ON DELETE CASCADE,
             user_id BIGINT NOT NULL,
             borrow_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             return_date TIMESTAMP DEFAULT NULL,
-            status TEXT DEFAULT 'PENDING' 
+            status TEXT DEFAULT 'PENDING'
+        )
+        """,
+        # دیتابیس‌های قدیمی ستون status را نداشتند
+        "ALTER TABLE loans ADD COLUMN IF NOT EXISTS status TEXT DEFAULT 'PENDING'",
+    ]),
+    (2, "ستون جستجوی نرمال‌شده و ایندکس trigram", [
+        ("""
+        CREATE OR REPLACE FUNCTION normalize_fa(t TEXT) RETURNS TEXT
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE
+        AS $$ SELECT btrim(regexp_replace(lower(translate(coalesce(t, ''), %s, %s)), '\\s+', ' ', 'g')) $$
+        """, (_FA_FROM + _FA_DROP, _FA_TO)),
+        """
+        ALTER TABLE books ADD COLUMN IF NOT EXISTS search_text TEXT
+        GENERATED ALWAYS AS (normalize_fa(title) || ' ' || normalize_fa(author) || ' ' || normalize_fa(subject)) STORED
+        """,
+        # pg_trgm روی همه سرویس‌ها نصب نیست؛ نبودنش مهاجرت را متوقف نمی‌کند
+        """
+        DO $$ BEGIN
+            CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        EXCEPTION WHEN OTHERS THEN
+            RAISE NOTICE 'pg_trgm unavailable: %', SQLERRM;
+        END $$
+        """,
+        """
+        DO $$ BEGIN
+            IF EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm') THEN
+                CREATE INDEX IF NOT EXISTS books_search_trgm ON books USING gin (search_text gin_trgm_ops);
+            END IF;
+        END $$
+        """,
+    ]),
+    (3, "جدول وضعیت مکالمه‌ها (PostgresPersistence)", [
+        """
+        CREATE TABLE IF NOT EXISTS bot_persistence (
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            data JSONB NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (kind, key)
+        )
+        """,
+    ]),
+    (4, "ایندکس‌های مسیرهای پرتکرار و محدوده borrowed_count", [
+        # امانت‌های جاری هر کاربر (my_loans و بررسی درخواست تکراری)
+        "CREATE INDEX IF NOT EXISTS loans_user_active ON loans (user_id) WHERE status IN ('PENDING', 'APPROVED')",
+        # صفحه‌های درخواست‌ها و امانت‌ها (WHERE status = .. AND id > .. ORDER BY id)
+        "CREATE INDEX IF NOT EXISTS loans_status_id ON loans (status, id)",
+        # درخواست‌های یک کتاب (book:N) و حذف آبشاری امانت‌ها با حذف کتاب
+        "CREATE INDEX IF NOT EXISTS loans_book_id ON loans (book_id)",
+        # مرور موضوعی (WHERE subject = .. AND id > .. ORDER BY id)
+        "CREATE INDEX IF NOT EXISTS books_subject_id ON books (subject, id)",
+        # داده‌های قدیمی را پیش از افزودن قید به بازه مجاز برمی‌گردانیم
+        """
+        UPDATE books SET borrowed_count = LEAST(GREATEST(COALESCE(borrowed_count, 0), 0), GREATEST(count, 0))
+        WHERE borrowed_count IS NULL OR borrowed_count < 0 OR borrowed_count > count
+        """,
+        "ALTER TABLE books ALTER COLUMN borrowed_count SET NOT NULL",
+        "ALTER TABLE books ADD CONSTRAINT books_borrowed_count_range CHECK (borrowed_count BETWEEN 0 AND count)",
+    ]),
+    (5, "جدول آمار موضوع‌ها با نگه‌داری خودکار توسط trigger", [
+        """
+        CREATE TABLE IF NOT EXISTS subject_stats (
+            subject TEXT PRIMARY KEY,
+            titles INTEGER NOT NULL DEFAULT 0,
+            copies BIGINT NOT NULL DEFAULT 0,
+            available BIGINT NOT NULL DEFAULT 0
+        )
+        """,
+        # triggerهای سطح دستور با جدول‌های انتقالی: یک COPY صدهزار ردیفی هم فقط یک upsert
+        # به ازای هر موضوع انجام می‌دهد، نه یکی به ازای هر ردیف
+        """
+        CREATE OR REPLACE FUNCTION subject_stats_apply() RETURNS trigger LANGUAGE plpgsql AS $$
+        DECLARE
+            s TEXT[];
+            t BIGINT[];
+            c BIGINT[];
+            a BIGINT[];
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                SELECT array_agg(subject ORDER BY subject), array_agg(dt ORDER BY subject), array_agg(dc ORDER BY subject),
+                       array_agg(da ORDER BY subject) INTO s, t, c, a FROM (
+                    SELECT subject, count(*) AS dt, sum(count) AS dc, sum(count - borrowed_count) AS da
+                    FROM new_rows WHERE subject IS NOT NULL GROUP BY subject
+                ) d;
+            ELSIF TG_OP = 'DELETE' THEN
+                SELECT array_agg(subject ORDER BY subject), array_agg(dt ORDER BY subject), array_agg(dc ORDER BY subject),
+                       array_agg(da ORDER BY subject) INTO s, t, c, a FROM (
+                    SELECT subject, -count(*) AS dt, -sum(count) AS dc, -sum(count - borrowed_count) AS da
+                    FROM old_rows WHERE subject IS NOT NULL GROUP BY subject
+                ) d;
+            ELSE
+                SELECT array_agg(subject ORDER BY subject), array_agg(dt ORDER BY subject), array_agg(dc ORDER BY subject),
+                       array_agg(da ORDER BY subject) INTO s, t, c, a FROM (
+                    SELECT subject, sum(dt) AS dt, sum(dc) AS dc, sum(da) AS da FROM (
+                        SELECT subject, 1 AS dt, count AS dc, count - borrowed_count AS da FROM new_rows
+                        UNION ALL
+                        SELECT subject, -1, -count, -(count - borrowed_count) FROM old_rows
+                    ) u WHERE subject IS NOT NULL GROUP BY subject
+                ) d WHERE dt <> 0 OR dc <> 0 OR da <> 0;
+            END IF;
+
+            IF s IS NULL THEN
+                RETURN NULL;
+            END IF;
+            -- ردیف‌ها به ترتیب موضوع قفل می‌شوند تا دو دستور همزمان بن‌بست نسازند
+            INSERT INTO subject_stats AS st (subject, titles, copies, available)
+            SELECT * FROM unnest(s, t, c, a)
+            ON CONFLICT (subject) DO UPDATE SET
+                titles = st.titles + EXCLUDED.titles,
+                copies = st.copies + EXCLUDED.copies,
+                available = st.available + EXCLUDED.available;
+            DELETE FROM subject_stats WHERE subject = ANY(s) AND titles <= 0;
+            PERFORM pg_notify('subject_stats', '');
+            RETURN NULL;
+        END $$
+        """,
+        """
+        CREATE TRIGGER books_subject_stats_ins AFTER INSERT ON books
+        REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION subject_stats_apply()
+        """,
+        """
+        CREATE TRIGGER books_subject_stats_upd AFTER UPDATE ON books
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION subject_stats_apply()
+        """,
+        """
+        CREATE TRIGGER books_subject_stats_del AFTER DELETE ON books
+        REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION subject_stats_apply()
+        """,
+        # پر کردن اولیه پس از ساخت triggerها؛ قفل CREATE TRIGGER نوشتن روی books را تا پایان تراکنش نگه می‌دارد
+        """
+        INSERT INTO subject_stats (subject, titles, copies, available)
+        SELECT subject, count(*), sum(count), sum(count - borrowed_count) FROM books
+        WHERE subject IS NOT NULL GROUP BY subject
+        """,
+    ]),
+    (6, "نسخه و زمان تغییر کتاب‌ها برای کش رکورد کتاب", [
+        "ALTER TABLE books ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 1",
+        "ALTER TABLE books ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP",
+        """
+        CREATE OR REPLACE FUNCTION books_bump_version() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            NEW.version := OLD.version + 1;
+            NEW.updated_at := CURRENT_TIMESTAMP;
+            RETURN NEW;
+        END $$
+        """,
+        "CREATE TRIGGER books_version BEFORE UPDATE ON books FOR EACH ROW EXECUTE FUNCTION books_bump_version()",
+        # payload: «id:version» برای ویرایش، «id» برای حذف، و «*» اگر در یک دستور بیش از ۵۰۰ کتاب تغییر کند
+        """
+        CREATE OR REPLACE FUNCTION books_notify_changed() RETURNS trigger LANGUAGE plpgsql AS $$
+        DECLARE
+            n INTEGER;
+            ids TEXT;
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                SELECT count(*), string_agg(id::text, ',') INTO n, ids FROM (SELECT id FROM old_rows LIMIT 501) o;
+            ELSE
+                SELECT count(*), string_agg(id || ':' || version, ',') INTO n, ids FROM (SELECT id, version FROM new_rows LIMIT 501) o;
+            END IF;
+            IF n > 500 THEN
+                ids := '*';
+            END IF;
+            IF ids IS NOT NULL THEN
+                PERFORM pg_notify('books_changed', ids);
+            END IF;
+            RETURN NULL;
+        END $$
+        """,
+        """
+        CREATE TRIGGER books_changed_upd AFTER UPDATE ON books
+        REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION books_notify_changed()
+        """,
+        """
+        CREATE TRIGGER books_changed_del AFTER DELETE ON books
+        REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION books_notify_changed()
+        """,
+    ]),
+    (7, "موعد بازگشت امانت‌ها و زمان آخرین یادآوری", [
+        "ALTER TABLE loans ADD COLUMN IF NOT EXISTS due_date TIMESTAMP, ADD COLUMN IF NOT EXISTS last_reminded_at TIMESTAMP",
+        # امانت‌های فعلی تاریخ تأیید ندارند؛ مهلت از زمان درخواست حساب می‌شود
+        ("UPDATE loans SET due_date = borrow_date + make_interval(days => %s) WHERE status = 'APPROVED' AND due_date IS NULL",
+         (LOAN_PERIOD_DAYS,)),
+        # فقط امانت‌های فعال در ایندکس‌اند؛ با بزرگ شدن تاریخچه امانت‌ها اندازه‌اش ثابت می‌ماند
+        "CREATE INDEX IF NOT EXISTS loans_overdue ON loans (due_date) WHERE status = 'APPROVED'",
+    ]),
+    (8, "صف انتظار کتاب‌های ناموجود", [
+        """
+        CREATE TABLE IF NOT EXISTS waitlist (
+            id SERIAL PRIMARY KEY,
+            book_id INTEGER NOT NULL REFERENCES books(id) ON DELETE CASCADE,
+            user_id BIGINT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (book_id, user_id)
+        )
+        """,
+        # ترتیب صف هر کتاب؛ هم سر صف و هم شماره نوبت (count روی id‌های کوچک‌تر) از همین ایندکس خوانده می‌شوند
+        "CREATE INDEX IF NOT EXISTS waitlist_book_id ON waitlist (book_id, id)",
+        "CREATE INDEX IF NOT EXISTS waitlist_user_id ON waitlist (user_id)",
+    ]),
+    (9, "جدول‌های تجمیعی آمار امانت با نگه‌داری افزایشی", [
+        "ALTER TABLE loans ADD COLUMN IF NOT EXISTS decided_at TIMESTAMP",
+        """
+        CREATE TABLE IF NOT EXISTS loan_stats_daily (
+            day DATE PRIMARY KEY,
+            requested INTEGER NOT NULL DEFAULT 0,
+            approved INTEGER NOT NULL DEFAULT 0,
+            rejected INTEGER NOT NULL DEFAULT 0,
+            returned INTEGER NOT NULL DEFAULT 0,
+            decided INTEGER NOT NULL DEFAULT 0,
+            decision_seconds DOUBLE PRECISION NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS loan_stats_book_daily (
+            day DATE,
+            book_id INTEGER,
+            approved INTEGER NOT NULL DEFAULT 0,
+            returned INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, book_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS loan_stats_subject_daily (
+            day DATE,
+            subject TEXT,
+            approved INTEGER NOT NULL DEFAULT 0,
+            returned INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, subject)
+        )
+        """,
+        "CREATE TABLE IF NOT EXISTS loan_stats_book (book_id INTEGER PRIMARY KEY, approved INTEGER NOT NULL DEFAULT 0)",
+        "CREATE INDEX IF NOT EXISTS loan_stats_book_top ON loan_stats_book (approved DESC)",
+        "CREATE TABLE IF NOT EXISTS loan_stats_user (user_id BIGINT PRIMARY KEY, approved INTEGER NOT NULL DEFAULT 0)",
+        "CREATE INDEX IF NOT EXISTS loan_stats_user_top ON loan_stats_user (approved DESC)",
+        # trigger فقط به این جدول اضافه می‌کند (بدون قفل ردیف و بدون ردیف داغ روز جاری در مسیر تأیید)؛
+        # loan_stats_flush تغییرات را دسته‌ای در جدول‌های بالا جمع می‌کند
+        """
+        CREATE TABLE IF NOT EXISTS loan_stats_delta (
+            day DATE NOT NULL,
+            book_id INTEGER,
+            user_id BIGINT NOT NULL,
+            requested INTEGER NOT NULL,
+            approved INTEGER NOT NULL,
+            rejected INTEGER NOT NULL,
+            returned INTEGER NOT NULL,
+            decided INTEGER NOT NULL,
+            decision_seconds DOUBLE PRECISION NOT NULL
+        )
+        """,
+        # امانت‌های با شناسه تا done_upto در آمار آمده‌اند؛ بقیه را backfill از روی وضعیت ردیف اضافه می‌کند
+        """
+        CREATE TABLE IF NOT EXISTS loan_stats_progress (
+            singleton BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (singleton),
+            done_upto INTEGER NOT NULL
         )
+        """,
+        """
+        INSERT INTO loan_stats_progress (done_upto)
+        SELECT CASE WHEN EXISTS (SELECT 1 FROM loans) THEN 0 ELSE 2147483647 END
+        ON CONFLICT DO NOTHING
+        """,
+        LOAN_STATS_EVENTS,
+        # قفل اشتراکی trigger با قفل انحصاری flush و دسته‌های backfill ترتیب می‌گیرد: وقتی آن‌ها قفل را
+        # دارند هیچ تراکنش نیمه‌کاره‌ای در loan_stats_delta نیست، و رویدادی که همزمان با یک دسته backfill
+        # رخ دهد پس از آن و با done_upto جدید ثبت می‌شود؛ نه دو بار شمرده می‌شود نه گم
+        ("""
+        CREATE OR REPLACE FUNCTION loan_stats_changed() RETURNS trigger LANGUAGE plpgsql AS $$
+        DECLARE
+            upto INTEGER;
+            added loans[];
+            removed loans[];
+        BEGIN
+            PERFORM pg_advisory_xact_lock_shared(%s);
+            SELECT done_upto INTO upto FROM loan_stats_progress;
+            IF TG_OP = 'INSERT' THEN
+                added := ARRAY(SELECT n FROM new_rows n WHERE n.id <= upto);
+                removed := '{}';
+            ELSE
+                -- فقط تغییر وضعیت در آمار اثر دارد؛ علامت‌گذاری یادآوری و مانند آن نادیده گرفته می‌شود
+                added := ARRAY(SELECT n FROM new_rows n JOIN old_rows o ON o.id = n.id
+                               WHERE n.id <= upto AND n.status IS DISTINCT FROM o.status);
+                removed := ARRAY(SELECT o FROM old_rows o JOIN new_rows n ON n.id = o.id
+                                 WHERE o.id <= upto AND n.status IS DISTINCT FROM o.status);
+            END IF;
+            IF cardinality(added) > 0 OR cardinality(removed) > 0 THEN
+                INSERT INTO loan_stats_delta SELECT * FROM loan_stats_events(added, removed);
+            END IF;
+            RETURN NULL;
+        END $$
+        """, (STATS_LOCK_ID,)),
+        """
+        CREATE TRIGGER loans_stats_ins AFTER INSERT ON loans
+        REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION loan_stats_changed()
+        """,
+        """
+        CREATE TRIGGER loans_stats_upd AFTER UPDATE ON loans
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION loan_stats_changed()
+        """,
+        # جمع کردن تغییرات در جدول‌های تجمیعی؛ ردیف‌های هر جدول به ترتیب کلید قفل می‌شوند
+        ("""
+        CREATE OR REPLACE FUNCTION loan_stats_flush() RETURNS bigint LANGUAGE plpgsql AS $$
+        DECLARE
+            n BIGINT;
+        BEGIN
+            PERFORM pg_advisory_xact_lock(%s);
+            SELECT count(*) INTO n FROM loan_stats_delta;
+            IF n = 0 THEN
+                RETURN 0;
+            END IF;
+
+            INSERT INTO loan_stats_daily AS t (day, requested, approved, rejected, returned, decided, decision_seconds)
+            SELECT day, sum(requested), sum(approved), sum(rejected), sum(returned), sum(decided), sum(decision_seconds)
+            FROM loan_stats_delta GROUP BY day ORDER BY day
+            ON CONFLICT (day) DO UPDATE SET
+                requested = t.requested + EXCLUDED.requested,
+                approved = t.approved + EXCLUDED.approved,
+                rejected = t.rejected + EXCLUDED.rejected,
+                returned = t.returned + EXCLUDED.returned,
+                decided = t.decided + EXCLUDED.decided,
+                decision_seconds = t.decision_seconds + EXCLUDED.decision_seconds;
+
+            INSERT INTO loan_stats_book_daily AS t (day, book_id, approved, returned)
+            SELECT day, book_id, sum(approved), sum(returned) FROM loan_stats_delta
+            WHERE book_id IS NOT NULL GROUP BY day, book_id
+            HAVING sum(approved) <> 0 OR sum(returned) <> 0 ORDER BY day, book_id
+            ON CONFLICT (day, book_id) DO UPDATE SET
+                approved = t.approved + EXCLUDED.approved, returned = t.returned + EXCLUDED.returned;
+
+            -- موضوع کتاب هنگام جمع‌بندی خوانده می‌شود، نه هنگام رویداد
+            INSERT INTO loan_stats_subject_daily AS t (day, subject, approved, returned)
+            SELECT d.day, COALESCE(b.subject, ''), sum(d.approved), sum(d.returned)
+            FROM loan_stats_delta d JOIN books b ON b.id = d.book_id
+            GROUP BY d.day, COALESCE(b.subject, '')
+            HAVING sum(d.approved) <> 0 OR sum(d.returned) <> 0 ORDER BY 1, 2
+            ON CONFLICT (day, subject) DO UPDATE SET
+                approved = t.approved + EXCLUDED.approved, returned = t.returned + EXCLUDED.returned;
+
+            INSERT INTO loan_stats_book AS t (book_id, approved)
+            SELECT book_id, sum(approved) FROM loan_stats_delta
+            WHERE book_id IS NOT NULL GROUP BY book_id HAVING sum(approved) <> 0 ORDER BY book_id
+            ON CONFLICT (book_id) DO UPDATE SET approved = t.approved + EXCLUDED.approved;
+
+            INSERT INTO loan_stats_user AS t (user_id, approved)
+            SELECT user_id, sum(approved) FROM loan_stats_delta
+            GROUP BY user_id HAVING sum(approved) <> 0 ORDER BY user_id
+            ON CONFLICT (user_id) DO UPDATE SET approved = t.approved + EXCLUDED.approved;
+
+            -- زیر قفل انحصاری هیچ نویسنده‌ای وسط تراکنش نیست؛ TRUNCATE برخلاف DELETE پس از backfill
+            -- صدها هزار tuple مرده برای count بعدی باقی نمی‌گذارد
+            TRUNCATE loan_stats_delta;
+            RETURN n;
+        END $$
+        """, (STATS_LOCK_ID,)),
+    ]),
+    (10, "اعلان books_changed برای کتاب‌های تازه", [
+        # ایندکس inline کتاب‌های افزوده‌شده را هم باید ببیند؛ برای کش رکوردها بی‌اثر است
+        """
+        CREATE TRIGGER books_changed_ins AFTER INSERT ON books
+        REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION books_notify_changed()
+        """,
+    ]),
+    (11, "جدا کردن امانت‌های بسته‌شده در پارتیشن بایگانی", [
+        # جدول فعلی بدون کپی داده پارتیشن داغ می‌شود: ستون با مقدار پیش‌فرض بازنویسی نمی‌خواهد و
+        # CHECK پیش از attach، اسکن اعتبارسنجی پارتیشن را حذف می‌کند. انتقال تاریخچه به بایگانی
+        # بعداً دسته‌ای با archive_loans انجام می‌شود.
+        "ALTER TABLE loans ADD COLUMN IF NOT EXISTS archived BOOLEAN NOT NULL DEFAULT false",
+        "ALTER TABLE loans ADD CONSTRAINT loans_hot_archived CHECK (NOT archived)",
+        "DROP TRIGGER IF EXISTS loans_stats_ins ON loans",
+        "DROP TRIGGER IF EXISTS loans_stats_upd ON loans",
+        "ALTER TABLE loans RENAME TO loans_hot",
+        "ALTER INDEX loans_pkey RENAME TO loans_hot_pkey",
+        """
+        CREATE TABLE loans (
+            id INTEGER NOT NULL DEFAULT nextval('loans_id_seq'),
+            book_id INTEGER REFERENCES books(id) ON DELETE CASCADE,
+            user_id BIGINT NOT NULL,
+            borrow_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            return_date TIMESTAMP DEFAULT NULL,
+            status TEXT DEFAULT 'PENDING',
+            due_date TIMESTAMP,
+            last_reminded_at TIMESTAMP,
+            decided_at TIMESTAMP,
+            archived BOOLEAN NOT NULL DEFAULT false
+        ) PARTITION BY LIST (archived)
+        """,
+        "ALTER SEQUENCE loans_id_seq OWNED BY loans.id",
+        "ALTER TABLE loans ATTACH PARTITION loans_hot FOR VALUES IN (false)",
+        # CHECK وضعیت، پارتیشن بایگانی را با constraint exclusion از کوئری‌های امانت‌های جاری
+        # (PENDING و APPROVED) کنار می‌گذارد؛ مسیرهای پرتکرار فقط پارتیشن داغ را می‌بینند
+        """
+        CREATE TABLE loans_archive PARTITION OF loans (
+            PRIMARY KEY (id),
+            CONSTRAINT loans_archive_closed CHECK (status IN ('RETURNED', 'REJECTED'))
+        ) FOR VALUES IN (true)
+        """,
+        "CREATE INDEX loans_archive_user ON loans_archive (user_id, id)",
+        "CREATE INDEX loans_archive_book ON loans_archive (book_id)",
+        # نامزدهای بایگانی به ترتیب زمان بسته شدن
+        """
+        CREATE INDEX loans_hot_closed ON loans_hot ((COALESCE(return_date, decided_at, borrow_date)))
+        WHERE status IN ('RETURNED', 'REJECTED')
+        """,
+        # تابع رویدادها به نوع ردیف جدول قدیمی (اکنون loans_hot) بسته شده بود
+        "DROP FUNCTION loan_stats_events(loans_hot[], loans_hot[])",
+        LOAN_STATS_EVENTS,
+        # انتقال به بایگانی وضعیت را عوض نمی‌کند و در آمار اثری ندارد
+        """
+        CREATE TRIGGER loans_stats_ins AFTER INSERT ON loans
+        REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION loan_stats_changed()
+        """,
+        """
+        CREATE TRIGGER loans_stats_upd AFTER UPDATE ON loans
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION loan_stats_changed()
+        """,
+    ]),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+MIGRATION_LOCK_ID = 7310021  # کلید advisory lock تا دو نمونه همزمان مهاجرت اجرا نکنند
+
+def _schema_state(conn):
+    """(نسخه فعلی اسکیما، pg_trgm فعال است) با یک کوئری"""
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT COALESCE(max(version), 0), EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')
+            FROM schema_version
+        """)
+        return cursor.fetchone()
+
+def _apply_migrations(conn):
+    """اجرای مرحله‌های باقی‌مانده در یک تراکنش؛ فهرست نسخه‌های اجراشده"""
+    applied = []
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_ID,))
+        # پس از گرفتن قفل دوباره می‌خوانیم؛ شاید نمونه دیگری همین حالا مهاجرت را انجام داده باشد
+        cursor.execute("SELECT COALESCE(max(version), 0) FROM schema_version")
+        current = cursor.fetchone()[0]
+        for version, description, steps in MIGRATIONS:
+            if version <= current:
+                continue
+            for step in steps:
+                if isinstance(step, tuple):
+                    cursor.execute(*step)
+                else:
+                    cursor.execute(step)
+            cursor.execute("INSERT INTO schema_version (version, description) VALUES (%s, %s)", (version, description))
+            applied.append(version)
+    return applied
+
+async def init_db():
+    """به‌روز کردن اسکیما؛ اگر اسکیما به‌روز باشد فقط یک کوئری خواندن نسخه اجرا می‌شود"""
+    global SEARCH_TRGM
+    try:
+        version, SEARCH_TRGM = await db_pool.run(_schema_state)
+    except psycopg2.errors.UndefinedTable:
+        version = 0  # دیتابیس تازه یا نسخه‌ای از ربات پیش از جدول schema_version
+
+    if version < SCHEMA_VERSION:
+        logger.info(f"به‌روزرسانی اسکیمای دیتابیس از نسخه {version} به {SCHEMA_VERSION}...")
+        # خطای مهاجرت راه‌اندازی را متوقف می‌کند؛ ربات نباید روی اسکیمای نیمه‌کاره اجرا شود
+        applied = await db_pool.run(_apply_migrations)
+        logger.info(f"مهاجرت‌های اجراشده: {applied or 'هیچ (نمونه دیگری انجام داده بود)'}")
+        version, SEARCH_TRGM = await db_pool.run(_schema_state)
+
+    if not SEARCH_TRGM:
+        logger.warning("افزونه pg_trgm در دسترس نیست؛ جستجو بدون ایندکس و بدون تحمل غلط تایپی انجام می‌شود.")
+
+# --- صف ارسال پیام ---
+
+class TokenBucket:
+    """محدودکننده نرخ: rate توکن در ثانیه با ظرفیت انفجاری capacity"""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self):
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    async def take(self):
+        while not self.try_take():
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class Notifier:
+    """صف محدود پیام‌های خروجی با چند worker در پس‌زمینه
+
+    handlerها فقط notify را صدا می‌زنند. پیام‌هایی که تا نوبت ارسال برای یک چت جمع شوند
+    در یک پیام خلاصه ادغام می‌شوند؛ RetryAfter و خطاهای شبکه با تأخیر دوباره تلاش می‌شوند.
+    """
+
+    def __init__(self, workers, maxsize, global_rate, chat_rate, max_retries):
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.max_retries = max_retries
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self._queue = asyncio.Queue(maxsize)
+        self._pending = {}
+        self._global = TokenBucket(global_rate, capacity=global_rate)
+        self._chats = {}
+        self._tasks = []
+        self._bot = None
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def notify(self, chat_id, text):
+        """افزودن پیام به صف؛ اگر صف پر باشد False"""
+        if chat_id in self._pending:
+            self._pending[chat_id].append(text)
+            self.coalesced += 1
+            return True
+        if self._queue.full():
+            self.dropped += 1
+            logger.warning(f"صف ارسال پر است؛ پیام به {chat_id} دور ریخته شد.")
+            return False
+        self._pending[chat_id] = [text]
+        self._queue.put_nowait(chat_id)
+        return True
+
+    def start(self, bot):
+        self._bot = bot
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout=10):
+        """ارسال پیام‌های باقی‌مانده (تا timeout) و توقف workerها"""
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"{self._queue.qsize()} پیام هنگام توقف ارسال نشد.")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                # سطل‌هایی که پر شده‌اند اطلاعاتی ندارند و می‌شود دورشان ریخت
+                for cid in [c for c, b in self._chats.items() if c not in self._pending and b.try_take()]:
+                    del self._chats[cid]
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate)
+        return bucket
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._queue.get()
+            try:
+                await self._chat_bucket(chat_id).take()
+                texts = self._pending.pop(chat_id, [])
+                if len(texts) > 1:
+                    texts = [f"📬 {len(texts)} اعلان جدید:\n\n" + "\n\n➖➖➖\n\n".join(texts)]
+                for text in texts:
+                    for i in range(0, len(text), 4096):
+                        await self._send(chat_id, text[i:i + 4096])
+            except Exception as e:
+                logger.error(f"خطای ارسال پیام به {chat_id}: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def _send(self, chat_id, text):
+        for attempt in range(self.max_retries + 1):
+            await self._global.take()
+            try:
+                await self._bot.send_message(chat_id, text)
+                self.sent += 1
+                return
+            except RetryAfter as e:
+                await asyncio.sleep(float(e.retry_after))
+            except NetworkError:
+                await asyncio.sleep(min(30, 2 ** attempt))
+            except TelegramError as e:
+                # کاربر ربات را بسته یا چت وجود ندارد؛ تلاش دوباره فایده ندارد
+                logger.warning(f"ارسال پیام به {chat_id} ممکن نشد: {e}")
+                break
+        self.failed += 1
+
+notifier = Notifier(NOTIFY_WORKERS, NOTIFY_QUEUE_SIZE, NOTIFY_GLOBAL_RATE, NOTIFY_CHAT_RATE, NOTIFY_MAX_RETRIES)
+
+# متریک‌هایی که هنگام خواندن /metrics از وضعیت اجزای دیگر گرفته می‌شوند
+CallbackMetric('library_db_pool_connections', "Pool connections by state", 'gauge', ('state',), lambda: [
+    (('in_use',), db_pool.in_use), (('waiting',), db_pool.waiting), (('max',), db_pool.maxconn),
+] if db_pool is not None else [])
+CallbackMetric('library_notify_queue_depth', "Chats with pending notifications", 'gauge', (),
+               lambda: [((), notifier.depth())])
+CallbackMetric('library_notify_messages_total', "Notification outcomes", 'counter', ('result',), lambda: [
+    (('sent',), notifier.sent), (('failed',), notifier.failed),
+    (('dropped',), notifier.dropped), (('coalesced',), notifier.coalesced),
+])
+CallbackMetric('library_cache_requests_total', "In-process cache lookups", 'counter', ('cache', 'result'), lambda: [
+    pair
+    for name, cache in (('admins', admin_cache), ('subjects', subject_cache), ('books', book_cache))
+    for pair in (((name, 'hit'), cache.hits), ((name, 'miss'), cache.misses))
+])
+CallbackMetric('library_db_replica_lag_seconds', "Measured replica replay lag", 'gauge', (),
+               lambda: [((), replica.lag)] if replica.lag is not None else [])
+CallbackMetric('library_db_replica_healthy', "1 while reads are routed to the replica", 'gauge', (),
+               lambda: [((), int(replica.healthy))] if DATABASE_REPLICA_URL else [])
+CallbackMetric('library_cache_evictions_total', "Book cache LRU evictions", 'counter', (),
+               lambda: [((), book_cache.evictions)])
+CallbackMetric('library_db_notifications_total', "LISTEN/NOTIFY messages received", 'counter', (),
+               lambda: [((), db_listener.received)] if db_listener is not None else [])
+
+async def open_db():
+    """باز کردن استخر اتصال و آماده‌سازی جداول (فقط بار اول)"""
+    global db_pool
+    if db_pool is not None:
+        return
+    db_pool = DBPool(DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_HEALTHCHECK_INTERVAL)
+    await db_pool.open()
+    await init_db()
+
+async def on_startup(application: Application) -> None:
+    """باز کردن استخر اتصال و آماده‌سازی جداول پیش از دریافت اولین آپدیت"""
+    # persistence ممکن است زودتر (هنگام initialize) استخر را باز کرده باشد
+    await open_db()
+    if DATABASE_REPLICA_URL and replica.pool is None:
+        await replica.open(DATABASE_REPLICA_URL)
+    global db_listener
+    db_listener = DBListener(DATABASE_URL, LISTEN_RETRY_INTERVAL)
+    db_listener.subscribe('subject_stats', subject_cache.invalidate)
+    db_listener.subscribe('books_changed', book_cache.on_notify)
+    db_listener.subscribe('books_changed', catalog_index.on_notify)
+    await db_listener.start()
+    # ساخت ایندکس پس از LISTEN؛ تغییری که در حین ساخت برسد بعد از آن اعمال می‌شود
+    catalog_index.start()
+    if application is not None:
+        notifier.start(application.bot)
+        schedule_jobs(application)
+
+async def on_stop(application: Application) -> None:
+    """ارسال پیام‌های مانده در صف پیش از بسته شدن اتصال ربات"""
+    await notifier.stop()
+
+async def on_shutdown(application: Application) -> None:
+    """بستن تمیز اتصال‌های دیتابیس هنگام توقف ربات"""
+    global db_pool, db_listener
+    await catalog_index.stop()
+    await replica.close()
+    if db_listener is not None:
+        await db_listener.stop()
+        db_listener = None
+    if db_pool is not None:
+        await db_pool.close()
+        db_pool = None
+
+# --- عملیات امانت (اتمیک) ---
+# هر عملیات یک دستور واحد است که بررسی موجودی و تغییر شمارنده را در یک رفت‌وبرگشت
+# و یک تراکنش انجام می‌دهد؛ شرط موجودی داخل خود UPDATE است تا دو تأیید همزمان
+# نتوانند موجودی را منفی کنند.
+
+async def request_loan(user_id, bid):
+    """ثبت درخواست امانت؛ (عنوان، موجودی، تکراری، شماره درخواست) یا None اگر کتاب نباشد"""
+    res = await db_write("""
+        WITH b AS (
+            SELECT id, title, count - COALESCE(borrowed_count, 0) AS avail FROM books WHERE id = %(bid)s
+        ), dup AS (
+            SELECT 1 FROM loans
+            WHERE user_id = %(uid)s AND book_id = %(bid)s AND status IN ('PENDING', 'APPROVED')
+        ), ins AS (
+            INSERT INTO loans (book_id, user_id, status)
+            SELECT id, %(uid)s, 'PENDING' FROM b WHERE avail > 0 AND NOT EXISTS (SELECT 1 FROM dup)
+            RETURNING id
+        ), unq AS (
+            DELETE FROM waitlist WHERE book_id = %(bid)s AND user_id = %(uid)s AND EXISTS (SELECT 1 FROM ins)
+        )
+        SELECT b.title, b.avail, EXISTS (SELECT 1 FROM dup), (SELECT id FROM ins) FROM b
+    """, {'bid': bid, 'uid': user_id})
+    return res[0] if res else None
+
+async def approve_loan(lid):
+    """تأیید درخواست در صورت وجود موجودی؛ (کاربر، عنوان، تأیید شد؟) یا None اگر درخواست منتظر نباشد"""
+    res = await db_write("""
+        WITH l AS (
+            SELECT id, book_id, user_id FROM loans WHERE id = %(lid)s AND status = 'PENDING' FOR UPDATE
+        ), b AS (
+            UPDATE books SET borrowed_count = COALESCE(books.borrowed_count, 0) + 1
+            FROM l
+            WHERE books.id = l.book_id AND books.count - COALESCE(books.borrowed_count, 0) > 0
+            RETURNING books.id
+        ), a AS (
+            UPDATE loans SET status = 'APPROVED', decided_at = CURRENT_TIMESTAMP,
+                             due_date = CURRENT_TIMESTAMP + make_interval(days => %(period)s)
+            FROM b WHERE loans.id = %(lid)s RETURNING loans.id
+        )
+        SELECT l.user_id, (SELECT title FROM books WHERE id = l.book_id), EXISTS (SELECT 1 FROM a), l.book_id FROM l
+    """, {'lid': lid, 'period': LOAN_PERIOD_DAYS})
+    if not res:
+        return None
+    if res[0][2]:
+        book_cache.invalidate(res[0][3])
+    return res[0][:3]
+
+async def reject_loan(lid):
+    """رد درخواست منتظر؛ شناسه کاربر درخواست‌دهنده یا None"""
+    res = await db_write(
+        "UPDATE loans SET status = 'REJECTED', decided_at = CURRENT_TIMESTAMP WHERE id = %s AND status = 'PENDING' RETURNING user_id",
+        (lid,))
+    return res[0][0] if res else None
+
+def _promote_waitlist(cursor, bid):
+    """تبدیل سر صف انتظار به درخواست PENDING به تعداد نسخه‌های آزاد؛ لیست (شماره درخواست، کاربر، عنوان)
+
+    در همان تراکنشی اجرا می‌شود که نسخه را آزاد کرده است. نسخه‌هایی که درخواست منتظر دارند
+    آزاد حساب نمی‌شوند و SKIP LOCKED نمی‌گذارد دو بازگشت همزمان یک نفر را دو بار جلو بیندازند.
+    """
+    cursor.execute("""
+        WITH slots AS (
+            SELECT b.title, GREATEST(b.count - COALESCE(b.borrowed_count, 0)
+                   - (SELECT count(*) FROM loans WHERE book_id = b.id AND status = 'PENDING'), 0) AS n
+            FROM books b WHERE b.id = %(bid)s
+        ), head AS (
+            SELECT w.id, w.user_id FROM waitlist w
+            WHERE w.book_id = %(bid)s
+              AND NOT EXISTS (
+                  SELECT 1 FROM loans l
+                  WHERE l.user_id = w.user_id AND l.book_id = %(bid)s AND l.status IN ('PENDING', 'APPROVED')
+              )
+            ORDER BY w.id
+            LIMIT COALESCE((SELECT n FROM slots), 0)
+            FOR UPDATE OF w SKIP LOCKED
+        ), gone AS (
+            DELETE FROM waitlist USING head WHERE waitlist.id = head.id
+        ), ins AS (
+            INSERT INTO loans (book_id, user_id, status)
+            SELECT %(bid)s, user_id, 'PENDING' FROM head ORDER BY id
+            RETURNING id, user_id
+        )
+        SELECT ins.id, ins.user_id, slots.title FROM ins, slots ORDER BY ins.id
+    """, {'bid': bid})
+    return cursor.fetchall()
+
+async def announce_promotions(promoted):
+    """خبر آزاد شدن نسخه به کاربرانی که از صف انتظار جلو آمدند و خبر درخواست جدید به ادمین‌ها"""
+    if not promoted:
+        return
+    admins = await get_admin_user_ids()
+    for lid, uid, title in promoted:
+        notifier.notify(uid, f"🎉 نسخه‌ای از «{title}» آزاد شد و درخواست امانت شما (شماره {lid}) خودکار ثبت شد. منتظر تایید ادمین باشید.")
+        for admin in admins:
+            notifier.notify(admin, f"🚨 درخواست جدید (از صف انتظار)!\nکتاب: {title}\nکاربر: {uid}\nشماره درخواست: {lid}")
+
+def _return_and_promote(conn, lid, user_id):
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            WITH r AS (
+                UPDATE loans SET status = 'RETURNED', return_date = CURRENT_TIMESTAMP
+                WHERE id = %(lid)s AND user_id = %(uid)s AND status = 'APPROVED'
+                RETURNING book_id
+            ), b AS (
+                UPDATE books SET borrowed_count = GREATEST(books.borrowed_count - 1, 0) FROM r WHERE books.id = r.book_id
+            )
+            SELECT book_id FROM r
+        """, {'lid': lid, 'uid': user_id})
+        row = cursor.fetchone()
+        if row is None:
+            return None, []
+        return row[0], _promote_waitlist(cursor, row[0])
+
+async def return_loan(lid, user_id):
+    """بازگرداندن امانت تأییدشده همین کاربر و جلو آوردن صف انتظار؛ شناسه کتاب یا None
+
+    خطای دیتابیس (psycopg2.Error یا PoolTimeout) به فراخواننده می‌رسد تا از «امانت نامعتبر» جدا باشد.
+    """
+    replica.touch(user_id)
+    bid, promoted = await db_pool.run(_return_and_promote, lid, user_id)
+    if bid is None:
+        return None
+    book_cache.invalidate(bid)
+    await announce_promotions(promoted)
+    return bid
+
+def _set_count_and_promote(conn, bid, cnt):
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            WITH u AS (
+                UPDATE books SET count = %(cnt)s WHERE id = %(bid)s AND COALESCE(borrowed_count, 0) <= %(cnt)s
+                RETURNING id
+            )
+            SELECT COALESCE(borrowed_count, 0), EXISTS (SELECT 1 FROM u) FROM books WHERE id = %(bid)s
+        """, {'bid': bid, 'cnt': cnt})
+        row = cursor.fetchone()
+        if row is None or not row[1]:
+            return row, []
+        return row, _promote_waitlist(cursor, bid)
+
+async def set_book_count(bid, cnt):
+    """تغییر موجودی به شرطی که از تعداد امانت‌ها کمتر نشود؛ (تعداد امانت، انجام شد؟) یا None"""
+    try:
+        res, promoted = await db_pool.run(_set_count_and_promote, bid, cnt)
+    except (psycopg2.Error, PoolTimeout) as e:
+        logger.error(f"خطای دیتابیس: {e}")
+        return None
+    finally:
+        # خطای شبکه ممکن است پس از commit رسیده باشد
+        book_cache.invalidate(bid)
+    await announce_promotions(promoted)
+    return res
+
+async def join_waitlist(user_id, bid):
+    """ورود به صف انتظار کتاب ناموجود؛ (عنوان، موجودی، تکراری، نوبت) یا None اگر کتاب نباشد"""
+    res = await db_write("""
+        WITH b AS (
+            SELECT id, title, count - COALESCE(borrowed_count, 0) AS avail FROM books WHERE id = %(bid)s
+        ), dup AS (
+            SELECT 1 FROM loans
+            WHERE user_id = %(uid)s AND book_id = %(bid)s AND status IN ('PENDING', 'APPROVED')
+        ), mine AS (
+            SELECT id FROM waitlist WHERE book_id = %(bid)s AND user_id = %(uid)s
+        ), ins AS (
+            INSERT INTO waitlist (book_id, user_id)
+            SELECT id, %(uid)s FROM b WHERE avail <= 0 AND NOT EXISTS (SELECT 1 FROM dup)
+            ON CONFLICT (book_id, user_id) DO NOTHING
+            RETURNING id
+        )
+        SELECT b.title, b.avail, EXISTS (SELECT 1 FROM dup),
+               (SELECT count(*) FROM waitlist w
+                WHERE w.book_id = b.id AND (NOT EXISTS (SELECT 1 FROM mine) OR w.id <= (SELECT id FROM mine)))
+               + (SELECT count(*) FROM ins)
+        FROM b
+    """, {'bid': bid, 'uid': user_id})
+    return res[0] if res else None
+
+async def apply_loan_batch(lids, approve=True, reject_rest=False):
+    """اعمال گروهی در یک تراکنش؛ لیست (وضعیت جدید، شماره درخواست، کاربر، عنوان کتاب)
+
+    در حالت تأیید، درخواست‌های هر کتاب به ترتیب ثبت تا تمام شدن موجودی تأیید می‌شوند و
+    باقی‌مانده یا منتظر می‌مانند یا (با reject_rest) رد می‌شوند.
+    """
+    rows = await db_write("""
+        WITH req AS (
+            SELECT id, book_id, user_id FROM loans
+            WHERE id = ANY(%(ids)s) AND status = 'PENDING'
+            ORDER BY id FOR UPDATE
+        ), stock AS (
+            SELECT id, count - COALESCE(borrowed_count, 0) AS avail FROM books
+            WHERE id IN (SELECT book_id FROM req) FOR UPDATE
+        ), ranked AS (
+            SELECT req.id, req.book_id,
+                   row_number() OVER (PARTITION BY req.book_id ORDER BY req.id) <= stock.avail AS fits
+            FROM req JOIN stock ON stock.id = req.book_id
+        ), ok AS (
+            UPDATE loans SET status = 'APPROVED', decided_at = CURRENT_TIMESTAMP,
+                             due_date = CURRENT_TIMESTAMP + make_interval(days => %(period)s)
+            FROM ranked
+            WHERE %(approve)s AND loans.id = ranked.id AND ranked.fits
+            RETURNING loans.id, loans.book_id, loans.user_id
+        ), bump AS (
+            UPDATE books SET borrowed_count = COALESCE(books.borrowed_count, 0) + c.n
+            FROM (SELECT book_id, count(*) AS n FROM ok GROUP BY book_id) c
+            WHERE books.id = c.book_id
+        ), rej AS (
+            UPDATE loans SET status = 'REJECTED', decided_at = CURRENT_TIMESTAMP FROM ranked
+            WHERE loans.id = ranked.id AND (NOT %(approve)s OR (%(reject_rest)s AND NOT ranked.fits))
+            RETURNING loans.id, loans.book_id, loans.user_id
+        )
+        SELECT 'APPROVED', ok.id, ok.user_id, b.title, b.id FROM ok JOIN books b ON b.id = ok.book_id
+        UNION ALL
+        SELECT 'REJECTED', rej.id, rej.user_id, b.title, b.id FROM rej JOIN books b ON b.id = rej.book_id
+    """, {'ids': list(lids), 'approve': approve, 'reject_rest': reject_rest, 'period': LOAN_PERIOD_DAYS}) or []
+    for r in rows:
+        if r[0] == 'APPROVED':
+            book_cache.invalidate(r[4])
+    return [r[:4] for r in rows]
+
+def loan_batch_summary(lids, results):
+    approved = sum(1 for r in results if r[0] == 'APPROVED')
+    rejected = len(results) - approved
+    return f"✅ تأیید: {approved}\n❌ رد: {rejected}\n⏸ بدون تغییر: {len(lids) - len(results)}"
+
+def notify_loan_decisions(results):
+    """یک پیام خلاصه برای هر درخواست‌دهنده به جای یک پیام برای هر درخواست"""
+    by_user = defaultdict(list)
+    for status, lid, uid, title in results:
+        by_user[uid].append(f"{'✅' if status == 'APPROVED' else '❌'} {title} (شماره {lid})")
+    for uid, lines in by_user.items():
+        notifier.notify(uid, "📬 نتیجه درخواست‌های امانت شما:\n" + "\n".join(lines))
+
+def parse_id_list(text):
+    """«12, 15-20 30» به لیست شناسه‌ها؛ None اگر قابل خواندن نباشد"""
+    ids = []
+    for part in re.split(r'[,،\s]+', text.strip()):
+        if not part:
+            continue
+        m = re.fullmatch(r'(\d+)(?:-(\d+))?', part)
+        if not m:
+            return None
+        lo, hi = int(m.group(1)), int(m.group(2) or m.group(1))
+        if hi < lo or hi - lo > 1000:
+            return None
+        ids.extend(range(lo, hi + 1))
+    return sorted(set(ids))[:5000] or None
+
+# --- یادآوری امانت‌های سررسیدگذشته ---
+# یک job دوره‌ای همه امانت‌های گذشته از موعد را با یک کوئری روی ایندکس جزئی loans_overdue
+# پیدا و در همان دستور علامت‌گذاری می‌کند؛ هر کاربر حداکثر روزی یک پیام می‌گیرد که همه
+# امانت‌های دیرکردش را دارد و پیام‌ها از صف محدود notifier ارسال می‌شوند.
+
+REMINDER_LOCK_ID = 7310022  # کلید advisory lock تا در هر لحظه فقط یک نمونه یادآوری بفرستد
+
+def _collect_overdue(conn, limit):
+    """علامت‌گذاری امانت‌های دیرکرد کاربرانی که امروز یادآوری نگرفته‌اند؛ None اگر نمونه دیگری مشغول باشد"""
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_xact_lock(%s)", (REMINDER_LOCK_ID,))
+        if not cursor.fetchone()[0]:
+            return None
+        cursor.execute("""
+            WITH picked AS (
+                SELECT l.user_id FROM loans l
+                WHERE l.status = 'APPROVED' AND l.due_date < CURRENT_TIMESTAMP
+                  -- NOT IN با hashed subplan؛ NOT EXISTS روی پارتیشن داغ کوچک با آمار کهنه پس از
+                  -- علامت‌گذاری‌های همین job به nested loop درجه دو می‌رسید (user_id هرگز NULL نیست)
+                  AND l.user_id NOT IN (
+                      SELECT r.user_id FROM loans r
+                      WHERE r.status = 'APPROVED' AND r.last_reminded_at > CURRENT_TIMESTAMP - interval '1 day'
+                  )
+                ORDER BY l.due_date
+                LIMIT %s
+            ), due AS (
+                -- همه دیرکردهای کاربران انتخاب‌شده تا هیچ امانتی به یادآوری فردا نیفتد
+                SELECT l.id FROM loans l
+                WHERE l.user_id IN (SELECT user_id FROM picked)
+                  AND l.status = 'APPROVED' AND l.due_date < CURRENT_TIMESTAMP
+                FOR UPDATE OF l SKIP LOCKED
+            ), m AS (
+                UPDATE loans SET last_reminded_at = CURRENT_TIMESTAMP FROM due WHERE loans.id = due.id
+                RETURNING loans.id, loans.user_id, loans.book_id, loans.due_date
+            )
+            SELECT m.user_id, m.id, b.title, CURRENT_DATE - m.due_date::date
+            FROM m JOIN books b ON b.id = m.book_id
+            ORDER BY m.user_id, m.due_date
+        """, (limit,))
+        return cursor.fetchall()
+
+async def send_overdue_reminders(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """job دوره‌ای: یک پیام برای هر کاربر با فهرست امانت‌های دیرکردش"""
+    rows = await db_pool.run(_collect_overdue, REMINDER_BATCH)
+    if not rows:
+        return
+    by_user = defaultdict(list)
+    for uid, lid, title, days in rows:
+        by_user[uid].append((lid, f"- {title} (شماره {lid}) — {max(days, 1)} روز دیرکرد"))
+    unsent = []
+    for uid, loans in by_user.items():
+        text = "⏰ مهلت امانت‌های زیر گذشته است؛ لطفاً هرچه زودتر بازگردانید:\n" + "\n".join(line for _, line in loans)
+        if not notifier.notify(uid, text):
+            unsent.extend(lid for lid, _ in loans)
+    if unsent:
+        # پیامی که در صف جا نشد در اجرای بعدی دوباره فرستاده می‌شود
+        await db_write("UPDATE loans SET last_reminded_at = NULL WHERE id = ANY(%s)", (unsent,))
+    logger.info(f"یادآوری دیرکرد: {len(rows)} امانت، {len(by_user)} کاربر، {len(unsent)} ارسال‌نشده")
+
+async def send_admin_digest(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """job روزانه: خلاصه امانت‌های دیرکرد و درخواست‌های منتظر برای هر ادمین"""
+    admins = await get_admin_user_ids()
+    if not admins:
+        return
+    totals = await db_read("""
+        SELECT count(*) FILTER (WHERE status = 'APPROVED' AND due_date < CURRENT_TIMESTAMP),
+               count(DISTINCT user_id) FILTER (WHERE status = 'APPROVED' AND due_date < CURRENT_TIMESTAMP),
+               count(*) FILTER (WHERE status = 'APPROVED'),
+               count(*) FILTER (WHERE status = 'PENDING')
+        FROM loans WHERE status IN ('PENDING', 'APPROVED')
     """)
+    if totals is None:
+        logger.error("گزارش روزانه ادمین‌ها به دلیل خطای دیتابیس فرستاده نشد.")
+        return
+    overdue, overdue_users, active, pending = totals[0]
+    worst = await db_read("""
+        SELECT l.id, l.user_id, b.title, CURRENT_DATE - l.due_date::date
+        FROM loans l JOIN books b ON b.id = l.book_id
+        WHERE l.status = 'APPROVED' AND l.due_date < CURRENT_TIMESTAMP
+        ORDER BY l.due_date LIMIT 10
+    """) or []
+    text = (
+        "📊 گزارش روزانه کتابخانه\n"
+        f"📚 امانت‌های فعال: {active}\n"
+        f"⏰ دیرکرد: {overdue} امانت از {overdue_users} کاربر\n"
+        f"⏳ درخواست‌های منتظر تأیید: {pending}"
+    )
+    if worst:
+        text += "\n\nبیشترین دیرکرد:\n" + "\n".join(
+            f"- {title} (شماره {lid}، کاربر {uid}) — {days} روز" for lid, uid, title, days in worst
+        )
+    for admin_id in admins:
+        notifier.notify(admin_id, text)
+
+def schedule_jobs(application: Application) -> None:
+    """ثبت jobهای یادآوری، گزارش روزانه و جمع‌بندی آمار روی job queue"""
+    if WORKER_INDEX:
+        return  # در حالت چندپردازه‌ای فقط worker صفر؛ وگرنه گزارش روزانه چند بار فرستاده می‌شود
+    if application.job_queue is None:
+        logger.warning("job queue در دسترس نیست (python-telegram-bot[job-queue])؛ یادآوری دیرکرد و گزارش روزانه غیرفعال است و آمار فقط هنگام /stats جمع‌بندی می‌شود.")
+        return
+    hour, minute = (int(x) for x in DIGEST_TIME.split(':'))
+    application.job_queue.run_repeating(send_overdue_reminders, interval=REMINDER_INTERVAL, first=60, name='overdue_reminders')
+    application.job_queue.run_daily(
+        send_admin_digest, datetime.time(hour, minute, tzinfo=zoneinfo.ZoneInfo(BOT_TIMEZONE)), name='admin_digest'
+    )
+    application.job_queue.run_repeating(flush_stats, interval=STATS_FLUSH_INTERVAL, first=STATS_FLUSH_INTERVAL, name='stats_flush')
+    application.job_queue.run_repeating(archive_loans, interval=LOAN_ARCHIVE_INTERVAL, first=300, name='loan_archive')
+
+# --- بایگانی امانت‌های بسته‌شده ---
+# loans بر اساس ستون archived دو پارتیشن دارد: loans_hot با امانت‌های جاری و تازه بسته‌شده، و
+# loans_archive با تاریخچه. بستن امانت ردیف را جابه‌جا نمی‌کند؛ این job امانت‌هایی را که
+# LOAN_ARCHIVE_AFTER_DAYS از بسته شدنشان گذشته در تراکنش‌های کوچک منتقل می‌کند تا heap و
+# ایندکس‌های مسیرهای پرتکرار با بزرگ شدن تاریخچه بزرگ نشوند. کوئری‌ها همچنان از loans می‌خوانند.
+
+ARCHIVE_LOCK_ID = 7310024  # کلید advisory lock تا در هر لحظه فقط یک نمونه بایگانی کند
+
+def _archive_batch(conn, after_days, batch):
+    """انتقال یک دسته از قدیمی‌ترین امانت‌های بسته‌شده به بایگانی؛ تعداد یا None اگر نمونه دیگری مشغول باشد"""
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_xact_lock(%s)", (ARCHIVE_LOCK_ID,))
+        if not cursor.fetchone()[0]:
+            return None
+        # UPDATE ستون کلید پارتیشن، ردیف را به loans_archive منتقل می‌کند
+        cursor.execute("""
+            WITH picked AS (
+                SELECT id FROM loans
+                WHERE NOT archived AND status IN ('RETURNED', 'REJECTED')
+                  AND COALESCE(return_date, decided_at, borrow_date) < CURRENT_TIMESTAMP - make_interval(days => %s)
+                ORDER BY COALESCE(return_date, decided_at, borrow_date)
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            UPDATE loans SET archived = true FROM picked WHERE loans.id = picked.id AND NOT loans.archived
+        """, (after_days, batch))
+        return cursor.rowcount
+
+async def archive_loans(context: ContextTypes.DEFAULT_TYPE = None, after_days=None, batch=None):
+    """job دوره‌ای: انتقال دسته‌ای امانت‌های بسته‌شده قدیمی؛ تعداد کل منتقل‌شده"""
+    after_days = LOAN_ARCHIVE_AFTER_DAYS if after_days is None else after_days
+    batch = batch or LOAN_ARCHIVE_BATCH
+    moved = 0
+    while True:
+        n = await db_pool.run(_archive_batch, after_days, batch)
+        if n is None:
+            break
+        moved += n
+        loans_archived.inc(n=n)
+        if n < batch:
+            break
+    if moved:
+        logger.info(f"بایگانی امانت‌ها: {moved} امانت بسته‌شده به loans_archive منتقل شد")
+    return moved
+
+# --- آمار امانت‌ها ---
+# trigger سطح دستور روی loans تغییر هر وضعیت را در loan_stats_delta صف می‌کند و flush_stats آن را در
+# جدول‌های loan_stats_* جمع می‌کند؛ /stats فقط پنجره STATS_DAYS روزه و ده ردیف اول ایندکس‌های approved
+# را می‌خواند و به اندازه تاریخچه وابسته نیست.
+
+STATS_COMPLETE = 2147483647  # done_upto پس از پایان backfill؛ از آن پس trigger همه امانت‌ها را می‌شمارد
+_stats_backfill_task = None
+
+def _stats_reset(conn):
+    """خالی کردن جدول‌های آمار تا backfill همه‌چیز را از نو بسازد"""
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", (STATS_LOCK_ID,))
+        cursor.execute("""
+            TRUNCATE loan_stats_daily, loan_stats_book_daily, loan_stats_subject_daily, loan_stats_book,
+                     loan_stats_user, loan_stats_delta
+        """)
+        cursor.execute("UPDATE loan_stats_progress SET done_upto = 0")
+
+def _stats_backfill_batch(conn, batch):
+    """افزودن دسته بعدی امانت‌های شمرده‌نشده به آمار؛ (تا شناسه، بیشینه شناسه، تمام شد؟)
+
+    قفل انحصاری فقط تا پایان همین دسته ثبت آمار تغییرات loans را نگه می‌دارد.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", (STATS_LOCK_ID,))
+        cursor.execute("SELECT done_upto, (SELECT max(id) FROM loans) FROM loan_stats_progress")
+        done, last = cursor.fetchone()
+        if done >= STATS_COMPLETE:
+            return done, last, True
+        upto = done + batch
+        finished = last is None or upto >= last
+        cursor.execute("""
+            INSERT INTO loan_stats_delta
+            SELECT * FROM loan_stats_events(ARRAY(SELECT l FROM loans l WHERE l.id > %s AND l.id <= %s), '{}')
+        """, (done, upto))
+        cursor.execute("SELECT loan_stats_flush()")
+        cursor.execute("UPDATE loan_stats_progress SET done_upto = %s", (STATS_COMPLETE if finished else upto,))
+        return upto, last, finished
+
+async def backfill_stats(rebuild=False, batch=STATS_BACKFILL_BATCH):
+    """ساخت آمار از روی امانت‌های موجود به صورت دسته‌ای؛ تعداد دسته‌ها"""
+    if rebuild:
+        await db_pool.run(_stats_reset)
+    batches = 0
+    while True:
+        upto, last, finished = await db_pool.run(_stats_backfill_batch, batch)
+        batches += 1
+        if finished:
+            return batches
+        logger.info(f"backfill آمار: تا امانت {upto} از {last}")
+
+async def flush_stats(context: ContextTypes.DEFAULT_TYPE = None) -> None:
+    """job دوره‌ای: جمع کردن تغییرات صف‌شده در جدول‌های آمار"""
+    await db_write("SELECT loan_stats_flush()")
+
+def _load_stats(conn, days):
+    with conn.cursor() as cursor:
+        # تغییرات از آخرین flush هم دیده شوند؛ حجمشان به فاصله job محدود است
+        cursor.execute("SELECT loan_stats_flush()")
+        cursor.execute("""
+            SELECT day, requested, approved, rejected, returned, decided, decision_seconds
+            FROM loan_stats_daily WHERE day > CURRENT_DATE - %s ORDER BY day
+        """, (days,))
+        daily = cursor.fetchall()
+        cursor.execute("""
+            SELECT s.book_id, b.title, s.approved FROM loan_stats_book s LEFT JOIN books b ON b.id = s.book_id
+            ORDER BY s.approved DESC LIMIT 10
+        """)
+        books = cursor.fetchall()
+        cursor.execute("""
+            SELECT subject, sum(approved) FROM loan_stats_subject_daily WHERE day > CURRENT_DATE - %s
+            GROUP BY subject HAVING sum(approved) > 0 ORDER BY 2 DESC LIMIT 5
+        """, (days,))
+        subjects = cursor.fetchall()
+        cursor.execute("SELECT user_id, approved FROM loan_stats_user ORDER BY approved DESC LIMIT 10")
+        users = cursor.fetchall()
+        cursor.execute("SELECT done_upto >= %s FROM loan_stats_progress", (STATS_COMPLETE,))
+        complete = cursor.fetchone()[0]
+    return daily, books, subjects, users, complete
+
+def format_stats(daily, books, subjects, users, complete, days=STATS_DAYS):
+    totals = [sum(r[i] for r in daily) for i in range(1, 7)]
+    requested, approved, rejected, returned, decided, seconds = totals
+    text = (
+        f"📈 آمار امانت ({days} روز اخیر)\n"
+        f"📝 درخواست: {requested}  ✅ تأیید: {approved}  ❌ رد: {rejected}  ↩️ بازگشت: {returned}"
+    )
+    if decided:
+        text += f"\n⏱ میانگین زمان بررسی درخواست: {seconds / decided / 3600:.1f} ساعت"
+    if books:
+        text += "\n\n🏆 پرامانت‌ترین کتاب‌ها:\n" + "\n".join(
+            f"{i}. {title or f'کتاب حذف‌شده {bid}'} — {n}" for i, (bid, title, n) in enumerate(books, 1))
+    if subjects:
+        text += f"\n\n🏷️ موضوع‌های پرطرفدار ({days} روز):\n" + "\n".join(
+            f"- {subject or 'بدون موضوع'}: {n}" for subject, n in subjects)
+    if users:
+        text += "\n\n👤 فعال‌ترین کاربران:\n" + "\n".join(f"{i}. {uid} — {n}" for i, (uid, n) in enumerate(users, 1))
+    if not complete:
+        text += "\n\n⚠️ امانت‌های قدیمی هنوز در آمار نیامده‌اند؛ /stats_backfill را اجرا کنید."
+    return text
+
+def render_stats_chart(daily):
+    """نمودار PNG حجم روزانه امانت؛ اگر matplotlib نصب نباشد ImportError"""
+    import matplotlib  # اختیاری؛ فقط برای تصویر /stats لازم است
+    matplotlib.use('Agg')
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=(8, 4), dpi=100)
+    ax = fig.subplots()
+    days = [r[0] for r in daily]
+    # برچسب‌ها لاتین‌اند؛ matplotlib حروف فارسی را بدون reshaper جدا از هم رسم می‌کند
+    for i, label in ((1, 'requested'), (2, 'approved'), (4, 'returned')):
+        ax.plot(days, [r[i] for r in daily], marker='.', label=label)
+    ax.set_title('Daily loans')
+    ax.legend()
+    ax.grid(alpha=0.3)
+    fig.autofmt_xdate()
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png')
+    buf.seek(0)
+    return buf
+
+# --- ذخیره وضعیت مکالمه‌ها در PostgreSQL ---
+
+class PostgresPersistence(BasePersistence):
+    """نگه‌داری user_data و وضعیت ConversationHandlerها در جدول bot_persistence
+
+    Application هر update_interval ثانیه (و هنگام خاموشی) update_* را صدا می‌زند؛ اینجا فقط
+    ورودی‌هایی که واقعاً تغییر کرده‌اند در حافظه جمع می‌شوند و همه با یک upsert دسته‌ای
+    نوشته می‌شوند. مسیر پردازش هر آپدیت به دیتابیس دست نمی‌زند.
+    """
+
+    def __init__(self, update_interval):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.writes = 0
+        self.skipped = 0
+        self._saved = {}  # (kind, key) -> json آخرین نسخه نوشته‌شده
+        self._dirty = {}  # (kind, key) -> json، یا None برای حذف
+        self._flush_task = None
+
+    async def _load(self, kind):
+        await open_db()
+        rows = await db_read("SELECT kind, key, data::text FROM bot_persistence WHERE kind = %s", (kind,), fresh=True)
+        if rows is None:
+            raise RuntimeError("خواندن وضعیت ذخیره‌شده از دیتابیس ممکن نشد.")
+        for kind, key, data in rows:
+            self._saved[(kind, key)] = data
+        return rows
+
+    def _mark(self, kind, key, data):
+        serialized = None if data is None else json.dumps(data, ensure_ascii=False, sort_keys=True, default=str)
+        if self._dirty.get((kind, key), self._saved.get((kind, key))) == serialized:
+            self.skipped += 1
+            return
+        self._dirty[(kind, key)] = serialized
+        if self._flush_task is None:
+            # همه update_*های یک دور در یک گام event loop می‌آیند؛ flush بعد از همه‌شان اجرا می‌شود
+            self._flush_task = asyncio.create_task(self._flush_dirty())
+
+    async def _flush_dirty(self):
+        await asyncio.sleep(0)
+        batch, self._dirty = self._dirty, {}
+        self._flush_task = None
+        if not batch:
+            return
+        try:
+            await db_pool.run(self._write_batch, batch)
+        except (psycopg2.Error, PoolTimeout) as e:
+            logger.error(f"ذخیره وضعیت مکالمه‌ها ناموفق بود؛ دور بعد دوباره تلاش می‌شود: {e}")
+            for k, v in batch.items():
+                self._dirty.setdefault(k, v)
+            return
+        self.writes += len(batch)
+        for k, v in batch.items():
+            if v is None:
+                self._saved.pop(k, None)
+            else:
+                self._saved[k] = v
+
+    @staticmethod
+    def _write_batch(conn, batch):
+        upserts = [(kind, key, data) for (kind, key), data in batch.items() if data is not None]
+        deletes = [(kind, key) for (kind, key), data in batch.items() if data is None]
+        with conn.cursor() as cursor:
+            if upserts:
+                psycopg2.extras.execute_values(cursor, """
+                    INSERT INTO bot_persistence (kind, key, data) VALUES %s
+                    ON CONFLICT (kind, key) DO UPDATE SET data = EXCLUDED.data, updated_at = CURRENT_TIMESTAMP
+                """, upserts, template="(%s, %s, %s::jsonb)")
+            if deletes:
+                psycopg2.extras.execute_values(cursor, """
+                    DELETE FROM bot_persistence p USING (VALUES %s) AS d(kind, key)
+                    WHERE p.kind = d.kind AND p.key = d.key
+                """, deletes)
+
+    async def get_user_data(self):
+        rows = await self._load('user')
+        return {int(key): json.loads(data) for _, key, data in rows}
+
+    async def update_user_data(self, user_id, data):
+        self._mark('user', str(user_id), data)
+
+    async def drop_user_data(self, user_id):
+        self._mark('user', str(user_id), None)
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def get_conversations(self, name):
+        rows = await self._load(f'conv:{name}')
+        return {tuple(json.loads(key)): json.loads(data) for _, key, data in rows}
+
+    async def update_conversation(self, name, key, new_state):
+        self._mark(f'conv:{name}', json.dumps(list(key)), new_state)
+
+    async def flush(self):
+        if self._flush_task is not None:
+            await self._flush_task
+        if self._dirty:
+            await self._flush_dirty()
 
-    # افزودن ستون 'status' اگر وجود نداشته باشد (Migration)
-    try:
-        db_query("ALTER TABLE loans ADD COLUMN IF NOT EXISTS status TEXT DEFAULT 'PENDING'")
-    except Exception as e:
-        pass # ستون احتمالا وجود دارد
-        
-def is_admin(user_id):
-    query = "SELECT 1 FROM admins WHERE user_id = %s"
-    result = db_query(query, (user_id,))
-    return bool(result)
+    # داده‌های ربات و چت ذخیره نمی‌شوند (store_data)
+    async def get_chat_data(self):
+        return {}
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def get_bot_data(self):
+        return {}
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
 
-def get_admin_user_ids():
-    results = db_query("SELECT user_id FROM admins")
-    return [r[0] for r in results] if results else []
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data):
+        pass
 
 # --- Handlers عمومی ---
 
-def get_keyboard(user_id):
-    if is_admin(user_id):
+async def get_keyboard(user_id):
+    if await is_admin(user_id):
         return ReplyKeyboardMarkup([
             ['📚 افزودن کتاب', '🔍 جستجوی کتاب'],
             ['✏️ ویرایش موجودی', '🗑️ حذف کتاب'], 
@@ -167,28 +2630,91 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     welcome_text = f"سلام {first_name}، به ربات کتابخانه خوش آمدید!\n"
     
-    # ادمین کردن اولین کاربر
-    if not is_admin(user_id) and not db_query("SELECT 1 FROM admins LIMIT 1"):
-        db_query("INSERT INTO admins (user_id) VALUES (%s)", (user_id,))
+    admins = await admin_cache.get()
+    # ادمین کردن اولین کاربر (پیش از تصمیم، خالی بودن جدول را از خود دیتابیس دوباره می‌پرسیم)
+    if not admins and not await admin_cache.get(refresh=True):
+        await db_write("INSERT INTO admins (user_id) VALUES (%s) ON CONFLICT DO NOTHING", (user_id,))
+        admin_cache.invalidate()
         welcome_text += "شما به عنوان **اولین ادمین** ثبت شدید."
-    elif is_admin(user_id):
+    elif user_id in admins:
         welcome_text += "شما به پنل ادمین دسترسی دارید."
 
-    await update.message.reply_text(welcome_text, reply_markup=get_keyboard(user_id))
+    await update.message.reply_text(welcome_text, reply_markup=await get_keyboard(user_id))
 
 async def add_admin_info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     await update.message.reply_text(f"✅ شناسه شما: `{user_id}`", parse_mode='Markdown')
     
+async def slowlog_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """ارسال کوئری‌های کند اخیر (و پلن‌های گرفته‌شده) به ادمین به صورت فایل"""
+    if not await is_admin(update.effective_user.id):
+        return
+    if not slow_queries:
+        await update.message.reply_text("کوئری کندی ثبت نشده است.")
+        return
+    parts = []
+    for e in reversed(slow_queries):
+        parts.append(f"[{e['at']}] trace={e['trace']} {e['ms']:.0f}ms ({e['timing']})\n{e['query']} {e['params']}")
+        if e['plan']:
+            parts.append(e['plan'])
+        parts.append("-" * 40)
+    doc = io.BytesIO("\n".join(parts).encode('utf-8'))
+    await update.message.reply_document(doc, filename="slowlog.txt", caption=f"🐢 {len(slow_queries)} کوئری کند اخیر")
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """آمار امانت از جدول‌های تجمیعی، با نمودار اگر matplotlib نصب باشد"""
+    if not await is_admin(update.effective_user.id):
+        return
+    try:
+        data = await db_pool.run(_load_stats, STATS_DAYS)
+    except (psycopg2.Error, PoolTimeout) as e:
+        logger.error(f"خطای دیتابیس در آمار: {e}")
+        await update.message.reply_text("⚠️ خطای دیتابیس؛ کمی بعد دوباره تلاش کنید.")
+        return
+    await update.message.reply_text(format_stats(*data))
+    daily = data[0]
+    if not daily:
+        return
+    try:
+        # رسم نمودار CPU می‌خواهد؛ بیرون از event loop
+        chart = await asyncio.get_running_loop().run_in_executor(None, render_stats_chart, daily)
+    except ImportError:
+        return
+    await update.message.reply_photo(chart)
+
+async def stats_backfill_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/stats_backfill امانت‌های قدیمی را به آمار اضافه می‌کند؛ /stats_backfill rebuild از صفر می‌سازد"""
+    global _stats_backfill_task
+    uid = update.effective_user.id
+    if not await is_admin(uid):
+        return
+    if _stats_backfill_task is not None and not _stats_backfill_task.done():
+        await update.message.reply_text("⏳ backfill آمار در حال اجراست.")
+        return
+    rebuild = context.args[:1] == ['rebuild']
+
+    async def run():
+        start = time.perf_counter()
+        try:
+            batches = await backfill_stats(rebuild=rebuild)
+        except Exception as e:
+            logger.error(f"خطای backfill آمار: {e}")
+            notifier.notify(uid, "❌ backfill آمار با خطا متوقف شد؛ اجرای دوباره از همان‌جا ادامه می‌دهد.")
+            return
+        notifier.notify(uid, f"✅ آمار ساخته شد ({batches} دسته، {time.perf_counter() - start:.1f} ثانیه).")
+
+    _stats_backfill_task = context.application.create_task(run())
+    await update.message.reply_text("⏳ ساخت آمار از روی امانت‌های موجود شروع شد؛ پس از پایان خبر می‌دهم.")
+
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data.clear()
-    await update.message.reply_text("❌ عملیات لغو شد.", reply_markup=get_keyboard(update.effective_user.id))
+    await update.message.reply_text("❌ عملیات لغو شد.", reply_markup=await get_keyboard(update.effective_user.id))
     return ConversationHandler.END
 
 # --- Handlers افزودن کتاب ---
 async def add_book_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("شما ادمین نیستید.", reply_markup=get_keyboard(update.effective_user.id))
+    if not await is_admin(update.effective_user.id):
+        await update.message.reply_text("شما ادمین نیستید.", reply_markup=await get_keyboard(update.effective_user.id))
         return ConversationHandler.END
     context.user_data['book_data'] = {}
     await update.message.reply_text("📚 نام کتاب را وارد کنید:", reply_markup=ReplyKeyboardMarkup([['لغو عملیات']], resize_keyboard=True))
@@ -219,10 +2745,10 @@ async def get_count(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         return GET_COUNT
         
     book = context.user_data['book_data']
-    db_query("INSERT INTO books (title, author, subject, count) VALUES (%s, %s, %s, %s)", 
+    await db_write("INSERT INTO books (title, author, subject, count) VALUES (%s, %s, %s, %s)", 
              (book['title'], book['author'], book['subject'], count))
     
-    await update.message.reply_text(f"✅ کتاب **{book['title']}** اضافه شد.", reply_markup=get_keyboard(update.effective_user.id), parse_mode='Markdown')
+    await update.message.reply_text(f"✅ کتاب **{book['title']}** اضافه شد.", reply_markup=await get_keyboard(update.effective_user.id), parse_mode='Markdown')
     context.user_data.clear()
     return ConversationHandler.END
 
@@ -232,26 +2758,17 @@ async def search_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     return SEARCH_QUERY
 
 async def execute_search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    term = f'%{update.message.text}%'
-    results = db_query("""
-        SELECT id, title, author, subject, count, borrowed_count FROM books 
-        WHERE title ILIKE %s OR author ILIKE %s OR subject ILIKE %s LIMIT 10
-    """, (term, term, term))
-    
-    if results:
-        text = f"✅ نتایج برای **'{update.message.text}'**:\n\n"
-        for r in results:
-            avail = r[4] - (r[5] or 0)
-            text += f"📕 **{r[1]}**\n🆔: {r[0]}\n✍️: {r[2]}\n🏷: {r[3]}\n⬅️ موجود: {avail}\n------------------\n"
+    term = update.message.text
+    rows, has_next = await fetch_page('search', term, None)
+    if rows:
+        await send_first_page(update, context, 'search', term, rows, has_next)
     else:
-        text = "❌ موردی یافت نشد."
-        
-    await update.message.reply_text(text, reply_markup=get_keyboard(update.effective_user.id), parse_mode='Markdown')
+        await update.message.reply_text("❌ موردی یافت نشد.", reply_markup=await get_keyboard(update.effective_user.id))
     return ConversationHandler.END
 
 # --- Handlers ویرایش ---
 async def edit_count_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    if not is_admin(update.effective_user.id): return ConversationHandler.END
+    if not await is_admin(update.effective_user.id): return ConversationHandler.END
     await update.message.reply_text("✏️ ID کتاب را وارد کنید:", reply_markup=ReplyKeyboardMarkup([['لغو عملیات']], resize_keyboard=True))
     return EDIT_GET_ID
 
@@ -262,27 +2779,31 @@ async def get_book_id_for_edit(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text("⚠️ ID باید عدد باشد.")
         return EDIT_GET_ID
         
-    res = db_query("SELECT title, count, borrowed_count FROM books WHERE id = %s", (bid,))
-    if not res:
+    book = await book_cache.get(bid)
+    if not book:
         await update.message.reply_text("⚠️ کتاب پیدا نشد.")
         return EDIT_GET_ID
         
     context.user_data['edit_bid'] = bid
-    await update.message.reply_text(f"کتاب: {res[0][0]}\nموجودی فعلی: {res[0][1]}\nدست امانت: {res[0][2]}\n\n🔢 موجودی جدید را وارد کنید:", reply_markup=ReplyKeyboardRemove())
+    await update.message.reply_text(f"کتاب: {book[1]}\nموجودی فعلی: {book[4]}\nدست امانت: {book[5]}\n\n🔢 موجودی جدید را وارد کنید:", reply_markup=ReplyKeyboardRemove())
     return EDIT_GET_NEW_COUNT
 
 async def get_new_count(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     try:
         cnt = int(update.message.text)
-        # چک کردن اینکه از تعداد امانت کمتر نباشد
+        # بررسی اینکه از تعداد امانت کمتر نباشد داخل همان UPDATE انجام می‌شود
         bid = context.user_data['edit_bid']
-        curr = db_query("SELECT borrowed_count FROM books WHERE id = %s", (bid,))[0][0]
-        if cnt < curr:
+        res = await set_book_count(bid, cnt)
+        if res is None:
+            await update.message.reply_text("❌ خطا در ثبت.", reply_markup=await get_keyboard(update.effective_user.id))
+            context.user_data.clear()
+            return ConversationHandler.END
+        curr, updated = res
+        if not updated:
             await update.message.reply_text(f"❌ موجودی نمیتواند کمتر از تعداد امانت ({curr}) باشد.")
             return EDIT_GET_NEW_COUNT
             
-        db_query("UPDATE books SET count = %s WHERE id = %s", (cnt, bid))
-        await update.message.reply_text("✅ موجودی آپدیت شد.", reply_markup=get_keyboard(update.effective_user.id))
+        await update.message.reply_text("✅ موجودی آپدیت شد.", reply_markup=await get_keyboard(update.effective_user.id))
     except:
         await update.message.reply_text("❌ خطا.")
     context.user_data.clear()
@@ -290,25 +2811,24 @@ async def get_new_count(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
 
 # --- Handlers مرور موضوعی ---
 async def browse_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    res = db_query("SELECT DISTINCT subject FROM books WHERE subject IS NOT NULL")
-    if not res:
-        await update.message.reply_text("موضوعی وجود ندارد.", reply_markup=get_keyboard(update.effective_user.id))
+    stats = await subject_cache.get()
+    if not stats:
+        await update.message.reply_text("موضوعی وجود ندارد.", reply_markup=await get_keyboard(update.effective_user.id))
         return ConversationHandler.END
-    rows = [[r[0]] for r in res] + [['لغو عملیات']]
+    # برچسب دکمه‌ها شمار کتاب‌ها را هم دارد؛ نگاشت برچسب به موضوع برای مرحله بعد نگه داشته می‌شود
+    labels = {f"{subj} ({titles} عنوان، {available} موجود)": subj for subj, titles, copies, available in stats}
+    context.user_data['browse_labels'] = labels
+    rows = [[label] for label in labels] + [['لغو عملیات']]
     await update.message.reply_text("یک موضوع انتخاب کنید:", reply_markup=ReplyKeyboardMarkup(rows, resize_keyboard=True))
     return BROWSE_GET_SUBJECT_CHOICE
 
 async def browse_show_books(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    subj = update.message.text
-    res = db_query("SELECT title, author, count, borrowed_count FROM books WHERE subject = %s", (subj,))
-    if res:
-        text = f"📚 کتاب‌های **{subj}**:\n\n"
-        for r in res:
-            avail = r[2] - (r[3] or 0)
-            text += f"📕 {r[0]} | موجود: {avail}\n"
-        await update.message.reply_text(text, reply_markup=get_keyboard(update.effective_user.id), parse_mode='Markdown')
+    subj = context.user_data.pop('browse_labels', {}).get(update.message.text, update.message.text)
+    rows, has_next = await fetch_page('subject', subj, None)
+    if rows:
+        await send_first_page(update, context, 'subject', subj, rows, has_next)
     else:
-        await update.message.reply_text("❌ کتابی یافت نشد.", reply_markup=get_keyboard(update.effective_user.id))
+        await update.message.reply_text("❌ کتابی یافت نشد.", reply_markup=await get_keyboard(update.effective_user.id))
     return ConversationHandler.END
 
 # --- Handlers امانت (درخواست) ---
@@ -324,41 +2844,54 @@ async def process_borrow_id(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("⚠️ عدد وارد کنید.")
         return BORROW_GET_ID
         
-    # 1. چک موجودی
-    info = db_query("SELECT title, count, borrowed_count FROM books WHERE id = %s", (bid,))
+    # بررسی موجودی، درخواست تکراری و ثبت درخواست در یک دستور
+    info = await request_loan(user.id, bid)
     if not info:
         await update.message.reply_text("⚠️ کتاب یافت نشد.")
         return BORROW_GET_ID
     
-    title, count, borrowed = info[0]
-    if (count - (borrowed or 0)) <= 0:
-        await update.message.reply_text("❌ موجودی ندارد.", reply_markup=get_keyboard(user.id))
+    title, avail, duplicate, real_lid = info
+    if duplicate:
+        await update.message.reply_text("❌ قبلاً این کتاب را درخواست داده یا امانت گرفته‌اید.", reply_markup=await get_keyboard(user.id))
         return ConversationHandler.END
-        
-    # 2. چک درخواست تکراری
-    exists = db_query("SELECT 1 FROM loans WHERE user_id = %s AND book_id = %s AND status IN ('PENDING', 'APPROVED')", (user.id, bid))
-    if exists:
-        await update.message.reply_text("❌ قبلاً این کتاب را درخواست داده یا امانت گرفته‌اید.", reply_markup=get_keyboard(user.id))
+    if avail <= 0:
+        await update.message.reply_text("❌ موجودی ندارد.", reply_markup=await get_keyboard(user.id))
+        await update.message.reply_text(
+            "می‌توانید در صف انتظار این کتاب قرار بگیرید؛ با آزاد شدن نسخه، درخواست شما خودکار ثبت می‌شود.",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🕒 ورود به صف انتظار", callback_data=f"wl:{bid}")]]),
+        )
         return ConversationHandler.END
         
-    # 3. ثبت درخواست
-    lid = db_query("INSERT INTO loans (book_id, user_id, status) VALUES (%s, %s, 'PENDING') RETURNING id", (bid, user.id))
-    
-    if lid: # lid یک لیست است چون fetchall خروجی می‌دهد اما اینجا چون RETURNING داریم در db_query تغییر کوچکی لازم بود که برای سادگی فرض میکنیم درست عمل میکند
-        # اصلاح: db_query ما fetchall برمیگرداند.
-        real_lid = lid[0][0]
-        await update.message.reply_text(f"✅ درخواست شما (شماره {real_lid}) ثبت شد. منتظر تایید ادمین باشید.", reply_markup=get_keyboard(user.id))
+    if real_lid:
+        await update.message.reply_text(f"✅ درخواست شما (شماره {real_lid}) ثبت شد. منتظر تایید ادمین باشید.", reply_markup=await get_keyboard(user.id))
         
-        # خبر به ادمین‌ها
-        for admin in get_admin_user_ids():
-            try:
-                await context.bot.send_message(admin, f"🚨 درخواست جدید!\nکتاب: {title}\nکاربر: {user.full_name}\nشماره درخواست: {real_lid}")
-            except: pass
+        await announce_request(title, user, real_lid)
     else:
-        await update.message.reply_text("❌ خطا در ثبت.", reply_markup=get_keyboard(user.id))
+        await update.message.reply_text("❌ خطا در ثبت.", reply_markup=await get_keyboard(user.id))
         
     return ConversationHandler.END
 
+async def announce_request(title, user, lid):
+    """خبر درخواست تازه به ادمین‌ها (از طریق صف ارسال، بدون معطل کردن پاسخ کاربر)"""
+    for admin in await get_admin_user_ids():
+        notifier.notify(admin, f"🚨 درخواست جدید!\nکتاب: {title}\nکاربر: {user.full_name}\nشماره درخواست: {lid}")
+
+async def waitlist_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """دکمه ورود به صف انتظار زیر پیام «موجودی ندارد»"""
+    query = update.callback_query
+    info = await join_waitlist(update.effective_user.id, int(query.data[3:]))
+    if not info:
+        await query.answer("کتاب یافت نشد.")
+        return
+    title, avail, duplicate, position = info
+    await query.answer()
+    if duplicate:
+        await query.edit_message_text("❌ قبلاً این کتاب را درخواست داده یا امانت گرفته‌اید.")
+    elif avail > 0:
+        await query.edit_message_text(f"📗 «{title}» اکنون موجود است؛ از «🤝 امانت کتاب» درخواست دهید.")
+    else:
+        await query.edit_message_text(f"🕒 در صف انتظار «{title}» قرار گرفتید. نوبت شما: {position}")
+
 # --- Handlers بازگشت ---
 async def return_book_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await update.message.reply_text("↩️ شماره امانت (Loan ID) را وارد کنید:", reply_markup=ReplyKeyboardMarkup([['لغو عملیات']], resize_keyboard=True))
@@ -372,102 +2905,172 @@ async def process_return_id(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("⚠️ عدد وارد کنید.")
         return RETURN_GET_LOAN_ID
         
-    # چک کردن مالکیت و وضعیت
-    res = db_query("SELECT book_id FROM loans WHERE id = %s AND user_id = %s AND status = 'APPROVED'", (lid, uid))
-    if not res:
+    # چک مالکیت و وضعیت و انجام بازگشت در یک دستور
+    try:
+        bid = await return_loan(lid, uid)
+    except (psycopg2.Error, PoolTimeout) as e:
+        logger.error(f"خطای دیتابیس در بازگشت امانت: {e}")
+        await update.message.reply_text("⚠️ خطای دیتابیس؛ کمی بعد دوباره تلاش کنید.", reply_markup=await get_keyboard(uid))
+        return ConversationHandler.END
+    if not bid:
         await update.message.reply_text("❌ شماره امانت نامعتبر است (یا تایید نشده یا مال شما نیست).")
         return RETURN_GET_LOAN_ID
         
-    bid = res[0][0]
-    
-    # انجام بازگشت
-    db_query("UPDATE loans SET status = 'RETURNED', return_date = CURRENT_TIMESTAMP WHERE id = %s", (lid,))
-    db_query("UPDATE books SET borrowed_count = borrowed_count - 1 WHERE id = %s", (bid,))
-    
-    await update.message.reply_text("✅ کتاب بازگردانده شد.", reply_markup=get_keyboard(uid))
+    await update.message.reply_text("✅ کتاب بازگردانده شد.", reply_markup=await get_keyboard(uid))
     return ConversationHandler.END
 
 # --- Handlers مدیریت درخواست (Approval) ---
 async def approval_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    if not is_admin(update.effective_user.id): return ConversationHandler.END
+    if not await is_admin(update.effective_user.id): return ConversationHandler.END
     
-    res = db_query("SELECT l.id, b.title, l.user_id FROM loans l JOIN books b ON l.book_id = b.id WHERE l.status = 'PENDING'")
-    if not res:
-        await update.message.reply_text("✅ درخواست جدیدی نیست.", reply_markup=get_keyboard(update.effective_user.id))
+    rows, has_next = await fetch_page('approval', None, None)
+    if not rows:
+        await update.message.reply_text("✅ درخواست جدیدی نیست.", reply_markup=await get_keyboard(update.effective_user.id))
         return ConversationHandler.END
         
-    text = "📩 درخواست‌های منتظر:\n" + "\n".join([f"🔹 درخواست {r[0]}: کتاب {r[1]} (کاربر {r[2]})" for r in res])
-    await update.message.reply_text(text + "\n\nشماره درخواست را وارد کنید:", reply_markup=ReplyKeyboardMarkup([['لغو عملیات']], resize_keyboard=True))
+    context.user_data['ap_sel'] = []
+    token = start_pager(context, 'approval', None, rows) if has_next else None
+    await update.message.reply_text(render_page('approval', None, rows, 1),
+                                    reply_markup=page_keyboard('approval', token, 1, has_next, rows, context))
+    await update.message.reply_text(
+        "شماره درخواست را وارد کنید، یا چند شماره و بازه (مثل 12,15-20)، یا همه درخواست‌های یک کتاب (مثل book:5)؛\n"
+        "می‌توانید درخواست‌ها را با دکمه‌های بالا هم انتخاب کنید.",
+        reply_markup=ReplyKeyboardMarkup([['لغو عملیات']], resize_keyboard=True))
     return APPROVAL_GET_LOAN_ID
 
 async def approval_get_loan_id(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    try:
-        lid = int(update.message.text)
-    except:
-        await update.message.reply_text("عدد وارد کنید.")
-        return APPROVAL_GET_LOAN_ID
-        
-    info = db_query("SELECT book_id, user_id FROM loans WHERE id = %s AND status = 'PENDING'", (lid,))
-    if not info:
+    text = normalize_text(update.message.text)
+    book = re.fullmatch(r'(?:book|کتاب)\s*:\s*(\d+)', text)
+    if book:
+        # همه درخواست‌های منتظر یک کتاب به ترتیب ثبت
+        res = await db_read("SELECT id FROM loans WHERE book_id = %s AND status = 'PENDING' ORDER BY id", (int(book.group(1)),), fresh=True)
+    else:
+        ids = parse_id_list(text)
+        if not ids:
+            await update.message.reply_text("عدد وارد کنید.")
+            return APPROVAL_GET_LOAN_ID
+        res = await db_read("SELECT id FROM loans WHERE id = ANY(%s) AND status = 'PENDING' ORDER BY id", (ids,), fresh=True)
+    if not res:
         await update.message.reply_text("درخواست پیدا نشد.")
         return APPROVAL_GET_LOAN_ID
         
-    context.user_data['m_lid'] = lid
-    context.user_data['m_bid'] = info[0][0]
-    context.user_data['m_uid'] = info[0][1]
-    
-    await update.message.reply_text(f"درخواست {lid} انتخاب شد. چه کنم؟", reply_markup=ReplyKeyboardMarkup([['✅ تأیید امانت', '❌ رد درخواست'], ['لغو عملیات']], resize_keyboard=True))
+    if len(res) == 1 and not book:
+        lid = res[0][0]
+        context.user_data['m_lid'] = lid
+        await update.message.reply_text(f"درخواست {lid} انتخاب شد. چه کنم؟", reply_markup=ReplyKeyboardMarkup([['✅ تأیید امانت', '❌ رد درخواست'], ['لغو عملیات']], resize_keyboard=True))
+        return APPROVAL_CONFIRM_ACTION
+
+    lids = [r[0] for r in res]
+    context.user_data['m_lids'] = lids
+    await update.message.reply_text(
+        f"{len(lids)} درخواست انتخاب شد: {', '.join(map(str, lids[:30]))}{' ...' if len(lids) > 30 else ''}\n"
+        "تأیید به ترتیب ثبت تا جایی که موجودی باشد انجام می‌شود. چه کنم؟",
+        reply_markup=ReplyKeyboardMarkup([['✅ تأیید امانت', '❌ رد درخواست'], ['✅ تأیید و رد مازاد'], ['لغو عملیات']], resize_keyboard=True))
     return APPROVAL_CONFIRM_ACTION
 
 async def approval_confirm_action(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     act = update.message.text
+    if 'm_lids' in context.user_data:
+        if 'تأیید' in act or 'رد' in act:
+            results = await apply_loan_batch(context.user_data['m_lids'], approve='تأیید' in act, reject_rest='مازاد' in act)
+            await update.message.reply_text(loan_batch_summary(context.user_data['m_lids'], results),
+                                            reply_markup=await get_keyboard(update.effective_user.id))
+            notify_loan_decisions(results)
+        context.user_data.clear()
+        return ConversationHandler.END
+
     lid = context.user_data['m_lid']
-    bid = context.user_data['m_bid']
-    uid = context.user_data['m_uid']
     
     if 'تأیید' in act:
-        # چک موجودی نهایی
-        curr = db_query("SELECT count, borrowed_count, title FROM books WHERE id = %s", (bid,))
-        if curr[0][0] - (curr[0][1] or 0) <= 0:
-            await update.message.reply_text("❌ موجودی تمام شده!", reply_markup=get_keyboard(update.effective_user.id))
-            return ConversationHandler.END
-            
-        db_query("UPDATE loans SET status = 'APPROVED' WHERE id = %s", (lid,))
-        db_query("UPDATE books SET borrowed_count = borrowed_count + 1 WHERE id = %s", (bid,))
-        
-        await update.message.reply_text("✅ تأیید شد.", reply_markup=get_keyboard(update.effective_user.id))
-        try: await context.bot.send_message(uid, f"✅ درخواست امانت کتاب {curr[0][2]} تأیید شد. دریافت کنید.")
-        except: pass
+        # چک موجودی نهایی و تأیید در یک دستور
+        res = await approve_loan(lid)
+        if not res:
+            await update.message.reply_text("⚠️ این درخواست دیگر منتظر نیست.", reply_markup=await get_keyboard(update.effective_user.id))
+        elif not res[2]:
+            await update.message.reply_text("❌ موجودی تمام شده!", reply_markup=await get_keyboard(update.effective_user.id))
+        else:
+            uid, title, _ = res
+            await update.message.reply_text("✅ تأیید شد.", reply_markup=await get_keyboard(update.effective_user.id))
+            notifier.notify(uid, f"✅ درخواست امانت کتاب {title} تأیید شد. دریافت کنید.")
         
     elif 'رد' in act:
-        db_query("UPDATE loans SET status = 'REJECTED' WHERE id = %s", (lid,))
-        await update.message.reply_text("❌ رد شد.", reply_markup=get_keyboard(update.effective_user.id))
-        try: await context.bot.send_message(uid, "❌ درخواست امانت شما رد شد.")
-        except: pass
+        uid = await reject_loan(lid)
+        await update.message.reply_text("❌ رد شد." if uid else "⚠️ این درخواست دیگر منتظر نیست.", reply_markup=await get_keyboard(update.effective_user.id))
+        if uid:
+            notifier.notify(uid, "❌ درخواست امانت شما رد شد.")
         
     context.user_data.clear()
     return ConversationHandler.END
 
+async def approval_select_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """چک‌باکس‌ها و دکمه‌های اعمال گروهی زیر فهرست درخواست‌های منتظر"""
+    query = update.callback_query
+    selected = context.user_data.setdefault('ap_sel', [])
+    if query.data.startswith('ap:t:'):
+        lid = int(query.data[5:])
+        if lid in selected:
+            selected.remove(lid)
+        else:
+            selected.append(lid)
+        await query.answer()
+        # فقط برچسب همان دکمه عوض می‌شود؛ نیازی به خواندن دوباره فهرست نیست
+        keyboard = [[InlineKeyboardButton(f"{'☑️' if int(b.callback_data[5:]) in selected else '⬜'} {b.callback_data[5:]}", callback_data=b.callback_data)
+                     if b.callback_data.startswith('ap:t:') else b for b in row]
+                    for row in query.message.reply_markup.inline_keyboard]
+        await query.edit_message_reply_markup(InlineKeyboardMarkup(keyboard))
+        return None
+
+    if not selected:
+        await query.answer("هیچ درخواستی انتخاب نشده است.")
+        return None
+    await query.answer()
+    lids = sorted(selected)
+    results = await apply_loan_batch(lids, approve=query.data == 'ap:ok')
+    await query.edit_message_text(f"درخواست‌های {', '.join(map(str, lids))}:\n" + loan_batch_summary(lids, results))
+    await context.bot.send_message(update.effective_user.id, "✅ انجام شد.", reply_markup=await get_keyboard(update.effective_user.id))
+    notify_loan_decisions(results)
+    context.user_data.clear()
+    return ConversationHandler.END
+
 # --- Handlers دیگر ---
 async def my_loans(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    res = db_query("""
-        SELECT l.id, b.title, l.status 
+    # امانت‌ها و صف‌های انتظار در یک رفت‌وبرگشت؛ نوبت با شمارش روی ایندکس (book_id, id) صف همان کتاب
+    rows = await db_read("""
+        SELECT 'L', l.id, b.title, l.status, to_char(l.due_date, 'YYYY-MM-DD'), l.due_date < CURRENT_TIMESTAMP
         FROM loans l JOIN books b ON l.book_id = b.id 
-        WHERE l.user_id = %s AND l.status IN ('PENDING', 'APPROVED')
-    """, (uid,))
+        WHERE l.user_id = %(uid)s AND l.status IN ('PENDING', 'APPROVED')
+        UNION ALL
+        (SELECT 'W', (SELECT count(*) FROM waitlist q WHERE q.book_id = w.book_id AND q.id <= w.id), b.title, NULL, NULL, NULL
+         FROM waitlist w JOIN books b ON b.id = w.book_id
+         WHERE w.user_id = %(uid)s ORDER BY w.id)
+    """, {'uid': uid}) or []
+    res = [r[1:] for r in rows if r[0] == 'L']
+    waits = [(r[2], r[1]) for r in rows if r[0] == 'W']
     
+    text = ""
     if res:
-        text = "📕 وضعیت شما:\n" + "\n".join([f"- {r[1]} (Status: {r[2]}) [ID: {r[0]}]" for r in res])
-    else:
+        text = "📕 وضعیت شما:\n" + "\n".join([
+            f"- {r[1]} (Status: {r[2]}) [ID: {r[0]}]" + (f" — موعد: {r[3]}" if r[3] else "") + (" ⚠️ دیرکرد" if r[4] else "")
+            for r in res
+        ])
+    if waits:
+        text += ("\n\n" if text else "") + "🕒 صف انتظار:\n" + "\n".join(f"- {title} (نوبت {pos})" for title, pos in waits)
+    if not text:
         text = "شما امانتی ندارید."
-    await update.message.reply_text(text, reply_markup=get_keyboard(uid))
+    await update.message.reply_text(text, reply_markup=await get_keyboard(uid))
     
 async def list_loans(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id): return
-    res = db_query("SELECT l.id, b.title, l.user_id FROM loans l JOIN books b ON l.book_id = b.id WHERE l.status = 'APPROVED'")
-    text = "📦 امانت‌های فعال:\n" + "\n".join([f"{r[0]}: {r[1]} (User: {r[2]})" for r in res]) if res else "خالی."
-    await update.message.reply_text(text, reply_markup=get_keyboard(update.effective_user.id))
+    if not await is_admin(update.effective_user.id): return
+    rows, has_next = await fetch_page('loans', None, None)
+    if rows:
+        await send_first_page(update, context, 'loans', None, rows, has_next)
+    else:
+        await update.message.reply_text("خالی.", reply_markup=await get_keyboard(update.effective_user.id))
+
+def book_text(r):
+    """متن جزئیات یک ردیف (id, title, author, subject, count, borrowed_count, ...)"""
+    return f"📕 {r[1]}\n✍️ {r[2]}\n🏷 {r[3]}\n🔢 کل: {r[4]}\n👥 دست مردم: {r[5] or 0}"
 
 async def details_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await update.message.reply_text("🔎 ID کتاب:", reply_markup=ReplyKeyboardMarkup([['لغو عملیات']], resize_keyboard=True))
@@ -476,11 +3079,9 @@ async def details_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
 async def show_details(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     try:
         bid = int(update.message.text)
-        res = db_query("SELECT title, author, subject, count, borrowed_count FROM books WHERE id = %s", (bid,))
-        if res:
-            r = res[0]
-            msg = f"📕 {r[0]}\n✍️ {r[1]}\n🏷 {r[2]}\n🔢 کل: {r[3]}\n👥 دست مردم: {r[4] or 0}"
-            await update.message.reply_text(msg, reply_markup=get_keyboard(update.effective_user.id))
+        r = await book_cache.get(bid)
+        if r:
+            await update.message.reply_text(book_text(r), reply_markup=await get_keyboard(update.effective_user.id))
         else:
             await update.message.reply_text("یافت نشد.")
     except:
@@ -488,26 +3089,26 @@ async def show_details(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     return ConversationHandler.END
 
 async def delete_book_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    if not is_admin(update.effective_user.id): return ConversationHandler.END
+    if not await is_admin(update.effective_user.id): return ConversationHandler.END
     await update.message.reply_text("🗑️ ID کتاب برای حذف:", reply_markup=ReplyKeyboardMarkup([['لغو عملیات']], resize_keyboard=True))
     return DELETE_GET_ID
 
 async def delete_get_id(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     try:
         bid = int(update.message.text)
-        # چک کردن اینکه دست کسی نباشد
-        curr = db_query("SELECT borrowed_count, title FROM books WHERE id = %s", (bid,))
-        if not curr: 
+        # چک کردن اینکه دست کسی نباشد (اینجا فقط برای پیام زودهنگام؛ شرط اصلی داخل خود DELETE است)
+        book = await book_cache.get(bid)
+        if not book: 
              await update.message.reply_text("کتاب نیست.")
              return ConversationHandler.END
              
-        if (curr[0][0] or 0) > 0:
-            await update.message.reply_text(f"❌ حذف نمیشود! {curr[0][0]} نسخه دست مردم است.", reply_markup=get_keyboard(update.effective_user.id))
+        if (book[5] or 0) > 0:
+            await update.message.reply_text(f"❌ حذف نمیشود! {book[5]} نسخه دست مردم است.", reply_markup=await get_keyboard(update.effective_user.id))
             return ConversationHandler.END
             
         context.user_data['del_bid'] = bid
-        context.user_data['del_title'] = curr[0][1]
-        await update.message.reply_text(f"آیا {curr[0][1]} حذف شود؟", reply_markup=ReplyKeyboardMarkup([['بله، حذف کن', 'لغو عملیات']], resize_keyboard=True))
+        context.user_data['del_title'] = book[1]
+        await update.message.reply_text(f"آیا {book[1]} حذف شود؟", reply_markup=ReplyKeyboardMarkup([['بله، حذف کن', 'لغو عملیات']], resize_keyboard=True))
         return DELETE_CONFIRM
     except:
         await update.message.reply_text("خطا.")
@@ -516,37 +3117,1172 @@ async def delete_get_id(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
 async def delete_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if update.message.text == 'بله، حذف کن':
         bid = context.user_data['del_bid']
-        db_query("DELETE FROM books WHERE id = %s", (bid,))
-        await update.message.reply_text("🗑️ حذف شد.", reply_markup=get_keyboard(update.effective_user.id))
+        res = await db_write("DELETE FROM books WHERE id = %s AND COALESCE(borrowed_count, 0) = 0 RETURNING id", (bid,))
+        book_cache.invalidate(bid)
+        if res:
+            await update.message.reply_text("🗑️ حذف شد.", reply_markup=await get_keyboard(update.effective_user.id))
+        else:
+            await update.message.reply_text("❌ حذف نشد؛ کتاب در این فاصله امانت داده شده یا قبلاً حذف شده است.", reply_markup=await get_keyboard(update.effective_user.id))
     else:
-        await update.message.reply_text("لغو شد.", reply_markup=get_keyboard(update.effective_user.id))
+        await update.message.reply_text("لغو شد.", reply_markup=await get_keyboard(update.effective_user.id))
     context.user_data.clear()
     return ConversationHandler.END
 
-# --- تابع اصلی ---
-def main() -> None:
-    # بررسی متغیرهای محیطی
-    if not TOKEN:
-        logger.critical("توکن یافت نشد! TOKEN را در تنظیمات Render چک کنید.")
+# --- جستجوی inline (@bot عبارت) ---
+# پاسخ‌ها از catalog_index می‌آیند و هر حرف تایپ‌شده کوئری دیتابیس نمی‌زند. پیام ارسال‌شده
+# ممکن است در گروه باشد؛ دکمه‌ها برای هر کسی که بزند با alert شخصی جواب می‌دهند و پیام را تغییر نمی‌دهند.
+
+def book_buttons(bid):
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton("🤝 امانت", callback_data=f"bk:borrow:{bid}"),
+        InlineKeyboardButton("🔎 جزئیات", callback_data=f"bk:details:{bid}"),
+    ]])
+
+async def inline_search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.inline_query
+    offset = int(query.offset) if query.offset.isdigit() else 0
+    if not catalog_index.ready:
+        await query.answer([], cache_time=0)
         return
-    if not DATABASE_URL:
-        logger.critical("آدرس دیتابیس یافت نشد! DATABASE_URL را در تنظیمات Render چک کنید.")
+    rows = catalog_index.search(query.query, offset + INLINE_RESULTS + 1)
+    results = [
+        InlineQueryResultArticle(
+            id=str(r[0]),
+            title=r[1],
+            description=f"✍️ {r[2]} | موجود: {r[4] - (r[5] or 0)} از {r[4]} | ID: {r[0]}",
+            input_message_content=InputTextMessageContent(f"{book_text(r)}\n🆔 {r[0]}"),
+            reply_markup=book_buttons(r[0]),
+        )
+        for r in rows[offset:offset + INLINE_RESULTS]
+    ]
+    more = len(rows) > offset + INLINE_RESULTS
+    await query.answer(results, cache_time=INLINE_CACHE_TIME, next_offset=str(offset + INLINE_RESULTS) if more else "")
+
+async def book_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """دکمه‌های امانت و جزئیات زیر نتیجه‌های inline"""
+    query = update.callback_query
+
+    async def alert(text):
+        await query.answer(text[:200], show_alert=True)  # سقف طول alert در تلگرام
+
+    _, action, bid = query.data.split(':')
+    bid = int(bid)
+    if action == 'details':
+        r = await book_cache.get(bid)
+        await alert(book_text(r) if r else "کتاب یافت نشد.")
         return
 
-    # ایجاد جداول دیتابیس
-    init_db()
-    
-    # اجرای وب‌سرور (برای زنده ماندن در Render)
-    keep_alive()
-    
-    app = Application.builder().token(TOKEN).concurrent_updates(True).build()
+    user = update.effective_user
+    info = await request_loan(user.id, bid)
+    if not info:
+        await alert("کتاب یافت نشد.")
+        return
+    title, avail, duplicate, lid = info
+    if duplicate:
+        await alert("❌ قبلاً این کتاب را درخواست داده یا امانت گرفته‌اید.")
+    elif avail <= 0:
+        await alert(f"❌ «{title}» موجودی ندارد. برای صف انتظار از «🤝 امانت کتاب» در گفتگو با ربات اقدام کنید.")
+    elif lid:
+        await alert(f"✅ درخواست شما (شماره {lid}) ثبت شد. منتظر تایید ادمین باشید.")
+        await announce_request(title, user, lid)
+    else:
+        await alert("❌ خطا در ثبت.")
+
+# --- ورود گروهی کتاب‌ها (CSV/XLSX) ---
+# فایل ردیف به ردیف خوانده و اعتبارسنجی می‌شود، ردیف‌های سالم دسته‌دسته با COPY
+# وارد جدول موقت books_import می‌شوند و در پایان با یک دستور در books ادغام می‌شوند
+# (کتاب هم‌عنوان و هم‌نویسنده موجودی‌اش زیاد می‌شود، بقیه درج می‌شوند).
+# حافظه مصرفی به اندازه یک دسته است، نه اندازه فایل.
+
+IMPORT_COLUMNS = {
+    'title': 'title', 'عنوان': 'title', 'نام کتاب': 'title',
+    'author': 'author', 'نویسنده': 'author',
+    'subject': 'subject', 'موضوع': 'subject',
+    'count': 'count', 'تعداد': 'count', 'موجودی': 'count',
+}
+_FA_CLEAN = str.maketrans("يىك", "ییک")
+
+def clean_text(value):
+    """یکسان‌سازی ی/ک و فاصله‌ها برای ذخیره (نیم‌فاصله حفظ می‌شود)"""
+    if value is None:
+        return None
+    return " ".join(str(value).translate(_FA_CLEAN).split()) or None
+
+def _iter_csv(path):
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        yield from csv.reader(f)
+
+def _iter_xlsx(path):
+    from openpyxl import load_workbook  # فقط برای فایل‌های xlsx لازم است
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        for row in wb.active.iter_rows(values_only=True):
+            yield ["" if v is None else str(v) for v in row]
+    finally:
+        wb.close()
+
+def _parse_import_row(row, columns):
+    """(title, author, subject, count) یا رشته خطا"""
+    values = dict(zip(columns, row))
+    title = clean_text(values.get('title'))
+    if not title:
+        return "عنوان خالی است"
+    if len(title) > 500:
+        return "عنوان بیش از حد طولانی است"
+    raw_count = normalize_text(str(values.get('count') or ""))
+    try:
+        count = int(float(raw_count)) if raw_count else 1
+    except (ValueError, OverflowError):  # OverflowError برای inf و 1e400
+        return f"تعداد نامعتبر: {values.get('count')}"
+    if not 1 <= count <= 100000:
+        return f"تعداد خارج از بازه است: {count}"
+    return title, clean_text(values.get('author')), clean_text(values.get('subject')), count
+
+def _copy_chunk(cursor, buf):
+    buf.seek(0)
+    cursor.copy_expert("COPY books_import (title, author, subject, count) FROM STDIN WITH (FORMAT csv)", buf)
+    buf.seek(0)
+    buf.truncate()
+
+def import_books(conn, path, kind, errors):
+    """اجرا داخل thread استخر؛ ردیف‌های خطا در errors (فایل متنی CSV) نوشته می‌شوند"""
+    rows = _iter_xlsx(path) if kind == 'xlsx' else _iter_csv(path)
+    error_writer = csv.writer(errors)
+    error_writer.writerow(['row', 'error', 'values'])
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    ok = failed = pending = 0
+
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            CREATE TEMP TABLE books_import (title TEXT, author TEXT, subject TEXT, count INTEGER) ON COMMIT DROP
+        """)
+        columns = None
+        for row_no, row in enumerate(rows, start=1):
+            if not any(str(v).strip() for v in row):
+                continue
+            if columns is None:
+                header = [IMPORT_COLUMNS.get(normalize_text(str(v))) for v in row]
+                if 'title' in header:
+                    columns = header
+                    continue
+                # بدون سرستون، ترتیب ستون‌ها عنوان، نویسنده، موضوع، تعداد فرض می‌شود
+                columns = ['title', 'author', 'subject', 'count']
+            parsed = _parse_import_row(row, columns)
+            if isinstance(parsed, str):
+                failed += 1
+                error_writer.writerow([row_no, parsed, " | ".join(str(v) for v in row)])
+                continue
+            writer.writerow(parsed)
+            ok += 1
+            pending += 1
+            if pending >= IMPORT_CHUNK_ROWS:
+                _copy_chunk(cursor, buf)
+                pending = 0
+        if pending:
+            _copy_chunk(cursor, buf)
+
+        cursor.execute("""
+            WITH s AS (
+                SELECT title, author, max(subject) AS subject, sum(count) AS count
+                FROM books_import GROUP BY title, author
+            ), upd AS (
+                UPDATE books b SET count = b.count + s.count, subject = COALESCE(b.subject, s.subject)
+                FROM s WHERE b.title = s.title AND b.author IS NOT DISTINCT FROM s.author
+                RETURNING b.title, b.author
+            ), ins AS (
+                INSERT INTO books (title, author, subject, count)
+                SELECT s.title, s.author, s.subject, s.count FROM s
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM upd WHERE upd.title = s.title AND upd.author IS NOT DISTINCT FROM s.author
+                )
+                RETURNING 1
+            )
+            SELECT (SELECT count(*) FROM ins), (SELECT count(*) FROM upd)
+        """)
+        inserted, updated = cursor.fetchone()
+    return ok, failed, inserted, updated
+
+async def import_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    if not await is_admin(update.effective_user.id): return ConversationHandler.END
+    await update.message.reply_text(
+        "📥 فایل CSV یا XLSX کتاب‌ها را بفرستید.\nستون‌ها: عنوان، نویسنده، موضوع، تعداد (سطر اول می‌تواند سرستون باشد).",
+        reply_markup=ReplyKeyboardMarkup([['لغو عملیات']], resize_keyboard=True))
+    return IMPORT_GET_FILE
+
+async def import_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    doc = update.message.document
+    name = (doc.file_name or "").lower()
+    kind = 'xlsx' if name.endswith('.xlsx') else 'csv' if name.endswith(('.csv', '.txt')) else None
+    if not kind:
+        await update.message.reply_text("⚠️ فقط فایل CSV یا XLSX پذیرفته می‌شود.")
+        return IMPORT_GET_FILE
+
+    await update.message.reply_text("⏳ در حال پردازش فایل...")
+    # فایل خطاها در هر مسیر خروج (از جمله خطای تلگرام هنگام دانلود یا ارسال) بسته می‌شود
+    errors = tempfile.SpooledTemporaryFile(max_size=1024 * 1024, mode='w+b')
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, f"import.{kind}")
+            await (await doc.get_file()).download_to_drive(path)
+            error_text = io.TextIOWrapper(errors, encoding='utf-8-sig', newline='')
+            try:
+                replica.touch(update.effective_user.id)
+                ok, failed, inserted, updated = await db_pool.run(import_books, path, kind, error_text)
+                book_cache.clear()
+            except ImportError:
+                await update.message.reply_text("❌ برای فایل XLSX کتابخانه openpyxl نصب نیست.", reply_markup=await get_keyboard(update.effective_user.id))
+                return ConversationHandler.END
+            except (psycopg2.Error, PoolTimeout, csv.Error, UnicodeDecodeError, ValueError, OverflowError) as e:
+                logger.error(f"خطای ورود گروهی: {e}")
+                await update.message.reply_text("❌ خطا در پردازش فایل.", reply_markup=await get_keyboard(update.effective_user.id))
+                return ConversationHandler.END
+
+        await update.message.reply_text(
+            f"✅ ورود گروهی انجام شد.\nردیف‌های سالم: {ok}\nکتاب جدید: {inserted}\nکتاب موجود (افزایش موجودی): {updated}\nردیف‌های خطادار: {failed}",
+            reply_markup=await get_keyboard(update.effective_user.id))
+        if failed:
+            error_text.flush()
+            error_text.detach()
+            errors.seek(0)
+            await update.message.reply_document(errors, filename="import_errors.csv", caption="⚠️ ردیف‌های ثبت‌نشده")
+    finally:
+        errors.close()
+    return ConversationHandler.END
+
+# --- خروجی CSV کتاب‌ها و تاریخچه امانت ---
+# ردیف‌ها با cursor نام‌دار سمت سرور در دسته‌های EXPORT_BATCH_ROWS خوانده و همان‌جا در فایل موقت
+# (و در صورت نیاز gzip) نوشته می‌شوند؛ حافظه به اندازه یک دسته است، نه کل جدول.
+# تاریخ‌ها در خود کوئری متن می‌شوند؛ ساختن datetime پایتون فقط برای چاپ دوباره‌اش بیشترین هزینه خروجی بود.
+
+EXPORT_LIMIT_BYTES = 50 * 1024 * 1024  # سقف اندازه فایلی که ربات می‌تواند در تلگرام بفرستد
+EXPORT_STATUSES = ('PENDING', 'APPROVED', 'REJECTED', 'RETURNED')
+_EXPORT_LOAN_FILTER = """
+    WHERE (%(since)s::date IS NULL OR l.borrow_date >= %(since)s::date)
+      AND (%(until)s::date IS NULL OR l.borrow_date < %(until)s::date + 1)
+      AND (%(status)s::text IS NULL OR l.status = %(status)s)
+    ORDER BY l.id
+"""
+EXPORTS = {
+    'books': (
+        ["id", "title", "author", "subject", "count", "borrowed_count"],
+        "SELECT id, title, author, subject, count, COALESCE(borrowed_count, 0) FROM books ORDER BY id",
+    ),
+    'loans': (
+        ["id", "book_id", "user_id", "status", "borrow_date", "decided_at", "due_date", "return_date"],
+        "SELECT l.id, l.book_id, l.user_id, l.status, l.borrow_date::text, l.decided_at::text, l.due_date::text,"
+        " l.return_date::text FROM loans l"
+        + _EXPORT_LOAN_FILTER,
+    ),
+    'history': (
+        ["loan_id", "user_id", "status", "borrow_date", "decided_at", "due_date", "return_date",
+         "book_id", "title", "author", "subject"],
+        """
+        SELECT l.id, l.user_id, l.status, l.borrow_date::text, l.decided_at::text, l.due_date::text,
+               l.return_date::text, l.book_id, b.title, b.author, b.subject
+        FROM loans l LEFT JOIN books b ON b.id = l.book_id
+        """ + _EXPORT_LOAN_FILTER,
+    ),
+}
+
+def export_csv(conn, kind, params, out, batch):
+    """نوشتن خروجی kind به صورت CSV در out؛ تعداد ردیف‌ها"""
+    header, query = EXPORTS[kind]
+    writer = csv.writer(out)
+    writer.writerow(header)
+    rows = 0
+    # cursor نام‌دار: نتیجه روی سرور می‌ماند و هر fetchmany فقط یک دسته به پایتون می‌آورد
+    with conn.cursor(name=f"export_{kind}") as cursor:
+        cursor.execute(query, params)
+        while True:
+            chunk = cursor.fetchmany(batch)
+            if not chunk:
+                break
+            writer.writerows(chunk)
+            rows += len(chunk)
+    return rows
+
+async def build_export(kind, since=None, until=None, status=None, compress=True, batch=EXPORT_BATCH_ROWS):
+    """ساخت خروجی در SpooledTemporaryFile؛ (فایل آماده خواندن، تعداد ردیف، اندازه به بایت)
+
+    خروجی فقط می‌خواند و چند ثانیه کهنگی برایش مهم نیست، پس اسکن بزرگ از replica انجام می‌شود؛
+    اگر replica وسط کار قطع شود یا کوئری را به خاطر تداخل با replay لغو کند، از اول روی primary ساخته می‌شود.
+    """
+    params = {'since': since, 'until': until, 'status': status}
+    pool = replica.target()
+    if pool is not db_pool:
+        try:
+            return await _build_export(pool, kind, params, compress, batch)
+        except (psycopg2.OperationalError, PoolTimeout) as e:
+            logger.warning(f"خروجی {kind} از replica ناموفق بود؛ ساخت دوباره از primary: {e}")
+    return await _build_export(db_pool, kind, params, compress, batch)
+
+async def _build_export(pool, kind, params, compress, batch):
+    spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES, mode='w+b')
+    raw = gzip.GzipFile(fileobj=spool, mode='wb', compresslevel=6) if compress else spool
+    text = io.TextIOWrapper(raw, encoding='utf-8-sig', newline='')
+    try:
+        rows = await pool.run(export_csv, kind, params, text, batch)
+        text.flush()
+        text.detach()
+        if compress:
+            raw.close()  # فقط انتهای gzip را می‌نویسد؛ spool باز می‌ماند
+    except BaseException:
+        spool.close()
+        raise
+    size = spool.tell()
+    spool.seek(0)
+    return spool, rows, size
+
+def parse_export_args(args):
+    """(نوع، از تاریخ، تا تاریخ، وضعیت، فشرده‌سازی) یا None اگر قابل خواندن نباشد"""
+    if not args or args[0].lower() not in EXPORTS:
+        return None
+    dates, status, compress = [], None, True
+    for arg in args[1:]:
+        if re.fullmatch(r'\d{4}-\d{2}-\d{2}', arg):
+            try:
+                dates.append(datetime.date.fromisoformat(arg))
+            except ValueError:
+                return None
+        elif arg.upper() in EXPORT_STATUSES:
+            status = arg.upper()
+        elif arg.lower() == 'csv':
+            compress = False
+        else:
+            return None
+    if len(dates) > 2:
+        return None
+    since, until = (dates + [None, None])[:2]
+    return args[0].lower(), since, until, status, compress
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/export books|loans|history [از YYYY-MM-DD] [تا YYYY-MM-DD] [وضعیت] [csv]"""
+    uid = update.effective_user.id
+    if not await is_admin(uid):
+        return
+    parsed = parse_export_args(context.args)
+    if not parsed:
+        await update.message.reply_text(
+            "📤 استفاده: /export books|loans|history [از YYYY-MM-DD] [تا YYYY-MM-DD] [PENDING|APPROVED|REJECTED|RETURNED] [csv]\n"
+            "مثال: /export history 2024-01-01 2024-06-30 RETURNED\n"
+            "خروجی به صورت پیش‌فرض gzip است؛ با csv فشرده نمی‌شود.")
+        return
+    kind, since, until, status, compress = parsed
+    await update.message.reply_text("⏳ در حال ساخت خروجی...")
+    try:
+        spool, rows, size = await build_export(kind, since, until, status, compress)
+    except (psycopg2.Error, PoolTimeout, OSError) as e:
+        logger.error(f"خطای ساخت خروجی: {e}")
+        await update.message.reply_text("❌ خطا در ساخت خروجی.")
+        return
+    try:
+        if size > EXPORT_LIMIT_BYTES:
+            await update.message.reply_text(
+                f"❌ فایل خروجی ({size / 2**20:.0f} مگابایت) از سقف ۵۰ مگابایت تلگرام بزرگ‌تر است؛ بازه تاریخ را کوچک‌تر کنید.")
+            return
+        # کتابخانه تلگرام فایل را برای آپلود یکجا می‌خواند؛ سقف ۵۰ مگابایت سقف حافظه همین مرحله هم هست
+        filename = f"{kind}-{datetime.date.today().isoformat()}.csv" + (".gz" if compress else "")
+        await update.message.reply_document(spool, filename=filename, caption=f"📤 {rows} ردیف")
+    finally:
+        spool.close()
+
+# --- صفحه‌بندی فهرست‌ها (keyset) ---
+# هر صفحه یک کوئری محدود «WHERE کلید > آخرین کلید دیده‌شده LIMIT n» است و
+# دکمه‌های قبلی/بعدی همان پیام را ویرایش می‌کنند. وضعیت در user_data نگه داشته می‌شود:
+# stack مکان‌نمای شروع هر صفحه دیده‌شده و last کلید آخرین ردیف صفحه فعلی است.
+
+async def _fetch_search_page(term, after, limit):
+    return await search_books(term, limit, after)
+
+async def _fetch_subject_page(subj, after, limit):
+    return await db_read(
+        "SELECT id, title, author, count, borrowed_count FROM books WHERE subject = %s AND id > %s ORDER BY id LIMIT %s",
+        (subj, after or 0, limit))
+
+async def _fetch_loans_page(status, after, limit):
+    return await db_read(
+        "SELECT l.id, b.title, l.user_id FROM loans l JOIN books b ON l.book_id = b.id "
+        "WHERE l.status = %s AND l.id > %s ORDER BY l.id LIMIT %s",
+        (status, after or 0, limit))
+
+def _render_search(term, rows):
+    text = f"✅ نتایج برای **'{term}'**:\n\n"
+    for r in rows:
+        avail = r[4] - (r[5] or 0)
+        text += f"📕 **{r[1]}**\n🆔: {r[0]}\n✍️: {r[2]}\n🏷: {r[3]}\n⬅️ موجود: {avail}\n------------------\n"
+    return text
+
+def _render_subject(subj, rows):
+    text = f"📚 کتاب‌های **{subj}**:\n\n"
+    for r in rows:
+        avail = r[3] - (r[4] or 0)
+        text += f"📕 {r[1]} | موجود: {avail}\n"
+    return text
+
+def _render_approval(_, rows):
+    return "📩 درخواست‌های منتظر:\n" + "\n".join([f"🔹 درخواست {r[0]}: کتاب {r[1]} (کاربر {r[2]})" for r in rows])
+
+def _render_loans(_, rows):
+    return "📦 امانت‌های فعال:\n" + "\n".join([f"{r[0]}: {r[1]} (User: {r[2]})" for r in rows])
+
+def _approval_buttons(rows, context):
+    """چک‌باکس انتخاب هر درخواست و دکمه‌های اعمال گروهی زیر فهرست درخواست‌ها"""
+    selected = set(context.user_data.get('ap_sel', []))
+    toggles = [InlineKeyboardButton(f"{'☑️' if r[0] in selected else '⬜'} {r[0]}", callback_data=f"ap:t:{r[0]}") for r in rows]
+    actions = [InlineKeyboardButton("✅ تأیید انتخاب‌شده‌ها", callback_data="ap:ok"),
+               InlineKeyboardButton("❌ رد انتخاب‌شده‌ها", callback_data="ap:no")]
+    return [toggles[i:i + 4] for i in range(0, len(toggles), 4)], [actions]
+
+# kind -> (واکشی صفحه، کلید مکان‌نما از ردیف، متن صفحه، parse_mode، دکمه‌های اضافه)
+PAGERS = {
+    'search': (_fetch_search_page, lambda r: [str(r[6]), r[0]], _render_search, 'Markdown', None),
+    'subject': (_fetch_subject_page, lambda r: r[0], _render_subject, 'Markdown', None),
+    'approval': (lambda _, after, limit: _fetch_loans_page('PENDING', after, limit), lambda r: r[0], _render_approval, None, _approval_buttons),
+    'loans': (lambda _, after, limit: _fetch_loans_page('APPROVED', after, limit), lambda r: r[0], _render_loans, None, None),
+}
+
+async def fetch_page(kind, arg, after):
+    """یک صفحه و اینکه صفحه بعدی وجود دارد یا نه (با واکشی یک ردیف اضافه)"""
+    rows = await PAGERS[kind][0](arg, after, PAGE_SIZE + 1) or []
+    return rows[:PAGE_SIZE], len(rows) > PAGE_SIZE
+
+def render_page(kind, arg, rows, page_no):
+    text = PAGERS[kind][2](arg, rows)
+    return text if page_no == 1 else f"{text}\n📄 صفحه {page_no}"
+
+def page_keyboard(kind, token, page_no, has_next, rows=(), context=None):
+    nav = []
+    if page_no > 1:
+        nav.append(InlineKeyboardButton("◀️ قبلی", callback_data=f"pg:{token}:prev"))
+    if has_next:
+        nav.append(InlineKeyboardButton("بعدی ▶️", callback_data=f"pg:{token}:next"))
+    top, bottom = PAGERS[kind][4](rows, context) if PAGERS[kind][4] and rows else ([], [])
+    keyboard = top + ([nav] if nav else []) + bottom
+    return InlineKeyboardMarkup(keyboard) if keyboard else None
+
+def start_pager(context: ContextTypes.DEFAULT_TYPE, kind, arg, rows):
+    """ذخیره وضعیت صفحه‌بندی؛ توکن برگشتی در callback_data دکمه‌ها می‌نشیند"""
+    token = secrets.token_hex(4)
+    context.user_data['pager'] = {'token': token, 'kind': kind, 'arg': arg, 'stack': [None], 'last': PAGERS[kind][1](rows[-1])}
+    return token
+
+async def send_first_page(update: Update, context: ContextTypes.DEFAULT_TYPE, kind, arg, rows, has_next):
+    """ارسال صفحه اول؛ فقط اگر صفحه بعدی باشد وضعیت صفحه‌بندی ذخیره می‌شود"""
+    parse_mode = PAGERS[kind][3]
+    text = render_page(kind, arg, rows, 1)
+    if not has_next:
+        await update.message.reply_text(text, reply_markup=await get_keyboard(update.effective_user.id), parse_mode=parse_mode)
+        return
+
+    token = start_pager(context, kind, arg, rows)
+    if kind in ('search', 'subject'):
+        # کیبورد «لغو عملیات» را با منوی اصلی جایگزین می‌کنیم چون پیام صفحه کیبورد inline دارد
+        await update.message.reply_text("📄 نتایج در چند صفحه نمایش داده می‌شوند.", reply_markup=await get_keyboard(update.effective_user.id))
+    await update.message.reply_text(text, reply_markup=page_keyboard(kind, token, 1, has_next, rows, context), parse_mode=parse_mode)
+
+async def expired_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """دکمه‌های inline پیام‌هایی که مکالمه‌شان تمام شده"""
+    await update.callback_query.answer("این فهرست منقضی شده است.")
+
+async def page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    _, token, direction = query.data.split(':')
+    state = context.user_data.get('pager')
+    if not state or state['token'] != token:
+        await query.answer("این فهرست منقضی شده است.")
+        return
+
+    stack = state['stack']
+    if direction == 'next':
+        stack.append(state['last'])
+    elif len(stack) > 1:
+        stack.pop()
+    kind, arg = state['kind'], state['arg']
+    rows, has_next = await fetch_page(kind, arg, stack[-1])
+    await query.answer()
+    if not rows:
+        # ردیف‌های این صفحه در این فاصله حذف شده‌اند
+        await query.edit_message_text("❌ موردی باقی نمانده است.", reply_markup=page_keyboard(kind, token, len(stack), False))
+        return
+    state['last'] = PAGERS[kind][1](rows[-1])
+    await query.edit_message_text(render_page(kind, arg, rows, len(stack)),
+                                  reply_markup=page_keyboard(kind, token, len(stack), has_next, rows, context),
+                                  parse_mode=PAGERS[kind][3])
+
+# --- وب‌سرور: وبهوک تلگرام و بررسی سلامت ---
+# یک سرور tornado روی همان event loop ربات؛ در حالت polling هم برای بررسی سلامت Render اجرا می‌شود.
+
+class HomeHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write("I am alive! Bot is running...")
+
+class HealthHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write("ok")
+
+async def app_ready(application):
+    """آماده یعنی ربات در حال اجراست و دیتابیس پاسخ می‌دهد"""
+    if not (application.running and db_pool is not None):
+        return False
+    try:
+        await asyncio.wait_for(db_pool.run(_execute, "SELECT 1", ()), 2)
+    except Exception:
+        return False
+    return True
+
+class ReadyHandler(tornado.web.RequestHandler):
+    def initialize(self, check):
+        self.check = check
+
+    async def get(self):
+        ready = await self.check()
+        self.set_status(200 if ready else 503)
+        self.write("ready" if ready else "not ready")
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        if METRICS_TOKEN and not hmac.compare_digest(self.request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"):
+            self.set_status(401)
+            return
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        # در حالت چندپردازه‌ای متریک‌های handler و دیتابیس در workerهاست و با برچسب worker می‌آید
+        self.write(render_metrics(supervisor.metrics() if supervisor else ()))
+
+class WebhookHandler(tornado.web.RequestHandler):
+    """دریافت آپدیت‌های تلگرام و تحویل آپدیت خام به submit"""
+
+    def initialize(self, submit):
+        self.submit = submit
+
+    async def post(self):
+        token = self.request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not WEBHOOK_SECRET or not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+            self.set_status(403)
+            return
+        try:
+            data = json.loads(self.request.body)
+        except ValueError:
+            self.set_status(400)
+            return
+        try:
+            await self.submit(data)
+        except WorkerOverloaded:
+            # تلگرام وبهوک ناموفق را بعداً دوباره می‌فرستد
+            self.set_status(503)
+
+def start_http_server(submit, ready) -> HTTPServer:
+    """submit(data) آپدیت خام وبهوک را تحویل می‌دهد و ready() آمادگی سرویس را بررسی می‌کند"""
+    routes = [
+        (r"/", HomeHandler),
+        (r"/healthz", HealthHandler),
+        (r"/readyz", ReadyHandler, {'check': ready}),
+        (r"/metrics", MetricsHandler),
+    ]
+    if BOT_MODE == 'webhook':
+        routes.append((WEBHOOK_PATH, WebhookHandler, {'submit': submit}))
+    server = HTTPServer(tornado.web.Application(routes))
+    server.listen(PORT)
+    logger.info(f"وب‌سرور روی پورت {PORT} اجرا شد (حالت {BOT_MODE}).")
+    return server
+
+async def run_bot(application: Application) -> None:
+    """چرخه عمر ربات: راه‌اندازی، دریافت آپدیت (webhook یا polling) تا سیگنال توقف، و خاموشی تمیز"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await application.initialize()
+    server = None
+    try:
+        await application.post_init(application)
+        server = start_http_server(
+            lambda data: application.update_queue.put(Update.de_json(data, application.bot)),
+            functools.partial(app_ready, application),
+        )
+        if BOT_MODE == 'webhook':
+            await application.bot.set_webhook(
+                WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+            )
+        else:
+            await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+        await application.start()
+        logger.info("ربات در حال اجراست...")
+        await stop.wait()
+    finally:
+        # وبهوک سر جایش می‌ماند تا تلگرام آپدیت‌ها را برای نمونه بعدی نگه دارد
+        if server:
+            server.stop()
+        if application.updater and application.updater.running:
+            await application.updater.stop()
+        if application.running:
+            await application.stop()
+        await application.post_stop(application)
+        await application.shutdown()
+        await application.post_shutdown(application)
+
+# --- حالت چندپردازه‌ای: ingress و workerهای تقسیم‌شده بر اساس کاربر ---
+# با BOT_WORKERS > 0 پردازه اصلی فقط آپدیت‌ها را (polling یا webhook) می‌گیرد و هر آپدیت خام را
+# بر اساس شناسه فرستنده به یکی از workerها می‌فرستد. هر کاربر همیشه به همان worker می‌رسد، پس
+# ترتیب پیام‌هایش و وضعیت مکالمه‌اش (در حافظه همان worker) حفظ می‌شود. هر worker Application
+# کامل، استخر اتصال، LISTEN و کش‌های خودش را دارد و نوشته‌ها با NOTIFY به بقیه می‌رسند.
+
+WORKER_INDEX = None  # شماره worker در پردازه worker؛ در حالت تک‌پردازه‌ای None
+POLL_TIMEOUT = 30  # ثانیه long polling در getUpdates
+WEBHOOK_DISPATCH_TIMEOUT = 10  # ثانیه انتظار وبهوک برای جا در worker پیش از پاسخ 503
+supervisor = None
+
+class WorkerOverloaded(Exception):
+    """worker مقصد در زمان مقرر جایی برای آپدیت تازه نداشت"""
+
+def update_shard_key(data):
+    """شناسه فرستنده آپدیت خام (همان effective_user.id)؛ برای پست کانال شناسه چت"""
+    for value in data.values():
+        if isinstance(value, dict):
+            sender = value.get('from') or value.get('user') or value.get('chat') or {}
+            return sender.get('id', 0)
+    return 0
+
+class PipeWriter:
+    """ارسال پیام روی یک سر Pipe از thread جدا تا send مسدودکننده هرگز event loop را نگه ندارد
+
+    اگر هر دو پردازه هم‌زمان روی pipe پر send کنند و هیچ‌کدام نخوانند، هر دو برای همیشه می‌مانند؛
+    با این کلاس event loop هر دو طرف همیشه به خواندن ادامه می‌دهد. on_error از همان thread صدا
+    زده می‌شود.
+    """
+
+    def __init__(self, conn, name, on_error=None):
+        self.conn = conn
+        self._queue = queue.SimpleQueue()
+        self._on_error = on_error
+        self._sending = False
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def send(self, message):
+        self._queue.put(message)
+
+    def idle(self):
+        return not self._sending and self._queue.empty()
+
+    def close(self, timeout=None):
+        """پس از فرستادن پیام‌های صف‌شده متوقف می‌شود؛ با timeout صفر منتظر نمی‌ماند"""
+        self._queue.put(None)
+        if timeout != 0:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            message = self._queue.get()
+            if message is None:
+                return
+            self._sending = True
+            try:
+                self.conn.send(message)
+            except (OSError, ValueError):
+                if self._on_error is not None:
+                    self._on_error()
+                return
+            finally:
+                self._sending = False
+
+class Worker:
+    """سمت worker: آپدیت‌ها را از pipe می‌گیرد، پیام‌های هر کاربر را به ترتیب پردازش و پایانشان را گزارش می‌کند"""
+
+    def __init__(self, index, conn, metrics_conn, application):
+        self.index = index
+        self.conn = conn
+        self.metrics_conn = metrics_conn
+        self.application = application
+        self._writer = self._metrics_writer = None
+        self.processed = 0
+        self._tails = {}  # کاربر -> task آخرین آپدیتش؛ آپدیت بعدی پس از آن اجرا می‌شود
+        self._drain = asyncio.Event()
+
+    def _send(self, message):
+        self._writer.send(message)
+
+    def _on_readable(self):
+        try:
+            while self.conn.poll():
+                message = self.conn.recv()
+                if message[0] == 'update':
+                    key = message[1]
+                    self._tails[key] = asyncio.ensure_future(self._process(key, message[2], self._tails.get(key)))
+                elif message[0] == 'drain':
+                    self._drain.set()
+        except (EOFError, OSError):
+            self._drain.set()
+
+    async def _process(self, key, data, previous):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await self.application.process_update(Update.de_json(data, self.application.bot))
+        except Exception:
+            logger.exception(f"worker {self.index}: خطا در پردازش آپدیت")
+        finally:
+            if self._tails.get(key) is asyncio.current_task():
+                del self._tails[key]
+            self.processed += 1
+            self._send(('done',))
+
+    async def _heartbeat(self):
+        reported = 0.0
+        while True:
+            self._send(('hb', self.processed, len(self._tails)))
+            # snapshot تازه فقط وقتی ساخته می‌شود که قبلی خوانده شده باشد
+            if time.monotonic() - reported >= WORKER_METRICS_INTERVAL and self._metrics_writer.idle():
+                reported = time.monotonic()
+                self._metrics_writer.send(metrics_snapshot())
+            await asyncio.sleep(WORKER_HEARTBEAT_INTERVAL)
+
+    async def run(self):
+        app = self.application
+        loop = asyncio.get_running_loop()
+        # ingress از دست رفته است
+        lost = functools.partial(loop.call_soon_threadsafe, self._drain.set)
+        self._writer = PipeWriter(self.conn, "pipe-writer", lost)
+        self._metrics_writer = PipeWriter(self.metrics_conn, "metrics-writer")
+        await app.initialize()
+        heartbeat = None
+        try:
+            await app.post_init(app)
+            await app.start()
+            loop.add_reader(self.conn.fileno(), self._on_readable)
+            heartbeat = asyncio.ensure_future(self._heartbeat())
+            self._send(('ready',))
+            await self._drain.wait()
+            loop.remove_reader(self.conn.fileno())
+            # آپدیت‌های تحویل‌گرفته پیش از خاموشی تمام می‌شوند؛ آخرین task هر کاربر منتظر قبلی‌هاست
+            if self._tails:
+                await asyncio.wait(list(self._tails.values()))
+            logger.info(f"worker {self.index} تخلیه شد ({self.processed} آپدیت).")
+        finally:
+            if heartbeat is not None:
+                heartbeat.cancel()
+            if app.running:
+                await app.stop()
+            await app.post_stop(app)
+            await app.shutdown()
+            await app.post_shutdown(app)
+            # پیام‌های done آخر پیش از پایان پردازه به ingress می‌رسند
+            self._metrics_writer.close(0)
+            self._writer.close(WORKER_DRAIN_TIMEOUT)
+
+def worker_main(index, count, conn, metrics_conn, request_factory=None):
+    """نقطه ورود پردازه worker؛ سهم استخر اتصال و نرخ ارسال بین workerها تقسیم می‌شود"""
+    global WORKER_INDEX, DB_POOL_MAX, DB_REPLICA_POOL_MAX, notifier
+    WORKER_INDEX = index
+    DB_POOL_MAX = max(2, DB_POOL_MAX // count)
+    DB_REPLICA_POOL_MAX = max(2, DB_REPLICA_POOL_MAX // count)
+    notifier = Notifier(NOTIFY_WORKERS, NOTIFY_QUEUE_SIZE, NOTIFY_GLOBAL_RATE / count, NOTIFY_CHAT_RATE, NOTIFY_MAX_RETRIES)
+    # بار worker را backpressure ورودی (WORKER_MAX_INFLIGHT و 503 به webhook) محدود می‌کند؛ آپدیتی که
+    # supervisor تحویل داده نباید دور ریخته شود. تکراری‌ها و محدودیت هر کاربر همچنان اعمال می‌شوند.
+    update_guard.max_in_flight = update_guard.max_db_waiting = float('inf')
+    # Ctrl+C و SIGTERM (مثلا systemd) به همه پردازه‌های گروه می‌رسند؛ توقف را ingress با پیام drain هماهنگ می‌کند
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    application = build_application(request_factory() if request_factory else None)
+    asyncio.run(Worker(index, conn, metrics_conn, application).run())
+
+class WorkerHandle:
+    """سمت ingress: یک پردازه worker، pipe آن و شمار آپدیت‌های در جریانش"""
+
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.conn = None
+        self.writer = None
+        self.metrics_conn = None  # pipe یک‌طرفه snapshot متریک‌ها، جدا از آپدیت‌ها
+        self.ready = False
+        self.inflight = 0
+        self.processed = 0
+        self.restarts = 0
+        self.last_seen = 0.0
+        self.metrics = None  # آخرین snapshot متریک‌های پردازه
+        self.room = asyncio.Event()
+
+class Supervisor:
+    """ingress: پخش آپدیت‌ها بین workerها با فشار معکوس، بررسی سلامت و اجرای دوباره، و تخلیه هنگام توقف
+
+    هر worker حداکثر max_inflight آپدیت تمام‌نشده دارد؛ پس از آن dispatch منتظر می‌ماند و
+    getUpdates بعدی (یا پاسخ وبهوک) عقب می‌افتد تا تلگرام آپدیت‌ها را نگه دارد. آپدیت‌های در جریانِ
+    workerی که از کار بیفتد از دست می‌روند و شمرده می‌شوند؛ مانند از کار افتادن نسخه تک‌پردازه‌ای.
+    """
+
+    def __init__(self, count, max_inflight, request_factory=None):
+        self.count = count
+        self.max_inflight = max_inflight
+        self.request_factory = request_factory
+        self.dispatched = 0
+        self.lost = 0
+        self.workers = [WorkerHandle(i) for i in range(count)]
+        # spawn: worker از پردازه‌ای با event loop و threadهای در حال اجرا fork نمی‌شود
+        self._ctx = multiprocessing.get_context('spawn')
+        self._loop = None
+        self._stopping = False
+        self._monitor_task = None
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        for worker in self.workers:
+            self._spawn(worker)
+        self._monitor_task = asyncio.ensure_future(self._monitor())
+
+    def healthy(self):
+        return all(worker.ready for worker in self.workers)
+
+    async def ready(self):
+        return self.healthy()
+
+    def _spawn(self, worker):
+        if self._stopping:
+            return
+        parent, child = self._ctx.Pipe()
+        metrics_reader, metrics_writer = self._ctx.Pipe(duplex=False)
+        worker.process = self._ctx.Process(
+            target=worker_main, args=(worker.index, self.count, child, metrics_writer, self.request_factory),
+            name=f"library-worker-{worker.index}",
+        )
+        worker.process.start()
+        child.close()
+        metrics_writer.close()
+        worker.conn = parent
+        worker.metrics_conn = metrics_reader
+        # پایان پردازه را sentinel گزارش می‌کند؛ خطای ارسال همان‌جا شمرده می‌شود
+        worker.writer = PipeWriter(parent, f"worker-{worker.index}-writer")
+        worker.last_seen = time.monotonic()
+        self._loop.add_reader(parent.fileno(), self._on_message, worker)
+        self._loop.add_reader(metrics_reader.fileno(), self._on_metrics, worker)
+        self._loop.add_reader(worker.process.sentinel, self._on_exit, worker)
+
+    def _on_message(self, worker):
+        try:
+            while worker.conn.poll():
+                message = worker.conn.recv()
+                worker.last_seen = time.monotonic()
+                if message[0] == 'done':
+                    worker.inflight -= 1
+                    worker.processed += 1
+                elif message[0] == 'ready':
+                    worker.ready = True
+                    logger.info(f"worker {worker.index} (pid {worker.process.pid}) آماده است.")
+        except (EOFError, OSError):
+            # پایان پردازه را sentinel گزارش می‌کند
+            self._loop.remove_reader(worker.conn.fileno())
+            return
+        if worker.ready and worker.inflight < self.max_inflight:
+            worker.room.set()
+
+    def _on_metrics(self, worker):
+        try:
+            while worker.metrics_conn.poll():
+                worker.metrics = worker.metrics_conn.recv()
+        except (EOFError, OSError):
+            self._loop.remove_reader(worker.metrics_conn.fileno())
+
+    def _detach(self, worker):
+        if worker.conn is None:
+            return
+        self._loop.remove_reader(worker.process.sentinel)
+        self._loop.remove_reader(worker.conn.fileno())
+        self._loop.remove_reader(worker.metrics_conn.fileno())
+        worker.writer.close(0)
+        worker.conn.close()
+        worker.metrics_conn.close()
+        worker.conn = worker.metrics_conn = worker.writer = None
+        worker.ready = False
+        worker.metrics = None
+        worker.room.clear()
+        if worker.inflight:
+            self.lost += worker.inflight
+            logger.error(f"{worker.inflight} آپدیت در جریان worker {worker.index} از دست رفت.")
+            worker.inflight = 0
+
+    def _on_exit(self, worker):
+        self._detach(worker)
+        worker.process.join()
+        if self._stopping:
+            return
+        worker.restarts += 1
+        logger.error(f"worker {worker.index} با کد {worker.process.exitcode} متوقف شد؛ اجرای دوباره.")
+        self._loop.call_later(1, self._spawn, worker)
+
+    async def _monitor(self):
+        while True:
+            await asyncio.sleep(WORKER_HEARTBEAT_INTERVAL)
+            now = time.monotonic()
+            for worker in self.workers:
+                if worker.conn is None:
+                    continue  # پایان یافته و منتظر اجرای دوباره
+                silent = now - worker.last_seen
+                if worker.ready and silent > WORKER_HEARTBEAT_TIMEOUT:
+                    logger.error(f"worker {worker.index} {silent:.0f} ثانیه پاسخ نداده؛ کشته می‌شود.")
+                elif not worker.ready and silent > WORKER_START_TIMEOUT:
+                    # تا آماده نشود dispatch آپدیت‌های سهم او (و در polling کل دریافت) منتظر می‌ماند
+                    logger.error(f"worker {worker.index} در {silent:.0f} ثانیه آماده نشد؛ کشته می‌شود.")
+                else:
+                    continue
+                worker.ready = False
+                worker.process.kill()
+
+    def metrics(self):
+        """snapshot متریک‌های workerها برای render_metrics"""
+        return [(f'worker="{w.index}"', w.metrics) for w in self.workers if w.metrics]
+
+    async def dispatch(self, data, timeout=None):
+        """فرستادن یک آپدیت خام به worker فرستنده‌اش؛ تا جا باز شود صبر می‌کند"""
+        key = update_shard_key(data)
+        worker = self.workers[key % self.count]
+        while not worker.room.is_set():
+            try:
+                await asyncio.wait_for(worker.room.wait(), timeout)
+            except asyncio.TimeoutError:
+                raise WorkerOverloaded(f"worker {worker.index} پر است.") from None
+        # ارسال در thread نویسنده؛ اگر worker بمیرد این آپدیت در inflight او گم‌شده شمرده می‌شود
+        worker.writer.send(('update', key, data))
+        worker.inflight += 1
+        self.dispatched += 1
+        if worker.inflight >= self.max_inflight:
+            worker.room.clear()
+
+    async def stop(self, timeout):
+        """تخلیه: workerها کار در دستشان را تمام می‌کنند و می‌بندند؛ پس از timeout کشته می‌شوند"""
+        self._stopping = True
+        if self._monitor_task is not None:
+            self._monitor_task.cancel()
+        for worker in self.workers:
+            if worker.writer is not None:
+                worker.writer.send(('drain',))
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            if worker.process is None:
+                continue
+            await self._loop.run_in_executor(None, worker.process.join, max(0.0, deadline - time.monotonic()))
+            if worker.process.is_alive():
+                logger.warning(f"worker {worker.index} در {timeout:.0f} ثانیه تخلیه نشد؛ کشته می‌شود.")
+                worker.process.kill()
+                await self._loop.run_in_executor(None, worker.process.join)
+            # پیام‌های done آخر پیش از بستن pipe خوانده می‌شوند
+            if worker.conn is not None:
+                self._on_message(worker)
+            self._detach(worker)
+
+CallbackMetric('library_worker_updates_total', "Updates completed per worker", 'counter', ('worker',),
+               lambda: [((w.index,), w.processed) for w in supervisor.workers] if supervisor else [])
+CallbackMetric('library_worker_in_flight', "Updates dispatched to a worker and not yet completed", 'gauge', ('worker',),
+               lambda: [((w.index,), w.inflight) for w in supervisor.workers] if supervisor else [])
+CallbackMetric('library_worker_restarts_total', "Worker processes restarted after exit or missed heartbeats", 'counter',
+               ('worker',), lambda: [((w.index,), w.restarts) for w in supervisor.workers] if supervisor else [])
+CallbackMetric('library_worker_lost_updates_total', "Updates in flight on a worker when it died", 'counter', (),
+               lambda: [((), supervisor.lost)] if supervisor else [])
+
+async def poll_updates(bot, dispatch, state):
+    """getUpdates و پخش آپدیت‌های خام؛ state['offset'] فقط پس از تحویل هر آپدیت جلو می‌رود"""
+    # آپدیت‌ها در ingress فقط JSON خوانده می‌شوند؛ ساختن اشیای Update کار workerهاست
+    warnings.filterwarnings("ignore", message="Please use 'Bot.getUpdates'", category=PTBDeprecationWarning)
+    while True:
+        params = {'timeout': POLL_TIMEOUT, 'allowed_updates': Update.ALL_TYPES}
+        if state['offset'] is not None:
+            params['offset'] = state['offset']
+        try:
+            updates = await bot.do_api_request('getUpdates', params, read_timeout=POLL_TIMEOUT + 10)
+        except RetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+            continue
+        except TelegramError as e:
+            logger.warning(f"getUpdates ناموفق بود؛ تلاش دوباره: {e}")
+            await asyncio.sleep(1)
+            continue
+        for data in updates:
+            await dispatch(data)
+            state['offset'] = data['update_id'] + 1
+
+async def run_ingress(count) -> None:
+    """چرخه عمر پردازه ingress: اجرای workerها، دریافت آپدیت تا سیگنال توقف، و تخلیه تمیز"""
+    global supervisor
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    supervisor = Supervisor(count, WORKER_MAX_INFLIGHT)
+    await supervisor.start()
+    bot = Bot(TOKEN, request=InstrumentedRequest(), get_updates_request=HTTPXRequest(read_timeout=POLL_TIMEOUT + 10))
+    await bot.initialize()
+    server = poller = None
+    state = {'offset': None}
+    try:
+        server = start_http_server(
+            functools.partial(supervisor.dispatch, timeout=WEBHOOK_DISPATCH_TIMEOUT), supervisor.ready)
+        if BOT_MODE == 'webhook':
+            await bot.set_webhook(
+                WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+            )
+        else:
+            await bot.delete_webhook()
+            poller = asyncio.ensure_future(poll_updates(bot, supervisor.dispatch, state))
+        logger.info(f"ربات با {count} worker در حال اجراست...")
+        await stop.wait()
+    finally:
+        # ورودی تازه بسته می‌شود؛ تلگرام آپدیت‌های بعدی را برای نمونه بعدی نگه می‌دارد
+        if server:
+            server.stop()
+        if poller is not None:
+            poller.cancel()
+            try:
+                await poller
+            except asyncio.CancelledError:
+                pass
+            if state['offset'] is not None:
+                try:
+                    # تأیید آپدیت‌های تحویل‌شده تا نمونه بعدی دوباره نگیردشان
+                    await bot.do_api_request('getUpdates', {'offset': state['offset'], 'limit': 1, 'timeout': 0})
+                except TelegramError as e:
+                    logger.warning(f"تأیید offset نهایی ناموفق بود: {e}")
+        await supervisor.stop(WORKER_DRAIN_TIMEOUT)
+        await bot.shutdown()
+
+# --- محافظ پیش از dispatch ---
+# یک TypeHandler در گروه -1 پیش از همه handlerها اجرا می‌شود و آپدیت رد‌شده را با
+# ApplicationHandlerStop متوقف می‌کند: update_id تکراری (ارسال دوباره تلگرام)، کاربری که سطل
+# توکنش خالی است (کوبیدن روی یک دکمه یا متن‌های پشت سر هم که هر کدام start و چند کوئری را اجرا
+# می‌کنند)، و در بار زیاد هر آپدیتی جز ادمین‌ها. هیچ‌کدام از این تصمیم‌ها به دیتابیس نیاز ندارد و
+# پاسخ «آهسته‌تر» متن ثابتی است که حداکثر هر GUARD_NOTICE_INTERVAL یک بار برای هر کاربر فرستاده می‌شود.
+
+GUARD_SLOW_TEXT = "⏳ پیام‌های شما خیلی سریع می‌رسند؛ چند ثانیه صبر کنید و دوباره تلاش کنید."
+GUARD_BUSY_TEXT = "🚦 ربات در این لحظه شلوغ است؛ لطفاً کمی بعد دوباره تلاش کنید."
+
+class UpdateGuard:
+    """تصمیم درباره هر آپدیت پیش از dispatch با حافظه محدود؛ check همان callback TypeHandler است"""
+
+    def __init__(self, rate, burst, dedup_size, max_users, max_in_flight, max_db_waiting, notice_interval):
+        self.rate = rate
+        self.burst = burst
+        self.dedup_size = dedup_size
+        self.max_users = max_users
+        self.max_in_flight = max_in_flight
+        self.max_db_waiting = max_db_waiting
+        self.notice_interval = notice_interval
+        self._seen = set()
+        self._order = deque()  # ترتیب ورود update_idها برای بیرون انداختن قدیمی‌ترین
+        self._buckets = OrderedDict()  # user_id -> TokenBucket به ترتیب آخرین استفاده
+        self._noticed = OrderedDict()  # user_id -> زمان آخرین پیام «آهسته‌تر» یا «شلوغ»
+
+    def duplicate(self, update_id):
+        if update_id in self._seen:
+            return True
+        self._seen.add(update_id)
+        self._order.append(update_id)
+        if len(self._order) > self.dedup_size:
+            self._seen.discard(self._order.popleft())
+        return False
+
+    def allow(self, user_id):
+        if self.rate <= 0:
+            return True
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            # سطل کاربری که مدتی نیامده پر است؛ بیرون انداختنش رفتار را عوض نمی‌کند
+            bucket = self._buckets[user_id] = TokenBucket(self.rate, self.burst)
+            if len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user_id)
+        return bucket.try_take()
+
+    def overloaded(self):
+        if handlers_in_flight.total() >= self.max_in_flight:
+            return True
+        return db_pool is not None and db_pool.waiting >= self.max_db_waiting
+
+    def classify(self, update):
+        """دلیل رد آپدیت ('duplicate'، 'shed'، 'throttled') یا None"""
+        if self.duplicate(update.update_id):
+            return 'duplicate'
+        # جستجوی inline از ایندکس حافظه پاسخ می‌گیرد و تلگرام برای هر حرف یک آپدیت می‌فرستد
+        if update.inline_query is not None or update.chosen_inline_result is not None:
+            return None
+        user = update.effective_user
+        if user is None:
+            return None
+        # فهرست ادمین‌ها از کش خوانده می‌شود، حتی اگر TTL آن گذشته باشد
+        if user.id in (admin_cache.peek() or ()):
+            return None
+        if self.overloaded():
+            return 'shed'
+        if not self.allow(user.id):
+            return 'throttled'
+        return None
+
+    def should_notice(self, user_id):
+        now = time.monotonic()
+        last = self._noticed.get(user_id)
+        if last is not None and now - last < self.notice_interval:
+            return False
+        self._noticed[user_id] = now
+        self._noticed.move_to_end(user_id)
+        while len(self._noticed) > self.max_users:
+            self._noticed.popitem(last=False)
+        return True
+
+    async def check(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        reason = self.classify(update)
+        if reason is None:
+            return
+        updates_dropped.inc((reason,))
+        user = update.effective_user
+        if reason != 'duplicate' and user is not None and self.should_notice(user.id):
+            text = GUARD_SLOW_TEXT if reason == 'throttled' else GUARD_BUSY_TEXT
+            if update.callback_query is not None:
+                try:
+                    await update.callback_query.answer(text)
+                except TelegramError as e:
+                    logger.warning(f"پاسخ به دکمه محدودشده ناموفق بود: {e}")
+            else:
+                notifier.notify(user.id, text)
+        raise ApplicationHandlerStop
+
+update_guard = UpdateGuard(GUARD_USER_RATE, GUARD_USER_BURST, GUARD_DEDUP_SIZE, GUARD_MAX_USERS,
+                           GUARD_MAX_IN_FLIGHT, GUARD_MAX_DB_WAITING, GUARD_NOTICE_INTERVAL)
+
+# --- تابع اصلی ---
+def build_application(request=None) -> Application:
+    """ساخت Application با همه handlerها؛ request برای اجرای آفلاین (بنچمارک) قابل جایگزینی است"""
+    # استخر اتصال و جداول در post_init ساخته و در post_shutdown بسته می‌شوند؛ صف پیام در post_stop خالی می‌شود
+    app = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(True)
+        .request(request or InstrumentedRequest(connection_pool_size=256))
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+        .persistence(PostgresPersistence(PERSISTENCE_INTERVAL))
+        .build()
+    )
 
     # افزودن هندلرها
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("addadmin", add_admin_info))
+    app.add_handler(CommandHandler("slowlog", slowlog_command))
+    app.add_handler(CommandHandler("stats", stats_command))
+    app.add_handler(CommandHandler("stats_backfill", stats_backfill_command))
+    app.add_handler(CommandHandler("export", export_command))
+    app.add_handler(CallbackQueryHandler(page_callback, pattern=r'^pg:'))
+    app.add_handler(CallbackQueryHandler(waitlist_callback, pattern=r'^wl:\d+$'))
+    app.add_handler(CallbackQueryHandler(book_callback, pattern=r'^bk:(borrow|details):\d+$'))
+    app.add_handler(InlineQueryHandler(inline_search))
     
     # 1. افزودن کتاب
     app.add_handler(ConversationHandler(
+        name='add_book', persistent=True,
         entry_points=[MessageHandler(filters.Regex('^📚 افزودن کتاب$'), add_book_start)],
         states={
             GET_TITLE: [MessageHandler(filters.TEXT & ~filters.COMMAND & ~filters.Regex('^لغو عملیات$'), get_title)],
@@ -558,6 +4294,7 @@ def main() -> None:
     
     # 2. جستجو
     app.add_handler(ConversationHandler(
+        name='search', persistent=True,
         entry_points=[MessageHandler(filters.Regex('^🔍 جستجوی کتاب$'), search_start)],
         states={SEARCH_QUERY: [MessageHandler(filters.TEXT & ~filters.COMMAND & ~filters.Regex('^لغو عملیات$'), execute_search)]},
         fallbacks=[MessageHandler(filters.ALL, cancel)]
@@ -565,6 +4302,7 @@ def main() -> None:
     
     # 3. مرور موضوعی
     app.add_handler(ConversationHandler(
+        name='browse', persistent=True,
         entry_points=[MessageHandler(filters.Regex('^🏷️ مرور موضوعی$'), browse_start)],
         states={BROWSE_GET_SUBJECT_CHOICE: [MessageHandler(filters.TEXT & ~filters.COMMAND & ~filters.Regex('^لغو عملیات$'), browse_show_books)]},
         fallbacks=[MessageHandler(filters.ALL, cancel)]
@@ -572,6 +4310,7 @@ def main() -> None:
 
     # 4. ویرایش
     app.add_handler(ConversationHandler(
+        name='edit_count', persistent=True,
         entry_points=[MessageHandler(filters.Regex('^✏️ ویرایش موجودی$'), edit_count_start)],
         states={
             EDIT_GET_ID: [MessageHandler(filters.TEXT & ~filters.COMMAND & ~filters.Regex('^لغو عملیات$'), get_book_id_for_edit)],
@@ -581,6 +4320,7 @@ def main() -> None:
     
     # 5. امانت
     app.add_handler(ConversationHandler(
+        name='borrow', persistent=True,
         entry_points=[MessageHandler(filters.Regex('^🤝 امانت کتاب$'), borrow_book_start)],
         states={BORROW_GET_ID: [MessageHandler(filters.TEXT & ~filters.COMMAND & ~filters.Regex('^لغو عملیات$'), process_borrow_id)]},
         fallbacks=[MessageHandler(filters.ALL, cancel)]
@@ -588,6 +4328,7 @@ def main() -> None:
     
     # 6. بازگشت
     app.add_handler(ConversationHandler(
+        name='return', persistent=True,
         entry_points=[MessageHandler(filters.Regex('^↩️ بازگشت کتاب$'), return_book_start)],
         states={RETURN_GET_LOAN_ID: [MessageHandler(filters.TEXT & ~filters.COMMAND & ~filters.Regex('^لغو عملیات$'), process_return_id)]},
         fallbacks=[MessageHandler(filters.ALL, cancel)]
@@ -595,6 +4336,7 @@ def main() -> None:
     
     # 7. جزئیات
     app.add_handler(ConversationHandler(
+        name='details', persistent=True,
         entry_points=[MessageHandler(filters.Regex('^🔎 جزئیات کتاب$'), details_start)],
         states={DETAILS_GET_ID: [MessageHandler(filters.TEXT & ~filters.COMMAND & ~filters.Regex('^لغو عملیات$'), show_details)]},
         fallbacks=[MessageHandler(filters.ALL, cancel)]
@@ -602,6 +4344,7 @@ def main() -> None:
     
     # 8. حذف
     app.add_handler(ConversationHandler(
+        name='delete', persistent=True,
         entry_points=[MessageHandler(filters.Regex('^🗑️ حذف کتاب$'), delete_book_start)],
         states={
             DELETE_GET_ID: [MessageHandler(filters.TEXT & ~filters.COMMAND & ~filters.Regex('^لغو عملیات$'), delete_get_id)],
@@ -609,22 +4352,57 @@ def main() -> None:
         }, fallbacks=[MessageHandler(filters.ALL, cancel)]
     ))
     
-    # 9. تایید امانت
+    # 9. تایید امانت (چک‌باکس‌ها عمداً به ازای کاربر دنبال می‌شوند، نه به ازای پیام)
+    warnings.filterwarnings("ignore", message="If 'per_message=False'", category=PTBUserWarning)
     app.add_handler(ConversationHandler(
+        name='approval', persistent=True,
         entry_points=[MessageHandler(filters.Regex('^📩 درخواست‌های امانت$'), approval_start)],
         states={
-            APPROVAL_GET_LOAN_ID: [MessageHandler(filters.TEXT & ~filters.COMMAND & ~filters.Regex('^لغو عملیات$'), approval_get_loan_id)],
-            APPROVAL_CONFIRM_ACTION: [MessageHandler(filters.Regex('^✅ تأیید امانت$|^❌ رد درخواست$|^لغو عملیات$'), approval_confirm_action)]
+            APPROVAL_GET_LOAN_ID: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND & ~filters.Regex('^لغو عملیات$'), approval_get_loan_id),
+                CallbackQueryHandler(approval_select_callback, pattern=r'^ap:'),
+            ],
+            APPROVAL_CONFIRM_ACTION: [MessageHandler(filters.Regex('^✅ تأیید امانت$|^❌ رد درخواست$|^✅ تأیید و رد مازاد$|^لغو عملیات$'), approval_confirm_action)]
         }, fallbacks=[MessageHandler(filters.ALL, cancel)]
     ))
 
+    # 10. ورود گروهی
+    app.add_handler(ConversationHandler(
+        name='import', persistent=True,
+        entry_points=[CommandHandler("import", import_start)],
+        states={IMPORT_GET_FILE: [MessageHandler(filters.Document.ALL, import_file)]},
+        fallbacks=[MessageHandler(filters.ALL, cancel)]
+    ))
+
     # هندلرهای ساده
+    app.add_handler(CallbackQueryHandler(expired_callback))
     app.add_handler(MessageHandler(filters.Regex('^📕 کتاب‌های من$'), my_loans))
     app.add_handler(MessageHandler(filters.Regex('^📦 لیست امانت‌ها$'), list_loans))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, start))
+    instrument_handlers(app)
+    # پس از instrument_handlers تا محافظ خودش در handlers_in_flight و trace شمرده نشود
+    app.add_handler(TypeHandler(Update, update_guard.check), group=-1)
+    return app
+
+def main() -> None:
+    # بررسی متغیرهای محیطی
+    if not TOKEN:
+        logger.critical("توکن یافت نشد! TOKEN را در تنظیمات Render چک کنید.")
+        return
+    if not DATABASE_URL:
+        logger.critical("آدرس دیتابیس یافت نشد! DATABASE_URL را در تنظیمات Render چک کنید.")
+        return
 
-    logger.info("ربات در حال اجراست...")
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    if BOT_MODE == 'webhook' and not WEBHOOK_URL:
+        logger.critical("برای حالت webhook باید WEBHOOK_URL تنظیم شود.")
+        return
+    if BOT_MODE == 'webhook' and not WEBHOOK_SECRET:
+        logger.critical("برای حالت webhook باید WEBHOOK_SECRET تنظیم شود (برای همه نمونه‌ها یکسان).")
+        return
+    if BOT_WORKERS > 0:
+        asyncio.run(run_ingress(BOT_WORKERS))
+    else:
+        asyncio.run(run_bot(build_application()))
 
 if __name__ == '__main__':
     main()